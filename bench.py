@@ -0,0 +1,711 @@
+import phase
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import py_compile
+import re
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import List, Tuple, Callable, Pattern, Any
+
+# number of directory entries to benchmark against, overridable from the
+# command line, e.g. python3 bench.py 10000 50000
+DEFAULT_SIZES: List[int] = [10_000, 100_000, 1_000_000]
+# fraction of the entries in each directory that are product files; the
+# rest are unrelated files, as in a real product directory
+PRODUCT_FRACTION: float = 0.5
+REPEATS: int = 15
+LIMIT: int = 11
+# directory products deleted at once, & the files in each, for bench_clean
+CLEAN_TREES: int = 4
+CLEAN_TREE_FILES: int = 5_000
+CLEAN_REPEATS: int = 3
+# entries in the directory bench_matcher scans, & the fraction of them
+# which are product files; the rest are unrelated files & near misses
+MATCHER_SIZE: int = 100_000
+MATCHER_PRODUCT_FRACTION: float = 0.05
+# the number of versions bench_product stores, & the frequency its
+# queries use
+PRODUCT_SIZE: int = 1_000_000
+PRODUCT_FREQUENCY: int = 5
+# runs of each command for bench_startup
+STARTUP_REPEATS: int = 20
+# the commands bench_startup times, run in a small product
+STARTUP_COMMANDS: List[List[str]] = [
+    ["-v"],
+    ["-h"],
+    ["--only-open"],
+    ["config","--check"],
+    ["backup","--sample"],
+    ["date","thingy_v1.ods"],
+]
+
+
+# where bench.py --suite keeps the results it compares against
+DEFAULT_BASELINE: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "bench-baseline.json"
+)
+# how much slower than the baseline an operation can get before it counts as
+# a regression, and how many seconds slower, so that tiny timings which are
+# mostly noise don't fail the suite
+DEFAULT_TOLERANCE: float = 1.5
+MIN_REGRESSION: float = 0.005
+SUITE_REPEATS: int = 5
+
+
+"""
+The shape of a synthetic product directory for bench_suite.
+    @param files: The number of versions of the product.
+    @param size: The size of each version, in bytes.
+    @param padding: The number of digits version numbers are zero-padded to.
+    @param dirs: The fraction of versions that are directories (of 4 files)
+        rather than files.
+    @param noise: The number of unrelated files in the directory.
+    @param near_noise: The number of files whose names look like product
+        files but don't match the pattern, e.g. editor backups.
+"""
+class Scenario():
+    def __init__(
+            self,
+            name: str,
+            files: int,
+            size: int=1024,
+            padding: int=0,
+            dirs: float=0.0,
+            noise: int=0,
+            near_noise: int=0
+    ):
+        self.name: str = name
+        self.files: int = files
+        self.size: int = size
+        self.padding: int = padding
+        self.dirs: float = dirs
+        self.noise: int = noise
+        self.near_noise: int = near_noise
+
+    def version_name(self, version: int) -> str:
+        return f"thingy_v{version:0{self.padding}d}.ods"
+
+    def seed(self, path: str):
+        body: bytes = b"x" * self.size
+        # spread the directory products out evenly among the file ones
+        every: int = round(1 / self.dirs) if self.dirs else 0
+        for version in range(1, self.files + 1):
+            name: str = f"{path}/{self.version_name(version)}"
+            if every and version % every == 0:
+                os.mkdir(name)
+                for i in range(4):
+                    with open(f"{name}/part{i}", "wb") as fp:
+                        fp.write(body[:self.size // 4])
+            else:
+                with open(name, "wb") as fp:
+                    fp.write(body)
+        for i in range(self.noise):
+            os.close(os.open(f"{path}/unrelated_{i}", os.O_CREAT | os.O_WRONLY))
+        for i in range(self.near_noise):
+            os.close(os.open(
+                f"{path}/{self.version_name(i)}.bak", os.O_CREAT | os.O_WRONLY
+            ))
+
+SCENARIOS: List[Scenario] = [
+    Scenario("small", 100),
+    Scenario("files-10k", 10_000, size=256),
+    Scenario("big-files", 200, size=4 * 1024 * 1024),
+    Scenario("padded", 10_000, size=256, padding=6),
+    Scenario("dirs", 2_000, size=1024, dirs=0.5),
+    Scenario("noisy", 2_000, size=256, noise=50_000, near_noise=20_000),
+    Scenario("many-versions", 100_000, size=0),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for phase. With no options, compares "
+        "get_versions with a plain listdir & sort, and clean with "
+        "shutil.rmtree."
+    )
+    parser.add_argument(
+        "sizes", nargs="*", type=int,
+        help="directory sizes to benchmark get_versions with"
+    )
+    parser.add_argument(
+        "--startup", action="store_true",
+        help="time how long each command takes to start up"
+    )
+    parser.add_argument(
+        "--matcher", action="store_true",
+        help="time scanning a mostly unrelated directory with & without "
+        "the literal prefilter"
+    )
+    parser.add_argument(
+        "--product", action="store_true",
+        help="compare the memory use & query times of a Product with a "
+        "plain list of tuples"
+    )
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="time every operation on synthetic products, and compare with "
+        "the baseline"
+    )
+    parser.add_argument(
+        "--scenario", action="append", default=[],
+        help="only run the suite scenario with this name (can be repeated)"
+    )
+    parser.add_argument("--files", type=int, help="run a custom scenario with "
+        "this many versions, instead of the built-in ones")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--padding", type=int, default=0)
+    parser.add_argument("--dirs", type=float, default=0.0)
+    parser.add_argument("--noise", type=int, default=0)
+    parser.add_argument("--near-noise", type=int, default=0)
+    parser.add_argument(
+        "--json", metavar="FILE", help="write the suite's results to FILE"
+    )
+    parser.add_argument(
+        "--baseline", metavar="FILE", default=DEFAULT_BASELINE,
+        help=f"the results to compare with (default {DEFAULT_BASELINE})"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true",
+        help="make these results the new baseline"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+        help="how many times slower than the baseline an operation can be "
+        f"(default {DEFAULT_TOLERANCE})"
+    )
+    args = parser.parse_args()
+    if args.startup:
+        bench_startup()
+        return
+    if args.matcher:
+        bench_matcher(args.sizes[0] if args.sizes else MATCHER_SIZE)
+        return
+    if args.product:
+        bench_product(args.sizes[0] if args.sizes else PRODUCT_SIZE)
+        return
+    if args.suite:
+        scenarios: List[Scenario] = [
+            scenario for scenario in SCENARIOS
+            if not args.scenario or scenario.name in args.scenario
+        ]
+        if args.files is not None:
+            scenarios = [Scenario(
+                "custom", args.files, args.size, args.padding, args.dirs,
+                args.noise, args.near_noise
+            )]
+        results: dict[str,float] = bench_suite(scenarios)
+        report: dict[str,Any] = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }
+        if args.json:
+            with open(args.json, "w") as fp:
+                json.dump(report, fp, indent=4)
+        if args.save_baseline:
+            with open(args.baseline, "w") as fp:
+                json.dump(report, fp, indent=4)
+            print(f"saved baseline to {args.baseline}")
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as fp:
+                baseline: dict[str,float] = json.load(fp)["results"]
+            if compare_results(results, baseline, args.tolerance):
+                sys.exit(1)
+        return
+    for size in args.sizes or DEFAULT_SIZES:
+        bench_get_versions(size)
+    bench_clean()
+
+
+def seed_dir(path: str, size: int):
+    num_products: int = int(size * PRODUCT_FRACTION)
+    for i in range(num_products):
+        os.close(os.open(f"{path}/thingy_v{i}.ods", os.O_CREAT | os.O_WRONLY))
+    for i in range(size - num_products):
+        os.close(os.open(f"{path}/unrelated_{i}", os.O_CREAT | os.O_WRONLY))
+
+"""
+Runs a function several times and returns the best wall time, in seconds.
+"""
+def best_time(func: Callable[[], Any]) -> float:
+    best: float = float("inf")
+    for _ in range(REPEATS):
+        start: float = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+"""
+The way get_versions worked before it used os.scandir & top-K selection,
+kept here so there is something to compare against.
+"""
+def listdir_get_versions(regex: Pattern) -> List[Tuple[str,int]]:
+    versions: List[Tuple[str,int]] = []
+    for filename in os.listdir():
+        match = regex.fullmatch(filename)
+        if  match == None:
+            continue
+        versions.append( (filename, int(match.group(1))) )
+    versions.sort(key=lambda product_file: product_file[1], reverse=True)
+    return versions
+
+def bench_get_versions(size: int):
+    regex: Pattern = phase.pat_to_regex("thingy_v%V.ods")
+    orig_dir: str = os.getcwd()
+    tmp_dir: str = tempfile.mkdtemp(prefix="phase-bench-")
+    try:
+        seed_dir(tmp_dir, size)
+        os.chdir(tmp_dir)
+        results: dict[str,float] = {
+            "listdir + sort": best_time(lambda: listdir_get_versions(regex)),
+            "get_versions": best_time(lambda: phase.get_versions(regex)),
+            "get_versions(newest=1)":
+                best_time(lambda: phase.get_versions(regex, 1)),
+            f"get_versions(newest={LIMIT})":
+                best_time(lambda: phase.get_versions(regex, LIMIT)),
+        }
+    finally:
+        os.chdir(orig_dir)
+        shutil.rmtree(tmp_dir)
+    baseline: float = results["listdir + sort"]
+    print(f"{size} directory entries:")
+    for name, seconds in results.items():
+        print(
+            f"    {name:<26} {seconds*1000:>10.2f}ms"
+            f"  ({baseline/seconds:.2f}x)"
+        )
+
+"""
+How scan_versions worked before it used a VersionMatcher: every name is
+matched against the regex.
+"""
+def regex_scan_versions(
+        regex: Pattern,
+        path: str="."
+) -> List[Tuple[str,int]]:
+    versions: List[Tuple[str,int]] = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            match = regex.fullmatch(entry.name)
+            if match is not None:
+                versions.append((entry.name, int(match.group(1))))
+    return versions
+
+def bench_matcher(size: int):
+    regex: Pattern = phase.pat_to_regex("thingy_v%V.ods")
+    backups: Pattern = phase.backup_regex(regex)
+    tmp_dir: str = tempfile.mkdtemp(prefix="phase-bench-")
+    try:
+        num_products: int = int(size * MATCHER_PRODUCT_FRACTION)
+        # unrelated files, then editor backups & the like, which share the
+        # product files' prefix
+        Scenario(
+            "matcher", num_products, size=0,
+            noise=(size - num_products) * 3 // 4,
+            near_noise=(size - num_products) // 4
+        ).seed(tmp_dir)
+        results: dict[str,float] = dict()
+        for name, pattern in [("product", regex), ("backup", backups)]:
+            assert sorted(regex_scan_versions(pattern, tmp_dir)) \
+                == sorted(phase.scan_versions(pattern, tmp_dir))
+            results[f"{name} regex"] = \
+                best_time(lambda: regex_scan_versions(pattern, tmp_dir))
+            results[f"{name} matcher"] = \
+                best_time(lambda: list(phase.scan_versions(pattern, tmp_dir)))
+    finally:
+        shutil.rmtree(tmp_dir)
+    print(
+        f"{size} directory entries, "
+        f"{MATCHER_PRODUCT_FRACTION:.0%} of them product files:"
+    )
+    for name, seconds in results.items():
+        baseline: float = results[name.split()[0] + " regex"]
+        print(
+            f"    {name:<26} {seconds*1000:>10.2f}ms"
+            f"  ({baseline/seconds:.2f}x)"
+        )
+
+"""
+Measures how much memory the versions of a product with very many of them
+take up, and how long the queries phase makes of them take, stored as a
+plain list of (name, version) tuples (sorted, and queried by walking it, as
+phase used to) and as a Product.
+"""
+def bench_product(size: int):
+    import random
+    import tracemalloc
+    files: List[Tuple[str,int]] = \
+        [(f"thingy_v{i}.ods", i) for i in range(size)]
+    random.seed(0)
+    random.shuffle(files)
+    middle: int = size // 2
+    def make_list() -> List[Tuple[str,int]]:
+        versions: List[Tuple[str,int]] = \
+            [(name, version) for name, version in files]
+        versions.sort(key=lambda file: file[1], reverse=True)
+        return versions
+    def make_product() -> phase.Product:
+        product = phase.Product(files)
+        product.sort()
+        return product
+    memory: dict[str,int] = {}
+    stores: dict[str,Any] = {}
+    for name, make in [("list", make_list), ("Product", make_product)]:
+        tracemalloc.start()
+        stores[name] = make()
+        memory[name] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    versions: List[Tuple[str,int]] = stores["list"]
+    product: phase.Product = stores["Product"]
+    assert product == versions
+    queries: List[Tuple[str,Callable[[],Any],Callable[[],Any]]] = [
+        (
+            "build & sort",
+            make_list,
+            make_product,
+        ),
+        (
+            "find a version",
+            lambda: [file for file in versions if file[1] == middle],
+            lambda: product.find(middle),
+        ),
+        (
+            "range of 100 versions",
+            lambda: [
+                file for file in versions if middle <= file[1] < middle + 100
+            ],
+            lambda: product.between(middle, middle + 99),
+        ),
+        (
+            f"every {PRODUCT_FREQUENCY}th version",
+            lambda: [
+                file for file in versions if file[1] % PRODUCT_FREQUENCY == 0
+            ],
+            lambda: product.every(PRODUCT_FREQUENCY),
+        ),
+        (
+            f"all but the newest {LIMIT}",
+            lambda: versions[phase.version_cut(versions, LIMIT):],
+            lambda: product.all_but_newest(LIMIT),
+        ),
+    ]
+    print(f"{size} versions:          list   Product")
+    print(
+        f"    {'memory':<26} {memory['list']/2**20:>9.1f}MB"
+        f" {memory['Product']/2**20:>9.1f}MB"
+        f"  ({memory['list']/memory['Product']:.2f}x)"
+    )
+    for name, with_list, with_product in queries:
+        list_time: float = best_time(with_list)
+        product_time: float = best_time(with_product)
+        print(
+            f"    {name:<26} {list_time*1000:>9.2f}ms"
+            f" {product_time*1000:>9.2f}ms"
+            f"  ({list_time/product_time:.2f}x)"
+        )
+
+def seed_tree(path: str, num_files: int):
+    # 100 files a directory, like an unzipped document or a build output
+    for i in range(num_files):
+        if i % 100 == 0:
+            subdir: str = f"{path}/sub{i // 100}"
+            os.makedirs(subdir)
+        with open(f"{subdir}/file{i}","wb") as fp:
+            fp.write(b"x" * 100)
+
+"""
+Times deleting a few directory products, one after the other with
+shutil.rmtree and all at once with phase.remove_paths. The trees have to be
+made again for every run, so there are fewer repeats than elsewhere.
+"""
+def bench_clean():
+    results: dict[str,float] = {}
+    removers: dict[str,Callable[[List[str]],Any]] = {
+        "shutil.rmtree": lambda paths: [shutil.rmtree(path) for path in paths],
+        "remove_paths": phase.remove_paths,
+    }
+    for name, remove in removers.items():
+        best: float = float("inf")
+        for _ in range(CLEAN_REPEATS):
+            tmp_dir: str = tempfile.mkdtemp(prefix="phase-bench-")
+            try:
+                paths: List[str] = [
+                    f"{tmp_dir}/tree_v{i}" for i in range(CLEAN_TREES)
+                ]
+                for path in paths:
+                    seed_tree(path,CLEAN_TREE_FILES)
+                start: float = time.perf_counter()
+                remove(paths)
+                best = min(best, time.perf_counter() - start)
+            finally:
+                shutil.rmtree(tmp_dir)
+        results[name] = best
+    baseline: float = results["shutil.rmtree"]
+    print(f"clean {CLEAN_TREES} directories of {CLEAN_TREE_FILES} files:")
+    for name, seconds in results.items():
+        print(
+            f"    {name:<26} {seconds*1000:>10.2f}ms"
+            f"  ({baseline/seconds:.2f}x)"
+        )
+
+"""
+Runs a command several times and returns the best wall time, in seconds.
+"""
+def best_run_time(cmd: List[str], env: dict[str,str]) -> float:
+    best: float = float("inf")
+    for _ in range(STARTUP_REPEATS):
+        start: float = time.perf_counter()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+"""
+Times each of STARTUP_COMMANDS from start to exit, in a fresh interpreter,
+against an interpreter that does nothing at all. Each command is run two
+ways: as a script, which is compiled on every run, and through a launcher
+that imports phase, which is how make install sets phase up, so that the
+compiled module is cached.
+"""
+def bench_startup():
+    phase_file: str = os.path.abspath(phase.__file__)
+    tmp_dir: str = tempfile.mkdtemp(prefix="phase-bench-")
+    try:
+        # installed & compiled, as make install does
+        lib_dir: str = f"{tmp_dir}/lib"
+        os.mkdir(lib_dir)
+        shutil.copy(phase_file, lib_dir)
+        py_compile.compile(
+            f"{lib_dir}/phase.py",
+            cfile=importlib.util.cache_from_source(f"{lib_dir}/phase.py")
+        )
+        product: str = f"{tmp_dir}/product"
+        os.makedirs(f"{product}/backups")
+        with open(f"{product}/.phase", "w") as fp:
+            fp.write(
+                "pattern = 'thingy_v%V.ods'\n"
+                "limit = 100\n"
+                "[backup.sample]\n"
+                "frequency = 5\n"
+                "destination = './backups'\n"
+                "limit = 100\n"
+            )
+        seed_dir(product, 100)
+        # so --only-open doesn't really open anything
+        os.mkdir(f"{tmp_dir}/bin")
+        with open(f"{tmp_dir}/bin/xdg-open", "w") as fp:
+            fp.write("#!/bin/sh\n")
+        os.chmod(f"{tmp_dir}/bin/xdg-open", 0o755)
+        env: dict[str,str] = dict(os.environ)
+        env["PATH"] = f"{tmp_dir}/bin:{env['PATH']}"
+        launcher: str = (
+            f"import sys; sys.path.insert(0, {lib_dir!r}); "
+            "import phase; phase.main()"
+        )
+        baseline: float = best_run_time([sys.executable, "-c", "pass"], env)
+        print(f"startup, best of {STARTUP_REPEATS}:")
+        print(f"    {'python -c pass':<26} {baseline*1000:>10.2f}ms")
+        orig_dir: str = os.getcwd()
+        os.chdir(product)
+        try:
+            for args in STARTUP_COMMANDS:
+                script: float = best_run_time(
+                    [sys.executable, phase_file] + args, env
+                )
+                module: float = best_run_time(
+                    [sys.executable, "-c", launcher] + args, env
+                )
+                print(
+                    f"    {'phase ' + ' '.join(args):<26} "
+                    f"{module*1000:>10.2f}ms"
+                    f"  (+{(module - baseline)*1000:.2f}ms,"
+                    f" as a script {script*1000:.2f}ms)"
+                )
+        finally:
+            os.chdir(orig_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+"""
+Runs a function several times and returns the best wall time, in seconds,
+along with its last result.
+"""
+"""
+Measures the memory a product's versions take up as a Product, and times
+the queries bench_product does of them, for bench_suite.
+    @param versions: The versions, as get_versions lists them.
+    @return: Megabytes for the memory, and seconds for each query, keyed by
+        name.
+"""
+def product_timings(versions: phase.Product) -> dict[str,float]:
+    import tracemalloc
+    files: List[Tuple[str,int]] = list(versions)
+    def make_product() -> phase.Product:
+        product = phase.Product(files)
+        product.sort()
+        return product
+    tracemalloc.start()
+    product: phase.Product = make_product()
+    timings: dict[str,float] = \
+        {"Product memory": tracemalloc.get_traced_memory()[0] / 2**20}
+    tracemalloc.stop()
+    middle: int = product[len(product) // 2][1]
+    for name, query in [
+        ("Product build & sort", make_product),
+        ("Product.find", lambda: product.find(middle)),
+        ("Product.between", lambda: product.between(middle, middle + 99)),
+        ("Product.every", lambda: product.every(PRODUCT_FREQUENCY)),
+        ("Product.all_but_newest", lambda: product.all_but_newest(LIMIT)),
+    ]:
+        timings[name], _ = best_time_result(query, SUITE_REPEATS)
+    return timings
+
+def best_time_result(func: Callable[[], Any], repeats: int) -> Tuple[float,Any]:
+    best: float = float("inf")
+    result: Any = None
+    for _ in range(repeats):
+        start: float = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+"""
+Times each phase operation on each scenario's product, from listing the
+versions through to the whole of a phase run, and measures its versions
+(see product_timings). Operations that change the product are timed in the
+order a phase run does them, so each one sees the product as it would be.
+    @return: Seconds taken (megabytes, for memory), keyed by
+        "scenario/operation".
+"""
+def bench_suite(scenarios: List[Scenario]) -> dict[str,float]:
+    results: dict[str,float] = {}
+    for scenario in scenarios:
+        tmp_dir: str = tempfile.mkdtemp(prefix="phase-bench-")
+        orig_dir: str = os.getcwd()
+        orig_system: Callable[[str],int] = os.system
+        try:
+            product: str = f"{tmp_dir}/product"
+            os.makedirs(f"{product}/backups")
+            os.mkdir(f"{product}/releases")
+            limit: int = max(1, scenario.files // 2)
+            with open(f"{product}/.phase", "w") as fp:
+                fp.write(
+                    # zero-padded versions match a plain %V too
+                    "pattern = 'thingy_v%V.ods'\n"
+                    f"limit = {limit}\n"
+                    "[backup.sample]\n"
+                    "frequency = 5\n"
+                    "destination = './backups'\n"
+                    f"limit = {max(1, scenario.files // 10)}\n"
+                    "[backup.release]\n"
+                    "format = '_%Y%m%d-%H%M%S'\n"
+                    "destination = './releases'\n"
+                )
+            scenario.seed(product)
+            os.chdir(product)
+            config: dict[str,Any] = phase.load_config(".", use_cache=False)
+            regex: Pattern = config["regex"]
+            sample: dict[str,Any] = config["backup"]["sample"]
+            timings: dict[str,float] = {}
+            timings["load_config"], _ = best_time_result(
+                lambda: phase.load_config(".", use_cache=False), SUITE_REPEATS
+            )
+            timings["get_versions"], versions = best_time_result(
+                lambda: phase.get_versions(regex), SUITE_REPEATS
+            )
+            timings["get_versions(newest=1)"], _ = best_time_result(
+                lambda: phase.get_versions(regex, 1), SUITE_REPEATS
+            )
+            timings.update(product_timings(versions))
+            index = phase.VersionIndex(phase.INDEX_FILE)
+            # the index doesn't trust a directory changed in the last
+            # couple of seconds, which this one just was
+            past: int = time.time_ns() - 10 * phase.RACY_NS
+            os.utime(".", ns=(past, past))
+            index.get_versions(regex)
+            timings["index.get_versions"], _ = best_time_result(
+                lambda: index.get_versions(regex), SUITE_REPEATS
+            )
+            timings["clean --dry-run"], _ = best_time_result(
+                lambda: phase.clean(versions, limit, dry_run=True),
+                SUITE_REPEATS
+            )
+            timings["backup_sample"], _ = best_time_result(
+                lambda: phase.backup_sample(
+                    versions, regex, sample,
+                    manifest=phase.BackupManifest(sample["destination"])
+                ),
+                1
+            )
+            timings["backup_sample (up to date)"], _ = best_time_result(
+                lambda: phase.backup_sample(
+                    versions, regex, sample,
+                    manifest=phase.BackupManifest(sample["destination"])
+                ),
+                SUITE_REPEATS
+            )
+            timings["date"], _ = best_time_result(
+                lambda: phase.date(
+                    versions[0][0], "_%Y%m%d-%H%M%S-%f", dst="releases"
+                ),
+                SUITE_REPEATS
+            )
+            timings["clean"], _ = best_time_result(
+                lambda: phase.clean(versions, limit), 1
+            )
+            sys.argv = ["phase", product]
+            # time phase's own work, not starting a viewer
+            os.system = lambda cmd: 0
+            timings["main"], _ = best_time_result(phase.main, SUITE_REPEATS)
+        finally:
+            os.system = orig_system
+            os.chdir(orig_dir)
+            shutil.rmtree(tmp_dir)
+        print(f"{scenario.name}:")
+        for name, seconds in timings.items():
+            if name.endswith("memory"):
+                print(f"    {name:<28} {seconds:>10.2f}MB")
+            else:
+                print(f"    {name:<28} {seconds*1000:>10.2f}ms")
+            results[f"{scenario.name}/{name}"] = seconds
+    return results
+
+"""
+Prints how each result compares with the baseline.
+    @return: Whether any operation got slower than the tolerance allows.
+"""
+def compare_results(
+        results: dict[str,float],
+        baseline: dict[str,float],
+        tolerance: float
+) -> bool:
+    regressed: bool = False
+    print("compared with the baseline:")
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio: float = seconds / baseline[name] if baseline[name] else 1.0
+        slow: bool = (
+            ratio > tolerance and seconds - baseline[name] > MIN_REGRESSION
+        )
+        regressed = regressed or slow
+        print(
+            f"    {name:<40} {ratio:>6.2f}x"
+            + ("  \x1b[1;31mREGRESSION\x1b[0m" if slow else "")
+        )
+    if regressed:
+        print(
+            f"\x1b[1;31msome operations are over {tolerance}x slower than "
+            "the baseline\x1b[0m",
+            file=sys.stderr
+        )
+    return regressed
+
+
+if __name__ == "__main__": main()
@@ -1,28 +1,197 @@
 #!/bin/env python3
 
+from __future__ import annotations
+
+# Only what nearly every command needs is imported up here. Everything else
+# is imported by the functions that use it, so that quick commands like
+# phase --only-open don't pay to import modules they never use (see
+# bench.py --startup). Annotations aren't evaluated (see the __future__
+# import above), so the typing names are only imported for type checkers.
+import array
+import bisect
 import enum
+import errno
+import fcntl
+import heapq
+import json
+import marshal
+import operator
 import os
 import re
-import shutil
+import stat
 import sys
-import textwrap
-import tomllib
-from datetime import datetime
-from typing import (
-    Pattern,
-    Match,
-    List,
-    Tuple,
-    Any,
-    TextIO
-)
+import time
 
+TYPE_CHECKING: bool = False
+if TYPE_CHECKING:
+    import threading
+    from concurrent.futures import Future
+    from datetime import datetime
+    from typing import (
+        Pattern,
+        Match,
+        List,
+        Tuple,
+        Any,
+        Callable,
+        Iterator,
+        Iterable,
+        TextIO
+    )
 
 type Version = int
-type Product = List[Tuple[str,Version]]
+# A file or directory to be deleted, with how many files & bytes it holds
+type Removal = Tuple[str,int,int]
 
 DESKTOP_FILES_LOC: str = \
     f"{os.getenv("HOME")}/.local/share/applications/phase"
+# The registry of products (see Registry), in the user's state directory
+REGISTRY_FILE: str = "products.db"
+# The sidecar file, next to .phase, that caches directory listings
+INDEX_FILE: str = ".phase-index"
+# The file in a backup destination recording what has been backed up there
+MANIFEST_FILE: str = ".phase-manifest"
+# The size of the pieces big files are sent to a remote destination in
+REMOTE_CHUNK_SIZE: int = 8 * 1024 * 1024
+# How many times a failed request to a remote destination is retried, and
+# how long to wait before the first retry; the wait doubles each time
+REMOTE_RETRIES: int = 4
+REMOTE_RETRY_DELAY: float = 0.5
+# How long to wait for a remote destination to answer, in seconds
+REMOTE_TIMEOUT: float = 60.0
+# The file in a backup --all destination recording what has been synced there
+SYNC_MANIFEST_FILE: str = ".phase-sync"
+# The file in a backup destination listing the checksums of the backups there
+CHECKSUM_FILE: str = ".phase-sha256"
+# Files at least this big are hashed through mmap (see hash_file)
+MMAP_MIN_SIZE: int = 1024 * 1024
+# The directory in a backup destination holding the contents of backups,
+# when they are kept in a content-addressed store
+STORE_DIR: str = ".phase-store"
+# The ioctl request which makes a file share another's data (a "reflink")
+# on btrfs, XFS and other copy-on-write filesystems; _IOW(0x94, 9, int)
+FICLONE: int = 0x40049409
+# The chunk size used when copying through userspace
+COPY_BUFSIZE: int = 1024 * 1024
+# How many files are copied at once, unless performance.copy_workers is set
+DEFAULT_COPY_WORKERS: int = 4
+# How many directories are emptied at once when deleting directory products.
+# Deleting is bound by filesystem metadata updates rather than bandwidth, so
+# more can usefully run at once than copies
+DEFAULT_DELETE_WORKERS: int = 8
+# What a run of literal text in a regex made by pat_to_regex looks like:
+# characters with no special meaning, or escaped punctuation
+MATCHER_LITERAL: str = r"(?:[^\\.^$*+?{}\[\]|()]|\\[^0-9A-Za-z])*"
+MATCHER_ESCAPE: Pattern = re.compile(r"\\(.)")
+# What the regex of a pattern with a single %V looks like, & of each pattern
+# in a regex made from several
+MATCHER_VERSION: str = rf"({MATCHER_LITERAL})\(\\d\+\)({MATCHER_LITERAL})"
+MATCHER_ALTERNATIVE: str = rf"\(\?:{MATCHER_VERSION}\)"
+# The values the compression option of a backup destination can take, with
+# the module whose open function (de)compresses a file, the extension added
+# to compressed backups, and the tarfile mode used for directory products.
+# "zlib" is written in the gzip format, so the backups can be opened by
+# other tools.
+COMPRESSIONS: dict[str,Tuple[str,str,str]] = {
+    "zlib": ("gzip", ".gz", "gz"),
+    "bz2": ("bz2", ".bz2", "bz2"),
+    "lzma": ("lzma", ".xz", "xz"),
+}
+# The extension of a backup stored as a binary delta against another backup
+DELTA_EXTENSION: str = ".phdelta"
+# The first bytes of every delta file
+DELTA_MAGIC: bytes = b"PHDELTA1"
+# The size of the blocks of the base file that deltas refer to
+DELTA_BLOCK_SIZE: int = 4096
+# How long after a directory is modified before its mtime can be trusted to
+# change again on the next modification. 2s covers the coarsest common
+# filesystem timestamps (FAT)
+RACY_NS: int = 2_000_000_000
+# The sidecar next to .phase holding its parsed, checked configuration, so
+# that it does not have to be parsed again until it changes
+CONFIG_CACHE_FILE: str = ".phase-cache"
+# Changed whenever what is kept in CONFIG_CACHE_FILE changes
+CONFIG_CACHE_VERSION: int = 2
+# Marks an option in CONFIG_SCHEMA that has no default
+REQUIRED: object = object()
+# What type each option in .phase must be, and its default, or REQUIRED. The
+# backup.release, backup.all & desktop sections can be left out altogether,
+# since only some commands use them (phase desktop writes its own); the
+# options in them are required if not.
+CONFIG_SCHEMA: dict[str,Any] = {
+    # one of these is required; see check_config
+    "pattern": (str, None),
+    "patterns": (list, None),
+    "limit": (int, REQUIRED),
+    "backup": {
+        "sample": {
+            "frequency": (int, REQUIRED),
+            "destination": (str, REQUIRED),
+            "limit": (int, REQUIRED),
+            "hash": (bool, False),
+            "store": (bool, False),
+            "compression": (str, None),
+            "delta": (int, None),
+            "checksum": (bool, False),
+            "link": (bool, False),
+        },
+        "release": {
+            "format": (str, REQUIRED),
+            "destination": (str, REQUIRED),
+            "store": (bool, False),
+            "compression": (str, None),
+            "checksum": (bool, False),
+            "link": (bool, False),
+            "hash": (bool, False),
+        },
+        "all": {
+            # one of these is required; see check_config
+            "cmd": (str, None),
+            "destination": (str, None),
+            "mirror": (bool, False),
+        },
+    },
+    "performance": {
+        "copy_workers": (int, DEFAULT_COPY_WORKERS),
+        "background": (bool, False),
+    },
+    "desktop": {
+        "location": (str, REQUIRED),
+        "name": (str, REQUIRED),
+        "description": (str, REQUIRED),
+        "only_open": (bool, REQUIRED),
+    },
+}
+OPTIONAL_SECTIONS: List[str] = ["backup.release", "backup.all", "desktop"]
+# How the types in CONFIG_SCHEMA are described in error messages
+TYPE_NAMES: dict[type,str] = {
+    str: "a string",
+    int: "a whole number",
+    bool: "true or false",
+    list: "a list",
+}
+# The file locked while a product's sample backups & clean are run, which
+# records the last run to finish (see ProductLock), and the log that runs
+# in the background write to
+MAINTENANCE_LOCK_FILE: str = ".phase-maintenance.lock"
+MAINTENANCE_LOG_FILE: str = ".phase-log"
+# The size the log can grow to before it is started again
+MAINTENANCE_LOG_MAX_SIZE: int = 256 * 1024
+# The file a running phase watch keeps locked in each product it watches
+WATCH_LOCK_FILE: str = ".phase-watch"
+# How long phase watch waits after a product file last changed before
+# backing it up, so that a file being saved is not copied half-written
+WATCH_DEBOUNCE: float = 2.0
+# How often phase watch rescans each product when inotify is unavailable
+WATCH_POLL_INTERVAL: float = 5.0
+# inotify event bits, from <sys/inotify.h>
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_Q_OVERFLOW: int = 0x00004000
+IN_ISDIR: int = 0x40000000
+IN_NONBLOCK: int = 0o4000
+IN_CLOEXEC: int = 0o2000000
 
 # Represents main action for phase to take; default is to open the latest
 # version & do clean-up
@@ -34,6 +203,13 @@ class Action(enum.Enum):
     RELEASE = "release"
     DESKTOP = "desktop"
     INIT = "init"
+    RESTORE = "restore"
+    CLEAN = "clean"
+    BATCH = "batch"
+    CONFIG = "config"
+    WATCH = "watch"
+    VERIFY = "verify"
+    LIST = "list"
 
 @enum.unique
 class BackupAction(enum.Enum):
@@ -49,16 +225,158 @@ class Flags():
         self.help: bool = False
         self.version: bool = False
         self.only_open: bool = False
+        self.background: bool = False
+        self.dry_run: bool = False
         self.product_path: str = os.getcwd()
         self.stamp_format: str = ""
         self.output_dir: str = os.getcwd()
         self.backup_action: BackupAction
         self.desktop_remove: bool
+        self.restore_version: Version | None
+        self.batch_action: Action
+        self.batch_registered: bool = False
+        self.jobs: int = os.cpu_count() or 1
+        self.watch_paths: List[str]
+        self.config_check: bool
+        self.timings: bool = False
+        self.trace_file: str | None = None
+
+
+"""
+Records how long each stage of a run takes, along with what it did (files
+scanned, files & bytes copied, entries deleted, etc.) and the peak memory
+use of the process by the end of it. Stages are the functions marked with
+traced, plus a few parts of main, and can be nested, in which case the
+outer stage's counts include the inner ones'. Nothing is recorded unless
+the tracer is enabled (by --timings or --trace), so a normal run pays only
+for checking that it isn't.
+"""
+class Tracer():
+    def __init__(self):
+        self.enabled: bool = False
+        # added to every record, e.g. the command & product
+        self.context: dict[str,Any] = dict()
+        self.records: List[dict[str,Any]] = []
+        self.stack: List[TraceStage] = []
+        self.start: float = time.perf_counter()
+
+    def enable(self, **context: Any):
+        self.enabled = True
+        self.context = context
+        self.records = []
+        self.stack = []
+        self.start = time.perf_counter()
+
+    def stage(self, name: str) -> TraceStage | NullStage:
+        return TraceStage(self,name) if self.enabled else NULL_STAGE
+
+    """
+    Adds to one of the counts of the innermost stage being run, if there is
+    one.
+    """
+    def count(self, name: str, amount: int=1):
+        if self.stack and amount:
+            counts: dict[str,int] = self.stack[-1].counts
+            counts[name] = counts.get(name,0) + amount
+
+    """
+    Ends any stages still being run (as happens when phase exits part way
+    through one), prints a table of the records on stderr if asked to, and
+    appends them to a file as JSON lines if given one.
+        @param show: Whether to print the table.
+        @param trace_file: The path of the file to write to, or None.
+    """
+    def report(self, show: bool, trace_file: str | None):
+        while self.stack:
+            self.stack[-1].__exit__(None,None,None)
+        records: List[dict[str,Any]] = \
+            sorted(self.records,key=operator.itemgetter("start"))
+        if trace_file is not None:
+            with open(trace_file,"a",encoding="utf8") as fp:
+                for record in records:
+                    fp.write(json.dumps(self.context | record) + "\n")
+        if not show:
+            return
+        print("\x1b[1mTimings:\x1b[0m",file=sys.stderr)
+        for record in records:
+            print(
+                f"  {'  ' * record['depth'] + record['stage']:<36}"
+                + f"{record['seconds'] * 1000:>10.1f}ms"
+                + f"{format_size(record['peak_rss'] * 1024):>10}  "
+                + ", ".join(
+                    f"{name.replace('_',' ')} {value}"
+                    for name,value in record["counts"].items()
+                ),
+                file=sys.stderr
+            )
+
+"""
+A stage being timed by a Tracer. Used as a context manager.
+"""
+class TraceStage():
+    def __init__(self, tracer: Tracer, name: str):
+        self.tracer: Tracer = tracer
+        self.name: str = name
+        self.counts: dict[str,int] = dict()
+        self.start: float = 0
+
+    def __enter__(self) -> TraceStage:
+        self.tracer.stack.append(self)
+        self.start = time.perf_counter()
+        return self
 
+    def __exit__(self, *exc_info: Any):
+        import resource
+        end: float = time.perf_counter()
+        stack: List[TraceStage] = self.tracer.stack
+        del stack[stack.index(self):]
+        if stack:
+            for name, value in self.counts.items():
+                stack[-1].counts[name] = stack[-1].counts.get(name,0) + value
+        self.tracer.records.append({
+            "stage": self.name,
+            "depth": len(stack),
+            "start": round(self.start - self.tracer.start,6),
+            "seconds": round(end - self.start,6),
+            "counts": self.counts,
+            # in KB on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
 
+"""
+What Tracer.stage gives when the tracer isn't enabled.
+"""
+class NullStage():
+    def __enter__(self) -> NullStage:
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        pass
+
+NULL_STAGE: NullStage = NullStage()
+TRACER: Tracer = Tracer()
 
-def check_is_product_dir(config: dict[str,Any],versions: Product):
+"""
+Makes a function a stage of TRACER, named after the function.
+"""
+def traced(function: Callable) -> Callable:
+    import functools
+    name: str = function.__qualname__
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if not TRACER.enabled:
+            return function(*args,**kwargs)
+        with TraceStage(TRACER,name):
+            return function(*args,**kwargs)
+    return wrapper
+
+def check_is_product_dir(
+        config: dict[str,Any],
+        versions: Product,
+        need_versions: bool=True
+):
     if not config:
+        import textwrap
         print(
             textwrap.dedent("""\
             \x1b[1;31mPhase Error: No .phase file found.
@@ -73,7 +391,8 @@ def check_is_product_dir(config: dict[str,Any],versions: Product):
             file=sys.stderr
         )
         sys.exit(1)
-    if not versions:
+    if need_versions and not versions:
+        import textwrap
         print(
             textwrap.dedent("""\
                 \x1b[1;31mPhase Error: No product files found.
@@ -86,108 +405,441 @@ def check_is_product_dir(config: dict[str,Any],versions: Product):
 
 def main():
     flags = flagparse(sys.argv)
+    invocation_dir: str = os.getcwd()
     flags.product_path = os.path.abspath(flags.product_path)
-    if flags.action != Action.DATE:
+    if flags.timings or flags.trace_file is not None:
+        import atexit
+        TRACER.enable(
+            command=flags.action.value,
+            product=flags.product_path,
+            pid=os.getpid(),
+            time=time.time()
+        )
+        # reported however phase exits, including part way through
+        atexit.register(TRACER.report,flags.timings,flags.trace_file)
+        TRACER.stage("main").__enter__()
+    if flags.action not in [
+        Action.DATE,Action.BATCH,Action.WATCH,Action.LIST
+    ]:
         os.chdir(flags.product_path)
     if flags.version:
         print("Phase, v0.8.3 - The Best Worst Form Of Version Control")
         sys.exit(0)
     if flags.help:
-        print(textwrap.dedent("""\
-            Phase, v0.8.3 - The Best Worst Form Of Version Control
-            
-            Usage:
-            \x1b[1mphase [PRODUCT_PATH]\x1b[0m
-                Opens the latest version of the product at PRODUCT_PATH/the current working directory.
-                Also deletes older versions and makes some backups
-            \x1b[1mphase [-o|--only-open] [PRODUCT_PATH]\x1b[0m
-                Same as above, but skips the backup and clean steps
-            \x1b[1mphase init [PRODUCT_PATH]\x1b[0m
-                Tell phase to manage files in PRODUCT_PATH/the current working directory
-            \x1b[1mphase backup [--sample | --all | --release] [PRODUCT_PATH]\x1b[0m
-                Make backup copies of some versions of the product.
-                \x1b[1m--sample\x1b[0m Copies every Nth version, where N is 
-                    a number you can configure (default 5)
-                \x1b[1m--release\x1b[0m Copies the latest version, and 
-                    appends a date-time stamp to the copy
-                \x1b[1m--all\x1b[0m Runs a shell command, which you configure.
-                    This command \x1b[3mshould\x1b[0m backup the whole directory,
-                    but really it could do anything
-            \x1b[1mphase release [PRODUCT_PATH]\x1b[0m
-                Alias for phase backup --release
-            \x1b[1mphase date [[-f|--format] STAMP_FORMAT] [[-d|--output-directory] DIRECTORY] FILE\x1b[0m
-                Appends a date-time stamp to the name of FILE in format STAMP_FORMAT and puts the result
-                in DIRECTORY.
-                    STAMP_FORMAT defaults to yyyymmdd-HHMMSS
-                    DIRECTORY defaults to the current directory
-                This is the only command which does not require a phase-managed set of files (a "product")
-            \x1b[1mphase desktop [--add|--remove] [PRODUCT_PATH]\x1b[0m
-                Create or remove a desktop entry file for the product at PRODUCT_PATH/the current
-                working directory.
-                This option is only useful on Linux systems
-        """))
+        print_help()
         sys.exit(0)
     # load product configration
     config: dict[str,Any] = dict()
-    versions: Product = []
-    if os.path.exists("./.phase"):
-        with open("./.phase","rb") as fp:
-            config = tomllib.load(fp)
-        config["regex"] = pat_to_regex(config["pattern"])
-        versions = get_versions(config["regex"])
+    versions = Product()
+    index: VersionIndex | None = None
+    lock: ProductLock | None = None
+    # progress is only worth showing to someone watching a terminal
+    executor = CopyExecutor(show_progress=sys.stderr.isatty())
+    if flags.action not in [
+        Action.DATE,Action.BATCH,Action.WATCH,Action.CONFIG,Action.LIST
+    ] and os.path.exists("./.phase"):
+        try:
+            config = load_config(".")
+        except ValueError as err:
+            print_config_error(err)
+            sys.exit(1)
+        flags.background = \
+            flags.background or config["performance"]["background"]
+        # only one phase at a time backs up or cleans a product; opening it
+        # doesn't wait for another to finish, and neither does opening it
+        # when a phase watch or a background run does the backing up
+        stages: List[str] = maintenance_stages(
+            flags.action,getattr(flags,"backup_action",None),flags.dry_run
+        )
+        if flags.action == Action.DEFAULT and (
+            flags.only_open or flags.background or is_watched(".")
+        ):
+            stages = []
+        if stages:
+            lock = ProductLock(
+                ".",
+                stages,
+                wait=flags.action != Action.DEFAULT,
+                verbose=sys.stderr.isatty()
+            )
+            lock.acquire()
+        # only the latest version is needed unless older versions are going
+        # to be backed up or cleaned
+        newest: int | None = None
+        if flags.only_open or flags.background or (
+            flags.action in [Action.DESKTOP,Action.RESTORE,Action.VERIFY]
+        ) or (
+            flags.action == Action.BACKUP
+            and getattr(flags,"backup_action",None) != BackupAction.SAMPLE
+        ):
+            newest = 1
+        index = VersionIndex(INDEX_FILE)
+        versions = index.get_versions(config["regex"],newest)
+        executor.workers = config["performance"]["copy_workers"]
     match flags.action:
         case Action.DATE:
             new_name: str = date(
                 flags.product_path,
                 # a nice default format is provided
                 flags.stamp_format or "_%Y%m%d-%H%M%S",
-                dst=flags.output_dir
+                dst=flags.output_dir,
+                executor=executor
             )
             print(f"copy {flags.product_path} -> {new_name}")
         case Action.BACKUP:
             check_is_product_dir(config,versions)
             match flags.backup_action:
                 case BackupAction.ALL:
-                    cmd: str = config["backup"]["all"]["cmd"]
-                    print(f"Running {cmd}")
-                    os.system(cmd)
-                    print("Done!")
+                    all_config: dict[str,Any] = config["backup"]["all"]
+                    if all_config.get("destination") is not None:
+                        sync_stats, sync_removals = sync_tree(
+                            ".",
+                            all_config["destination"],
+                            all_config.get("mirror",False),
+                            executor
+                        )
+                        summary: str = \
+                            f"Synced to {all_config['destination']}: " \
+                            + str(sync_stats)
+                        if sync_removals:
+                            summary += \
+                                f", deleted {format_removals(sync_removals)}"
+                        print(summary)
+                    else:
+                        cmd: str = all_config["cmd"]
+                        print(f"Running {cmd}")
+                        os.system(cmd)
+                        print("Done!")
+                case BackupAction.SAMPLE if lock is not None \
+                        and lock.result == LockResult.DONE:
+                    print("Sample backups: skipped, just made by another phase")
                 case BackupAction.SAMPLE:
-                    backup_sample(
+                    stats: CopyStats = backup_sample(
                         versions,
                         config["regex"],
-                        config["backup"]["sample"]
+                        config["backup"]["sample"],
+                        index,
+                        BackupManifest(config["backup"]["sample"]["destination"]),
+                        executor
                     )
+                    registry_backed_up(flags.product_path,versions,stats)
+                    print(f"Sample backups: {stats}")
                 case BackupAction.RELEASE:
-                    date(
-                        versions[0][0],
-                        flags.stamp_format or \
-                            config["backup"]["release"]["format"],
-                        dst=config["backup"]["release"]["destination"]
-                    )
+                    release_config: dict[str,Any] = config["backup"]["release"]
+                    # every file of the latest version
+                    for version in versions.newest(1):
+                        date(
+                            version[0],
+                            flags.stamp_format or release_config["format"],
+                            dst=release_config["destination"],
+                            store=release_config.get("store",False),
+                            executor=executor,
+                            compression=release_config.get("compression"),
+                            checksum=release_config.get("checksum",False),
+                            link_regex=release_regex(config["patterns"])
+                                if release_config.get("link",False) else None,
+                            use_hash=release_config.get("hash",False)
+                        )
         case Action.DESKTOP:
             check_is_product_dir(config,versions)
             if flags.desktop_remove:
                 remove_desktop_file(flags.product_path,config)
+                update_registry(flags.product_path,None)
             else:
                 add_desktop_file(flags.product_path,config)
+                update_registry(flags.product_path,config)
         case Action.INIT:
             initialise(flags.product_path)
+            update_registry(flags.product_path,load_config("."))
+        case Action.RESTORE:
+            check_is_product_dir(config,versions,need_versions=False)
+            destination: str = config["backup"]["sample"]["destination"]
+            backend: LocalBackend | WebDAVBackend | None = None
+            backups: Product
+            if is_remote(destination):
+                backend = open_backend(destination)
+                backups = listed_backups(backend.list(),config["regex"])
+            else:
+                backups = get_versions(
+                    backup_regex(config["regex"]),path=destination
+                )
+            if flags.restore_version is not None:
+                backups = backups.find(flags.restore_version)
+            if not backups:
+                print(
+                    "\x1b[1;31mPhase Error: No backup found.\x1b[0m "
+                    + "There is no backup"
+                    + (f" of version {flags.restore_version}"
+                        if flags.restore_version is not None else "")
+                    + f" in {backend.url if backend else destination}",
+                    file=sys.stderr
+                )
+                sys.exit(1)
+            # restore to the product directory, unless told otherwise
+            restore_dir: str = flags.product_path
+            if flags.output_dir != invocation_dir:
+                restore_dir = flags.output_dir
+            # every file of the version
+            for backup in backups.newest(1):
+                try:
+                    restored: str
+                    if backend is not None:
+                        restored = restore_remote(
+                            backend,
+                            backup[0],
+                            os.path.join(invocation_dir,restore_dir),
+                            config["regex"]
+                        )
+                    else:
+                        restored = restore(
+                            f"{destination}/{backup[0]}",
+                            os.path.join(invocation_dir,restore_dir),
+                            config["regex"]
+                        )
+                except FileExistsError as err:
+                    print(
+                        f"\x1b[1;31mPhase Error: {err.filename} already "
+                        + "exists.\x1b[0m Move or delete it first.",
+                        file=sys.stderr
+                    )
+                    sys.exit(1)
+                print(
+                    f"restore {backend.url if backend else destination}/"
+                    + f"{backup[0]} -> {restored}"
+                )
+        case Action.CLEAN if lock is not None \
+                and lock.result == LockResult.DONE:
+            print("Skipped, just cleaned by another phase")
+        case Action.CLEAN:
+            check_is_product_dir(config,versions,need_versions=False)
+            destination = config["backup"]["sample"]["destination"]
+            removals: List[Removal] = clean(
+                versions,config["limit"],index,dry_run=flags.dry_run
+            ) + clean_backups(
+                config["regex"],
+                config["backup"]["sample"],
+                index,
+                None if flags.dry_run else BackupManifest(destination),
+                dry_run=flags.dry_run
+            )
+            verb: str = "would delete" if flags.dry_run else "delete"
+            for removal in removals:
+                print(
+                    f"{verb} {os.path.normpath(removal[0])} "
+                    + f"({format_removals([removal])})"
+                )
+            print(f"{'Would delete' if flags.dry_run else 'Deleted'} "
+                + format_removals(removals))
+        case Action.CONFIG:
+            if not os.path.exists(".phase"):
+                check_is_product_dir(config,versions)
+            import tomllib
+            errors: List[str]
+            warnings: List[str] = []
+            try:
+                with open(".phase","rb") as fp:
+                    config, errors, warnings = check_config(tomllib.load(fp))
+            except tomllib.TOMLDecodeError as err:
+                errors = [str(err)]
+            for warning in warnings:
+                print(f"\x1b[1;33mWarning:\x1b[0m {warning}",file=sys.stderr)
+            if errors:
+                print_config_error(ValueError("\n".join(errors)))
+                sys.exit(1)
+            if flags.config_check:
+                # and cache it, so the next run doesn't have to
+                load_config(".")
+                print(f"{flags.product_path}/.phase is valid")
+            else:
+                config["regex"] = \
+                    patterns_to_regex(config["patterns"]).pattern
+                print(json.dumps(config,indent=4))
+        case Action.VERIFY:
+            check_is_product_dir(config,versions,need_versions=False)
+            destinations: List[str] = [
+                config["backup"][section]["destination"]
+                for section in ["sample","release"]
+                if section in config["backup"]
+            ]
+            results: dict[str,str] = dict()
+            for destination in destinations:
+                if not os.path.exists(f"{destination}/{CHECKSUM_FILE}"):
+                    continue
+                for name, result in \
+                        verify_checksums(destination,flags.jobs).items():
+                    results[os.path.normpath(f"{destination}/{name}")] = \
+                        result
+            if not results:
+                print(
+                    "No checksums to verify. Set checksum = true in "
+                    + "[backup.sample] or [backup.release] to keep them."
+                )
+            problems: List[str] = \
+                [name for name,result in results.items() if result != "ok"]
+            for name in sorted(problems):
+                print(f"\x1b[1;31m{results[name]}\x1b[0m {name}")
+            if results:
+                print(
+                    f"Verified {len(results)} files: "
+                    + f"{len(results) - len(problems)} ok, "
+                    + f"{len(problems)} bad"
+                )
+            if problems:
+                sys.exit(1)
+        case Action.WATCH:
+            watcher = ProductWatcher()
+            for path in flags.watch_paths:
+                path = os.path.abspath(path)
+                try:
+                    watcher.add_product(path)
+                except FileNotFoundError:
+                    check_is_product_dir({},[])
+                except BlockingIOError:
+                    print(
+                        f"\x1b[1;31mPhase Error: {path} is already being "
+                        + "watched.\x1b[0m",
+                        file=sys.stderr
+                    )
+                    sys.exit(1)
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            watcher.close()
+        case Action.BATCH:
+            products: List[str] | None = None
+            if flags.batch_registered:
+                with Registry() as registry:
+                    # leaving out any that have since been deleted
+                    products = [
+                        product["path"] for product in registry.products()
+                        if os.path.exists(f"{product['path']}/.phase")
+                    ]
+            if run_batch(
+                flags.product_path,
+                flags.batch_action,
+                getattr(flags,"backup_action",None),
+                flags.jobs,
+                flags.dry_run,
+                products
+            ):
+                sys.exit(1)
+        case Action.LIST:
+            list_products()
         case _:
             check_is_product_dir(config,versions)
-            if not flags.only_open:
+            # a running phase watch has already done the backing up, and
+            # another phase holding the lock is doing it
+            maintain: bool = not flags.only_open and not is_watched(".")
+            if lock is not None and lock.result == LockResult.ACQUIRED:
                 # make backups
-                backup_sample(
+                registry_backed_up(
+                    flags.product_path,
                     versions,
-                    config["regex"],
-                    config["backup"]["sample"],
+                    backup_sample(
+                        versions,
+                        config["regex"],
+                        config["backup"]["sample"],
+                        index,
+                        BackupManifest(
+                            config["backup"]["sample"]["destination"]
+                        ),
+                        CopyExecutor(executor.workers)
+                    )
                 )
                 # clean up old versions, both in the main directory and also 
                 # in the backup
-                clean(versions,config["limit"])
-                # open the latest version of the product
-            os.system(f"xdg-open {versions[0][0]} &")
+                clean(versions,config["limit"],index)
+            # open the latest version of the product
+            with TRACER.stage("open"):
+                os.system(f"xdg-open {latest_file(versions,config)} &")
+            if maintain and flags.background:
+                # the worker reads the index, so it is saved first
+                index.save()
+                maintain_in_background(flags.product_path)
+    if index is not None:
+        index.save()
+    if lock is not None:
+        lock.release(completed=True)
+
+
+"""
+Prints the usage of every command. The text is only built when it is asked
+for.
+"""
+def print_help():
+    import textwrap
+    print(textwrap.dedent("""\
+        Phase, v0.8.3 - The Best Worst Form Of Version Control
+        
+        Usage:
+        \x1b[1mphase [PRODUCT_PATH]\x1b[0m
+            Opens the latest version of the product at PRODUCT_PATH/the current working directory.
+            Also deletes older versions and makes some backups
+        \x1b[1mphase [-o|--only-open] [PRODUCT_PATH]\x1b[0m
+            Same as above, but skips the backup and clean steps
+        \x1b[1mphase [-b|--background] [PRODUCT_PATH]\x1b[0m
+            Same as above, but opens the product first and then does the backup and clean steps
+            in the background, logging what was done to .phase-log
+        \x1b[1mphase init [PRODUCT_PATH]\x1b[0m
+            Tell phase to manage files in PRODUCT_PATH/the current working directory
+        \x1b[1mphase backup [--sample | --all | --release] [PRODUCT_PATH]\x1b[0m
+            Make backup copies of some versions of the product.
+            \x1b[1m--sample\x1b[0m Copies every Nth version, where N is 
+                a number you can configure (default 5)
+            \x1b[1m--release\x1b[0m Copies the latest version, and 
+                appends a date-time stamp to the copy
+            \x1b[1m--all\x1b[0m Runs a shell command, which you configure.
+                This command \x1b[3mshould\x1b[0m backup the whole directory,
+                but really it could do anything
+                Or, with a destination configured, copies whatever in the
+                whole directory has changed since the last time to there
+        \x1b[1mphase release [PRODUCT_PATH]\x1b[0m
+            Alias for phase backup --release
+        \x1b[1mphase date [[-f|--format] STAMP_FORMAT] [[-d|--output-directory] DIRECTORY] FILE\x1b[0m
+            Appends a date-time stamp to the name of FILE in format STAMP_FORMAT and puts the result
+            in DIRECTORY.
+                STAMP_FORMAT defaults to yyyymmdd-HHMMSS
+                DIRECTORY defaults to the current directory
+            This is the only command which does not require a phase-managed set of files (a "product")
+        \x1b[1mphase restore [VERSION] [-d|--output-directory DIRECTORY] [PRODUCT_PATH]\x1b[0m
+            Restores a sample backup (decompressing or rebuilding it if need be) to DIRECTORY.
+                VERSION defaults to the latest version backed up
+                DIRECTORY defaults to the product directory
+        \x1b[1mphase clean [-n|--dry-run] [PRODUCT_PATH]\x1b[0m
+            Deletes older versions of the product and older sample backups, without making any
+            new backups.
+            \x1b[1m--dry-run\x1b[0m Lists what would be deleted, and how big it is, instead
+        \x1b[1mphase verify [-j|--jobs N] [PRODUCT_PATH]\x1b[0m
+            Checks the sample & release backups against the checksums kept for them, N files at
+            a time, and lists any that are missing or have changed.
+                N defaults to the number of CPUs
+        \x1b[1mphase batch [backup [--sample | --all | --release] | release | clean [-n|--dry-run]] [-j|--jobs N] [--registered | ROOT]\x1b[0m
+            Runs a command on every product under ROOT/the current working directory, N products
+            at a time, and prints a summary for each.
+                With no command, makes sample backups & cleans, as phase does before opening
+                N defaults to the number of CPUs
+            \x1b[1m--registered\x1b[0m Runs it on every registered product instead (see phase list)
+        \x1b[1mphase list\x1b[0m
+            Lists the products registered by phase init & phase desktop, with their latest
+            versions and when they were last backed up
+        \x1b[1mphase config [--check] [PRODUCT_PATH]\x1b[0m
+            Prints the product's configuration, with defaults filled in.
+            \x1b[1m--check\x1b[0m Just checks the configuration, and says what is wrong with it
+        \x1b[1mphase watch [PRODUCT_PATH...]\x1b[0m
+            Watches the products at PRODUCT_PATHs/the current working directory, and makes sample
+            backups & cleans as new versions are saved. While this is running, opening one of
+            these products skips the backup and clean steps
+        \x1b[1mphase desktop [--add|--remove] [PRODUCT_PATH]\x1b[0m
+            Create or remove a desktop entry file for the product at PRODUCT_PATH/the current
+            working directory.
+            This option is only useful on Linux systems
 
+        Any command can also be given:
+            \x1b[1m--timings\x1b[0m Prints how long each stage took, what it did (files scanned, copied
+                & deleted), and the peak memory use by the end of it, when phase exits
+            \x1b[1m--trace FILE\x1b[0m Appends the same to FILE, as one JSON object per line
+    """))
 
 def flagparse(argv: List[str]) -> Flags:
     flags = Flags()
@@ -199,6 +851,16 @@ def flagparse(argv: List[str]) -> Flags:
             if num_positional_args == 0:
                 try: flags.action = Action(argv[i])
                 except ValueError: flags.product_path = argv[i]
+            elif flags.action == Action.RESTORE and argv[i].isdecimal() \
+                    and not hasattr(flags,"restore_version"):
+                flags.restore_version = int(argv[i])
+            elif flags.action == Action.BATCH and num_positional_args == 1 \
+                    and argv[i] in ["backup","release","clean"]:
+                flags.batch_action = Action(argv[i])
+            elif flags.action == Action.WATCH:
+                if not hasattr(flags,"watch_paths"):
+                    flags.watch_paths = []
+                flags.watch_paths.append(argv[i])
             else:
                 flags.product_path = argv[i]
             num_positional_args += 1
@@ -208,6 +870,10 @@ def flagparse(argv: List[str]) -> Flags:
             flags.version = True
         elif argv[i] == "-o" or argv[i] == "--only-open":
             flags.only_open = True
+        elif argv[i] == "-b" or argv[i] == "--background":
+            flags.background = True
+        elif argv[i] == "-n" or argv[i] == "--dry-run":
+            flags.dry_run = True
         elif argv[i] == "-d" or argv[i] == "--output-directory":
             flags.output_dir = argv[i+1]
             i += 1
@@ -215,14 +881,27 @@ def flagparse(argv: List[str]) -> Flags:
             flags.stamp_format = argv[i+1]
             i += 2
             continue
+        elif argv[i] == "-j" or argv[i] == "--jobs":
+            flags.jobs = max(1,int(argv[i+1]))
+            i += 1
+        elif argv[i] == "--timings":
+            flags.timings = True
+        elif argv[i] == "--trace":
+            flags.trace_file = os.path.abspath(argv[i+1])
+            i += 1
         else:
             match flags.action:
-                case Action.BACKUP:
+                case Action.BACKUP | Action.BATCH:
+                    if argv[i] == "--registered":
+                        flags.batch_registered = True
                     try: flags.backup_action = BackupAction(argv[i])
                     except ValueError: pass
                 case Action.DESKTOP:
                     if argv[i] == "--remove":
                         flags.desktop_remove = True
+                case Action.CONFIG:
+                    if argv[i] == "--check":
+                        flags.config_check = True
         i += 1
     match flags.action:
         case Action.RELEASE:
@@ -231,8 +910,258 @@ def flagparse(argv: List[str]) -> Flags:
         case Action.DESKTOP:
             if not hasattr(flags,"desktop_remove"):
                 flags.desktop_remove = False
+        case Action.RESTORE:
+            if not hasattr(flags,"restore_version"):
+                flags.restore_version = None
+        case Action.BATCH:
+            if not hasattr(flags,"batch_action"):
+                flags.batch_action = Action.DEFAULT
+            if flags.batch_action == Action.RELEASE:
+                flags.batch_action = Action.BACKUP
+                flags.backup_action = BackupAction.RELEASE
+            elif flags.batch_action == Action.BACKUP \
+                    and not hasattr(flags,"backup_action"):
+                flags.backup_action = BackupAction.SAMPLE
+        case Action.WATCH:
+            if not hasattr(flags,"watch_paths"):
+                flags.watch_paths = [flags.product_path]
+        case Action.CONFIG:
+            if not hasattr(flags,"config_check"):
+                flags.config_check = False
     return flags
 
+"""
+Reads a product's configuration, checks it, and compiles its pattern. The
+result is kept in CONFIG_CACHE_FILE, and taken from there as long as .phase
+has not changed since, so that most runs do not parse any TOML or build any
+regex.
+    @param product_path: The product directory.
+    @param use_cache: Whether to use (& update) the cache.
+    @return: The contents of the product's .phase file, with defaults filled
+        in (see CONFIG_SCHEMA and check_config) and the compiled patterns
+        added as "regex" (see patterns_to_regex).
+    @raise ValueError: If .phase is not valid TOML, or not a valid
+        configuration. The message says what is wrong.
+"""
+@traced
+def load_config(product_path: str, use_cache: bool=True) -> dict[str,Any]:
+    config_path: str = os.path.join(product_path,".phase")
+    cache_path: str = os.path.join(product_path,CONFIG_CACHE_FILE)
+    config_stat: os.stat_result = os.stat(config_path)
+    key: List[int] = [
+        CONFIG_CACHE_VERSION,
+        config_stat.st_mtime_ns,
+        config_stat.st_size,
+        config_stat.st_ino
+    ]
+    config: dict[str,Any]
+    if use_cache:
+        try:
+            with open(cache_path,"rb") as fp:
+                cache: dict[str,Any] = marshal.load(fp)
+            # as with VersionIndex, a cache written too soon after .phase
+            # was could have missed a change made in the same tick
+            if cache["key"] == key \
+                    and cache["written"] - key[1] > RACY_NS:
+                config = cache["config"]
+                config["regex"] = re.compile(cache["regex"])
+                return config
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+    import tomllib
+    with open(config_path,"rb") as fp:
+        raw_config: dict[str,Any] = tomllib.load(fp)
+    errors: List[str]
+    config, errors, _ = check_config(raw_config)
+    if errors:
+        raise ValueError("\n".join(errors))
+    # a cache that would not be trusted is not worth writing
+    if use_cache and time.time_ns() - key[1] > RACY_NS:
+        try:
+            # written in place, like the index, so that the product
+            # directory's mtime (and so its listing in the index) is left
+            # alone; a reader that catches it half-written just parses
+            # .phase
+            with open(cache_path,"wb") as fp:
+                marshal.dump(
+                    {
+                        "key": key,
+                        "written": time.time_ns(),
+                        "config": config,
+                        "regex":
+                            patterns_to_regex(config["patterns"]).pattern,
+                    },
+                    fp
+                )
+        except (OSError, ValueError):
+            # e.g. a read-only directory, or TOML dates, which marshal
+            # can't write; either way, there is just no cache (an empty
+            # file is left, rather than the directory changed every run)
+            pass
+    config["regex"] = patterns_to_regex(config["patterns"])
+    return config
+
+"""
+Checks a configuration against CONFIG_SCHEMA, and some rules of its own.
+    @param raw_config: The parsed contents of a .phase file.
+    @return: A copy of the configuration with defaults filled in, a list of
+        errors, and a list of warnings (about options phase doesn't know).
+"""
+def check_config(
+        raw_config: dict[str,Any]
+) -> Tuple[dict[str,Any],List[str],List[str]]:
+    errors: List[str] = []
+    warnings: List[str] = []
+    def check_section(
+            section: dict[str,Any],
+            schema: dict[str,Any],
+            name: str
+    ) -> dict[str,Any]:
+        checked: dict[str,Any] = dict()
+        for key, value in section.items():
+            if key not in schema:
+                warnings.append(f"unknown option {name}{key}")
+                checked[key] = value
+        for key, rule in schema.items():
+            if isinstance(rule,dict):
+                if key not in section and f"{name}{key}" in OPTIONAL_SECTIONS:
+                    continue
+                value = section.get(key,{})
+                if not isinstance(value,dict):
+                    errors.append(f"{name}{key} should be a section")
+                    continue
+                checked[key] = check_section(value,rule,f"{name}{key}.")
+                continue
+            option_type, default = rule
+            if key not in section:
+                if default is REQUIRED:
+                    errors.append(f"{name}{key} is missing")
+                checked[key] = default
+                continue
+            value = section[key]
+            # TOML booleans are ints as far as isinstance is concerned
+            if not isinstance(value,option_type) or (
+                option_type is int and isinstance(value,bool)
+            ):
+                errors.append(
+                    f"{name}{key} should be {TYPE_NAMES[option_type]}"
+                )
+            checked[key] = value
+        return checked
+    config: dict[str,Any] = check_section(raw_config,CONFIG_SCHEMA,"")
+    # the checks below are only made on options of the right type, which
+    # have been complained about already otherwise
+    sample: dict[str,Any] = config.get("backup",{}).get("sample",{})
+    # a product made of several files has a pattern for each; either way,
+    # "patterns" ends up with every pattern, and "pattern" with the first,
+    # which is the file phase opens
+    patterns: List[Any] = []
+    if config["pattern"] is None and config["patterns"] is None:
+        errors.append("pattern is missing")
+    elif config["pattern"] is not None and config["patterns"] is not None:
+        errors.append("only one of pattern & patterns can be given")
+    elif config["pattern"] is not None:
+        patterns = [config["pattern"]]
+        if isinstance(config["pattern"],str):
+            config["patterns"] = patterns
+    elif isinstance(config["patterns"],list):
+        patterns = config["patterns"]
+        if not patterns or not all(
+            isinstance(pattern,str) for pattern in patterns
+        ):
+            errors.append("patterns should be a list of strings")
+            patterns = []
+        else:
+            config["pattern"] = patterns[0]
+    for i, pattern in enumerate(patterns):
+        if isinstance(pattern,str) and "%V" not in pattern.replace("%%",""):
+            errors.append(
+                "pattern has no %V in it" if "pattern" in raw_config
+                else f"patterns[{i}] has no %V in it"
+            )
+    for name, value, minimum in [
+        ("limit",config["limit"],1),
+        ("backup.sample.frequency",sample.get("frequency"),1),
+        ("backup.sample.limit",sample.get("limit"),0),
+        ("backup.sample.delta",sample.get("delta"),1),
+        ("performance.copy_workers",
+            config.get("performance",{}).get("copy_workers"),1),
+    ]:
+        if type(value) is int and value < minimum:
+            errors.append(f"{name} should be at least {minimum}")
+    for section in ["sample","release"]:
+        compression: Any = \
+            config.get("backup",{}).get(section,{}).get("compression")
+        if isinstance(compression,str) and compression not in COMPRESSIONS:
+            errors.append(
+                f"backup.{section}.compression should be one of "
+                + ", ".join(f"'{name}'" for name in COMPRESSIONS)
+            )
+    if sample.get("delta") is not None and (
+        sample.get("compression") is not None or sample.get("store")
+    ):
+        errors.append(
+            "backup.sample.delta can't be used with compression or store"
+        )
+    for section in ["sample","release"]:
+        options: dict[str,Any] = config.get("backup",{}).get(section,{})
+        if options.get("checksum") is True and (
+            options.get("store") or options.get("delta") is not None
+        ):
+            errors.append(
+                f"backup.{section}.checksum can't be used with store or delta"
+            )
+        if options.get("link") is True and (
+            options.get("store") or options.get("compression") is not None
+            or options.get("delta") is not None
+        ):
+            errors.append(
+                f"backup.{section}.link can't be used with store, compression "
+                + "or delta"
+            )
+    for section in ["sample","release","all"]:
+        destination: Any = \
+            config.get("backup",{}).get(section,{}).get("destination")
+        if not isinstance(destination,str):
+            continue
+        if "://" in destination and not is_remote(destination):
+            errors.append(
+                f"backup.{section}.destination should be a directory or a "
+                + "URL starting with "
+                + ", ".join(f"{scheme}://" for scheme in BACKENDS)
+            )
+        elif is_remote(destination):
+            options: dict[str,Any] = config["backup"][section]
+            for option in ["store","compression","delta","checksum","link"]:
+                if options.get(option) not in [None,False]:
+                    errors.append(
+                        f"backup.{section}.{option} can't be used with a "
+                        + "remote destination"
+                    )
+    all_config: dict[str,Any] | None = config.get("backup",{}).get("all")
+    if all_config is not None:
+        if all_config["cmd"] is None and all_config["destination"] is None:
+            errors.append("backup.all.cmd or backup.all.destination is missing")
+        elif all_config["cmd"] is not None \
+                and all_config["destination"] is not None:
+            errors.append(
+                "only one of backup.all.cmd & backup.all.destination can be "
+                + "given"
+            )
+    if sample.get("delta") is not None and len(patterns) > 1:
+        errors.append(
+            "backup.sample.delta can't be used with more than one pattern"
+        )
+    return config, errors, warnings
+
+def print_config_error(err: ValueError):
+    import textwrap
+    print(
+        "\x1b[1;31mPhase Error: Invalid .phase file.\x1b[0m\n"
+        + textwrap.indent(str(err),"    "),
+        file=sys.stderr
+    )
+
 """
 Converts a 'pattern' with a '%V' in it to a regular expression that matches
 any filename with a version number in place of the '%V'. Also converts any
@@ -258,93 +1187,4109 @@ def pat_to_regex(pattern: str) -> Pattern:
         new_pattern += char
     return re.compile(new_pattern)
 
+"""
+Converts the patterns of a product to one regular expression, which matches
+the name of any of its files. A single pattern is converted as by
+pat_to_regex; otherwise each pattern's regex is tried in turn, so a file's
+version is in whichever group matched (see match_version).
+    @param patterns: The product's patterns, as in config["patterns"].
+"""
+def patterns_to_regex(patterns: List[str]) -> Pattern:
+    if len(patterns) == 1:
+        return pat_to_regex(patterns[0])
+    return re.compile("|".join(
+        f"(?:{pat_to_regex(pattern).pattern})" for pattern in patterns
+    ))
+
+"""
+Gets the version from a match of a regex made by pat_to_regex or
+patterns_to_regex (or backup_regex): the first %V of whichever pattern
+matched.
+"""
+def match_version(match: Match[str]) -> Version:
+    for group in match.groups():
+        if group is not None:
+            return int(group)
+    raise ValueError(f"{match.re.pattern} has no version in it")
+
+"""
+Picks apart a regex that identifies product files, so that filenames can be
+checked without running it. Most entries in a product directory are not
+product files, and can be rejected with str.startswith/endswith on the
+literal text before & after the version. When that text is all there is to
+the regex (as with any pattern with a single %V), the version is just sliced
+out of the filename, and the regex is never run. Otherwise, names which get
+past the prefix are checked with the regex itself. A regex made from several
+patterns (see patterns_to_regex) has a prefix & suffix for each.
+"""
+class VersionMatcher():
+    """
+        @param regex: The regex, e.g. the output of pat_to_regex,
+            patterns_to_regex or backup_regex.
+    """
+    def __init__(self, regex: Pattern):
+        self.regex: Pattern = regex
+        # the text every match of each pattern starts & ends with
+        self.affixes: List[Tuple[str,str]] = [("","")]
+        # whether a name starting & ending with one of those, with only
+        # digits in between, is certain to match
+        self.exact: bool = False
+        if regex.flags & ~re.UNICODE:
+            self.prefixes: Tuple[str,...] = ("",)
+            return
+        affixes: List[Tuple[str,str]] | None = regex_affixes(regex.pattern)
+        if affixes is not None:
+            self.affixes = affixes
+            self.exact = True
+        else:
+            # a regex like backup_regex's, with more after the product
+            # pattern(s)
+            wrapped: Match[str] | None = re.match(
+                rf"\(\?:(?:{MATCHER_VERSION}|{MATCHER_ALTERNATIVE}"
+                + rf"(?:\|{MATCHER_ALTERNATIVE})*)\)",
+                regex.pattern
+            )
+            if wrapped is not None:
+                affixes = regex_affixes(wrapped.group(0)[3:-1])
+            if affixes is not None:
+                self.affixes = [(prefix,"") for prefix,_ in affixes]
+        # every match starts with one of these
+        self.prefixes = tuple(prefix for prefix,_ in self.affixes)
+
+    """
+    Gets the version of a product file from its name.
+        @return: The version, or None if name isn't the name of a product
+            file.
+    """
+    def version(self, name: str) -> Version | None:
+        if not name.startswith(self.prefixes):
+            return None
+        if self.exact:
+            for prefix, suffix in self.affixes:
+                if not name.startswith(prefix) or not name.endswith(suffix) \
+                        or len(name) <= len(prefix) + len(suffix):
+                    continue
+                digits: str = name[len(prefix):len(name) - len(suffix)]
+                # exactly what \d matches
+                if digits.isdecimal():
+                    return int(digits)
+            return None
+        match: Match[str] | None = self.regex.fullmatch(name)
+        return None if match is None else match_version(match)
+
+"""
+Gets the literal text before & after the version in each pattern a regex
+was made from, if that is all there is to it.
+    @param pattern: The source of a regex from pat_to_regex or
+        patterns_to_regex.
+    @return: The prefix & suffix of each pattern, in order, or None if the
+        regex isn't that simple, e.g. a pattern has more than one %V.
+"""
+def regex_affixes(pattern: str) -> List[Tuple[str,str]] | None:
+    affixes: List[Tuple[str,str]]
+    single: Match[str] | None = re.fullmatch(MATCHER_VERSION,pattern)
+    if single is not None:
+        affixes = [(single.group(1),single.group(2))]
+    elif re.fullmatch(
+        rf"{MATCHER_ALTERNATIVE}(?:\|{MATCHER_ALTERNATIVE})*",pattern
+    ):
+        affixes = re.findall(MATCHER_ALTERNATIVE,pattern)
+    else:
+        return None
+    return [
+        (MATCHER_ESCAPE.sub(r"\1",prefix),MATCHER_ESCAPE.sub(r"\1",suffix))
+        for prefix,suffix in affixes
+    ]
+
+"""
+Yields the name & version of every product file in a directory, in the order
+the directory lists them. The directory is streamed with os.scandir, so no
+list of every entry is ever built. Names are checked with a VersionMatcher,
+inlined here for the usual single pattern, since this runs for every entry
+of every directory phase lists.
+    @param regex: The regular expression used to identify product files,
+        i.e. the output of pat_to_regex or patterns_to_regex
+    @param path: The directory to scan. Defaults to the pwd.
+"""
+def scan_versions(regex: Pattern, path: str=".") -> Iterator[Tuple[str,Version]]:
+    matcher = VersionMatcher(regex)
+    prefix, suffix = matcher.affixes[0]
+    prefixes: Tuple[str,...] = matcher.prefixes
+    start: int = len(prefix)
+    end: int | None = -len(suffix) or None
+    min_length: int = len(prefix) + len(suffix)
+    version_of = matcher.version
+    version: Version | None
+    name: str
+    scanned: int = 0
+    with os.scandir(path) as entries:
+        if matcher.exact and len(matcher.affixes) == 1:
+            for entry in entries:
+                scanned += 1
+                name = entry.name
+                if name.startswith(prefix) and name.endswith(suffix) \
+                        and len(name) > min_length:
+                    digits: str = name[start:end]
+                    if digits.isdecimal():
+                        yield (name, int(digits))
+        else:
+            for entry in entries:
+                scanned += 1
+                name = entry.name
+                if not name.startswith(prefixes):
+                    continue
+                version = version_of(name)
+                if version is not None:
+                    yield (name, version)
+    TRACER.count("files_scanned",scanned)
+
+"""
+The files of a product (or of its backups), each paired with its version,
+e.g. as found by get_versions. It is a sequence of (filename, version)
+tuples, newest version first, with the files of a version in the order they
+were added, and compares equal to a list of the same tuples. Versions are
+kept in an array of machine integers beside a list of names, rather than as
+a tuple (and int object) per file, and are only sorted once something needs
+them in order, after which a version, or range of versions, is found by
+bisection instead of by walking every file.
+"""
+class Product():
+    __slots__ = ("names","versions","is_sorted")
+
+    """
+        @param files: (filename, version) pairs, in any order.
+        @param is_sorted: Whether files are already sorted, newest first.
+    """
+    def __init__(
+            self,
+            files: Iterable[Tuple[str,Version]]=(),
+            is_sorted: bool=False
+    ):
+        self.names: List[str] = []
+        # an array("q"), or a list if a version is too big for one
+        self.versions: Any = array.array("q")
+        iterator: Iterator[Tuple[str,Version]] = iter(files)
+        try:
+            for name, version in iterator:
+                self.versions.append(version)
+                self.names.append(name)
+        except OverflowError:
+            self.versions = list(self.versions)
+            self.versions.append(version)
+            self.names.append(name)
+            for name, version in iterator:
+                self.versions.append(version)
+                self.names.append(name)
+        self.is_sorted: bool = is_sorted
+
+    """
+    Gets files as a Product, without copying it if it already is one.
+    """
+    @staticmethod
+    def of(files: Iterable[Tuple[str,Version]]) -> Product:
+        return files if isinstance(files,Product) else Product(files)
+
+    def append(self, name: str, version: Version):
+        try:
+            self.versions.append(version)
+        except OverflowError:
+            self.versions = list(self.versions)
+            self.versions.append(version)
+        self.names.append(name)
+        self.is_sorted = False
+
+    def sort(self):
+        if self.is_sorted:
+            return
+        # newest first; sorted is stable in reverse too, so the files of a
+        # version stay in the order they were added
+        keys: List[Version] = list(self.versions)
+        order: List[int] = sorted(
+            range(len(keys)),key=keys.__getitem__,reverse=True
+        )
+        self.names = [self.names[i] for i in order]
+        versions: List[Version] = [keys[i] for i in order]
+        self.versions = versions if isinstance(self.versions,list) \
+            else array.array("q",versions)
+        self.is_sorted = True
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int | slice) -> Any:
+        self.sort()
+        if isinstance(i,slice):
+            part = Product(is_sorted=True)
+            part.names = self.names[i]
+            part.versions = self.versions[i]
+            if i.step is not None and i.step < 0:
+                part.is_sorted = len(part.names) < 2
+            return part
+        return (self.names[i],self.versions[i])
+
+    def __iter__(self) -> Iterator[Tuple[str,Version]]:
+        self.sort()
+        return zip(self.names,self.versions)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other,(Product,list)):
+            return len(self) == len(other) and all(
+                tuple(mine) == tuple(theirs)
+                for mine,theirs in zip(self,other)
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Product({list(self)!r})"
+
+    """
+    The index of the first file of the newest version no newer than
+    version, or of the first file older than version if after is true.
+    """
+    def bisect(self, version: Version, after: bool=False) -> int:
+        self.sort()
+        # the versions are in descending order, so are searched negated
+        return (bisect.bisect_right if after else bisect.bisect_left)(
+            self.versions,-version,key=operator.neg
+        )
+
+    """
+    Gets the files with a given version.
+    """
+    def find(self, version: Version) -> Product:
+        return self[self.bisect(version):self.bisect(version,after=True)]
+
+    """
+    Gets the files with versions from low to high, inclusive.
+    """
+    def between(self, low: Version, high: Version) -> Product:
+        return self[self.bisect(high):self.bisect(low,after=True)]
+
+    """
+    Finds where the files of the newest few versions end, like version_cut,
+    by jumping from one version to the next.
+        @param count: How many versions should come before the split.
+        @return: The index to split at.
+    """
+    def cut(self, count: int) -> int:
+        i: int = 0
+        for _ in range(count):
+            if i >= len(self.names):
+                break
+            i = self.bisect(self[i][1],after=True)
+        return i
+
+    """
+    Gets the files of the newest few versions.
+    """
+    def newest(self, count: int) -> Product:
+        return self[:self.cut(count)]
+
+    """
+    Gets the files of every version except the newest few, i.e. the ones
+    clean deletes.
+    """
+    def all_but_newest(self, count: int) -> Product:
+        return self[self.cut(count):]
+
+    """
+    Gets the files whose version is a multiple of n, i.e. the ones sample
+    backups are made of. Where there are far fewer multiples of n between
+    the oldest & newest versions than there are files, each multiple is
+    looked up in turn; otherwise, the versions are filtered.
+    """
+    def every(self, n: int) -> Product:
+        self.sort()
+        if not self.names:
+            return Product()
+        newest: Version = self.versions[0]
+        oldest: Version = self.versions[-1]
+        # each lookup takes a couple of bisections, a few dozen steps
+        if (newest // n - (oldest - 1) // n) * 64 >= len(self.names):
+            picked: List[int] = [
+                i for i,version in enumerate(self.versions)
+                if version % n == 0
+            ]
+            multiples = Product(is_sorted=True)
+            multiples.names = [self.names[i] for i in picked]
+            multiples.versions = self.versions[:0]
+            multiples.versions.extend(self.versions[i] for i in picked)
+            return multiples
+        return Product(
+            (
+                file
+                for version in range(newest - newest % n,oldest - 1,-n)
+                for file in self.find(version)
+            ),
+            is_sorted=True
+        )
+
+    """
+    Counts the distinct versions.
+    """
+    def version_count(self) -> int:
+        return len(set(self.versions))
+
 """
 Gets the names & versions of all the product files in the current working 
 directory, sorted in reverse order of versions (so the latest version is
-first on the list)
+first on the list). A product with several patterns has several files with
+each version, which are next to each other in the list.
     @param regex: The regular expression used to identify product files,
-        i.e. the output of pat_to_regex
-    @return A list, whose entries are tuples of the form
-        (filename, product version of filename)
-"""
-def get_versions(regex: Pattern) -> Product:
-    match: Match[str] | None
-    versions: Product = []
-    for filename in os.listdir():
-        match = regex.fullmatch(filename)
-        if  match == None:
+        i.e. the output of pat_to_regex or patterns_to_regex
+    @param newest: If given, only the files of this many of the latest
+        versions are returned. They are picked out with a heap as the
+        directory is scanned, rather than sorting every version.
+    @param path: The directory to scan. Defaults to the pwd.
+    @return A Product, whose entries are tuples of the form
+        (filename, product version of filename). It is only sorted once it
+        is used.
+"""
+@traced
+def get_versions(
+        regex: Pattern,
+        newest: int | None = None,
+        path: str="."
+) -> Product:
+    if newest is not None:
+        return newest_versions(scan_versions(regex,path),newest)
+    return Product(scan_versions(regex,path))
+
+"""
+Picks out the files of the latest few versions from product files in any
+order, keeping a heap of the versions seen so far, so that files of older
+versions are dropped as soon as they are found to be too old.
+    @param versions: The product files, e.g. from scan_versions.
+    @param count: How many versions to keep.
+    @return: The files of the latest count versions, sorted as by
+        get_versions.
+"""
+def newest_versions(
+        versions: Iterable[Tuple[str,Version]],
+        count: int
+) -> Product:
+    heap: List[Version] = []
+    names: dict[Version,List[str]] = dict()
+    # the oldest version kept, once there are count of them
+    oldest: Version | None = None
+    if count <= 0:
+        return Product()
+    for name, version in versions:
+        if oldest is not None and version < oldest:
             continue
-        versions.append( (filename, int(match.group(1))) )
-    versions.sort(key=lambda product_file: product_file[1], reverse=True)
-    return versions
+        if version in names:
+            names[version].append(name)
+        elif oldest is None:
+            heapq.heappush(heap,version)
+            names[version] = [name]
+            if len(heap) == count:
+                oldest = heap[0]
+        else:
+            del names[heapq.heapreplace(heap,version)]
+            names[version] = [name]
+            oldest = heap[0]
+    return Product(
+        (
+            (name,version)
+            for version in sorted(names,reverse=True)
+            for name in names[version]
+        ),
+        is_sorted=True
+    )
 
 """
-Deletes the oldest versions of the product until only a given number are
-left. Must be run from within the directory of the files you wish to delete
-    @param versions: The filenames of the various product versions, paired
-        with their respective versions. The output of get_versions
-    @param limit: The number of versions to leave behind
+Finds where the files of the latest few versions end in a list of product
+files sorted as by get_versions, so that the list can be split without
+splitting up the files of a version.
+    @param versions: The product files.
+    @param count: How many versions should come before the split.
+    @return: The index to split versions at.
 """
-def clean(versions: Product, limit: int):
-    for i in range(limit,len(versions)):
-        os.remove(versions[i][0])
+def version_cut(
+        versions: Product | List[Tuple[str,Version]],
+        count: int
+) -> int:
+    if isinstance(versions,Product):
+        return versions.cut(count)
+    seen: int = 0
+    last: Version | None = None
+    for i, (_,version) in enumerate(versions):
+        if version != last:
+            if seen == count:
+                return i
+            seen += 1
+            last = version
+    return len(versions)
 
 """
-Selects every nth version of the product and copies it to a given
-destination. "nth version" here means that the *version number* is divisble
-by n. Also deletes older versions in copies directory until only a given 
-number are left, using the clean function.
-    @param versions: The versions of the product; the output of get_versions
-    @param regex: the regex used to identify a product file
-    @param config: the section of the configuration used for sample backups.
-        It has the following values:
-            destination: the given directory above
-            frequency: the value of n
-            limit: the maximum number of backups to leave behind
+Counts the versions which clean would delete from a list of product files.
 """
-def backup_sample(versions: Product, regex: Pattern, config: dict[str,Any]):
-    for version in versions:
-        if version[1] % config["frequency"] == 0:
-            shutil.copy2(version[0],config["destination"])
-    orig_dir: str = os.getcwd()
-    os.chdir(config["destination"])
-    clean(get_versions(regex),config["limit"])
-    os.chdir(orig_dir)
+def count_old_versions(versions: Product, limit: int) -> int:
+    return max(0,Product.of(versions).version_count() - limit)
 
 """
-Makes a copy of a given file with a date-time-stamp added to the file's name.
-Note that the stamp is added before the last extension, i.e. before the last
-'.' character.
-    @param file: The path to the given file.
-    @param format: The format of the date-time-stamp.
-    @param now: The datetime to be used for the stamp. Defaults to the
-        present.
-    @param dst: The directory the copy should be placed in. Defaults to the
-        pwd.
-    @return: The new (absolute) file path.
+Gets the file phase opens: the file of the latest version that matches the
+product's first pattern, or failing that, any file of the latest version.
+    @param versions: The product files, sorted as by get_versions.
+    @param config: The product's configuration.
 """
-def date(
+def latest_file(versions: Product, config: dict[str,Any]) -> str:
+    if len(config["patterns"]) > 1:
+        regex: Pattern = pat_to_regex(config["pattern"])
+        for name, version in versions:
+            if version != versions[0][1]:
+                break
+            if regex.fullmatch(name) is not None:
+                return name
+    return versions[0][0]
+
+"""
+An on-disk cache of get_versions results, kept in the INDEX_FILE sidecar
+next to .phase. Each directory's entry stores the parsed (filename, version)
+list along with the directory's mtime, inode & link count, so as long as a
+single stat of the directory matches, the listing is reused without
+scanning. Changes phase makes itself are applied to the entries in place
+(see update), and anything else causes a rescan of that directory.
+"""
+class VersionIndex():
+    """
+        @param index_path: The path of the sidecar file. It is created
+            straight away if it does not exist, so that creating it does
+            not change the mtime of a directory that has already been
+            indexed.
+    """
+    def __init__(self, index_path: str):
+        self.index_path: str = index_path
+        self.dirs: dict[str,dict[str,Any]] = dict()
+        self.changed: bool = False
+        # directories whose entries are known to be up to date in this run
+        self.fresh: set[str] = set()
+        try:
+            with open(index_path,"r",encoding="utf8") as fp:
+                self.dirs = json.load(fp)
+        except FileNotFoundError:
+            try: open(index_path,"a").close()
+            except OSError: pass
+        except (OSError, ValueError):
+            # a corrupt or unreadable index is just rebuilt
+            self.dirs = dict()
+
+    """
+    Same as the get_versions function, except the listing of path is taken
+    from the index if the directory has not changed since it was indexed.
+    A listing made or checked in this run is trusted for the rest of it,
+    along with the changes phase itself has made since (see update). If
+    only the newest few versions are wanted and the listing can't be
+    used, just those are found, and nothing is added to the index.
+    """
+    @traced
+    def get_versions(
+            self,
+            regex: Pattern,
+            newest: int | None = None,
+            path: str="."
+    ) -> Product:
+        key: str = os.path.abspath(path)
+        entry: dict[str,Any] | None = self.dirs.get(key)
+        if entry is None or entry["pattern"] != regex.pattern \
+                or key not in self.fresh:
+            stat: os.stat_result = os.stat(key)
+            if not (
+                entry is not None
+                and entry["pattern"] == regex.pattern
+                and entry["mtime"] == stat.st_mtime_ns
+                and entry["ino"] == stat.st_ino
+                and entry["nlink"] == stat.st_nlink
+                and entry["scanned"] - entry["mtime"] > RACY_NS
+            ):
+                if newest is not None:
+                    return get_versions(regex,newest,path=key)
+                scanned: int = time.time_ns()
+                entry = {
+                    "pattern": regex.pattern,
+                    "mtime": stat.st_mtime_ns,
+                    "ino": stat.st_ino,
+                    "nlink": stat.st_nlink,
+                    "scanned": scanned,
+                    "versions": list(get_versions(regex,path=key)),
+                }
+                self.dirs[key] = entry
+                self.changed = True
+            self.fresh.add(key)
+        versions = Product(entry["versions"],is_sorted=True)
+        return versions if newest is None else versions.newest(newest)
+
+    """
+    Records changes phase has made to a directory itself, so that the
+    directory does not need to be listed again in this run (see
+    get_versions). A later run lists it again, since something else could
+    have changed it in the same tick. If the directory's entry was not
+    checked in this run, it is dropped instead, since it cannot be known to
+    have been correct before the change.
+        @param path: The directory that was changed.
+        @param added: The product files which were added to it.
+        @param removed: The names of the product files removed from it.
+    """
+    def update(
+            self,
+            path: str=".",
+            added: List[Tuple[str,Version]]=[],
+            removed: List[str]=[]
+    ):
+        key: str = os.path.abspath(path)
+        if key not in self.dirs:
+            return
+        self.changed = True
+        if key not in self.fresh:
+            del self.dirs[key]
+            return
+        entry: dict[str,Any] = self.dirs[key]
+        dropped: set[str] = set(removed) | {name for name,_ in added}
+        versions: List[Tuple[str,Version]] = [
+            (name,version) for name,version in entry["versions"]
+            if name not in dropped
+        ] + list(added)
+        versions.sort(key=operator.itemgetter(1), reverse=True)
+        stat: os.stat_result = os.stat(key)
+        entry["versions"] = versions
+        entry["mtime"] = stat.st_mtime_ns
+        entry["ino"] = stat.st_ino
+        entry["nlink"] = stat.st_nlink
+        entry["scanned"] = time.time_ns()
+
+    """
+    Writes the index back to its sidecar file, if anything has changed.
+    The file is overwritten in place rather than replaced, so the product
+    directory's mtime is left alone. Failing to write the index is not an
+    error; it just means the next run has to scan again.
+    """
+    @traced
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            with open(self.index_path,"w",encoding="utf8") as fp:
+                json.dump(self.dirs,fp)
+            self.changed = False
+        except OSError:
+            pass
+
+"""
+Counts what a backup did, so it can be reported to the user.
+"""
+class CopyStats():
+    def __init__(self):
+        self.files_copied: int = 0
+        self.bytes_copied: int = 0
+        self.files_skipped: int = 0
+        self.bytes_skipped: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"copied {self.files_copied} "
+            f"({format_size(self.bytes_copied)}), "
+            f"skipped {self.files_skipped} "
+            f"({format_size(self.bytes_skipped)}) already backed up"
+        )
+
+def format_size(num_bytes: int) -> str:
+    size: float = num_bytes
+    for unit in ["B","KB","MB","GB"]:
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+"""
+Sums up the output of remove_paths, e.g. "12 files, 1.5MB".
+"""
+def format_removals(removals: List[Removal]) -> str:
+    files: int = sum(removal[1] for removal in removals)
+    return (
+        f"{files} file{'' if files == 1 else 's'}, "
+        + format_size(sum(removal[2] for removal in removals))
+    )
+
+"""
+Returns the SHA-256 hex digest of a file's contents. Big files are mapped
+into memory and hashed in one go, which is quicker than reading them a chunk
+at a time, and lets other threads run while they are hashed.
+"""
+def hash_file(path: str) -> str:
+    import hashlib
+    with open(path,"rb") as fp:
+        if os.fstat(fp.fileno()).st_size < MMAP_MIN_SIZE:
+            return hashlib.file_digest(fp,"sha256").hexdigest()
+        import mmap
+        with mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped,"madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            return hashlib.sha256(mapped).hexdigest()
+
+"""
+A file object which hashes everything written through it before passing it
+on to another file object, so that a checksum of something written by e.g.
+a compressor can be had without reading it back.
+"""
+class HashingWriter():
+    """
+        @param fp: The file object to write to.
+    """
+    def __init__(self, fp: Any):
+        import hashlib
+        self.fp: Any = fp
+        self.hasher: Any = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hasher.update(data)
+        return self.fp.write(data)
+
+    def flush(self):
+        self.fp.flush()
+
+"""
+The SHA-256 checksums of the backups in a destination, kept in
+CHECKSUM_FILE there in the same format as sha256sum writes, so that they can
+also be checked with sha256sum -c. Each checksum is worked out while its
+backup is written (see copy_fd), so keeping them costs no extra reads;
+they are only read back by verify_checksums.
+"""
+class Checksums():
+    """
+        @param destination: The backup destination directory.
+    """
+    def __init__(self, destination: str):
+        self.path: str = f"{destination}/{CHECKSUM_FILE}"
+        # checksums of backups made since the file was last saved
+        self.added: dict[str,str] = dict()
+        # as with BackupManifest, the file is made straight away, so that
+        # making it does not make the destination's index stale
+        try:
+            if not os.path.exists(self.path):
+                open(self.path,"a").close()
+        except OSError:
+            pass
+
+    def add(self, name: str, digest: str):
+        self.added[name] = digest
+
+    """
+    Copies a file with a copying function that takes a hasher (see copy_fd),
+    and adds the checksum of the copy.
+        @param copy_function: Takes a source & destination path & a hasher,
+            and returns the number of bytes written.
+        @param name: The name to add the checksum under.
+        @return: What copy_function returns.
+    """
+    def copy(
+            self,
+            copy_function: Callable[[str,str,Any],int],
+            src: str,
+            dst: str,
+            name: str
+    ) -> int:
+        import hashlib
+        hasher: Any = hashlib.sha256()
+        written: int = copy_function(src,dst,hasher)
+        self.add(name,hasher.hexdigest())
+        return written
+
+    """
+    Reads the checksums saved in the destination.
+        @return: The checksum of each backup, by its path relative to the
+            destination. If a backup is listed more than once, its last
+            checksum is used.
+    """
+    def load(self) -> dict[str,str]:
+        checksums: dict[str,str] = dict()
+        try:
+            with open(self.path,"r",encoding="utf8") as fp:
+                for line in fp:
+                    line = line.rstrip("\n")
+                    escaped: bool = line.startswith("\\")
+                    digest, _, name = line.removeprefix("\\").partition("  ")
+                    if escaped:
+                        name = name.replace("\\n","\n").replace("\\\\","\\")
+                    if name:
+                        checksums[name] = digest
+        except FileNotFoundError:
+            pass
+        return checksums
+
+    """
+    Writes the checksums added since the last save to the file. They are
+    appended, unless they replace checksums already there, in which case
+    the file is rewritten (in place, like the manifest), so sha256sum -c
+    does not see the old ones.
+    """
+    def save(self):
+        if not self.added:
+            return
+        saved: dict[str,str] = self.load()
+        # a directory backup that was made again replaces all of the old
+        # one's checksums
+        replaced: set[str] = {name.split("/",1)[0] for name in self.added}
+        kept: dict[str,str] = {
+            name: digest for name,digest in saved.items()
+            if name.split("/",1)[0] not in replaced
+        }
+        if len(kept) != len(saved):
+            self.write(kept | self.added,"w")
+        else:
+            self.write(self.added,"a")
+        self.added = dict()
+
+    """
+    Drops the checksums of backups that no longer exist.
+        @param names: The backups that do exist. The checksums of the files
+            in a directory backup are kept if the directory is.
+    """
+    def prune(self, names: List[str]):
+        saved: dict[str,str] = self.load()
+        keep: set[str] = set(names)
+        kept: dict[str,str] = {
+            name: digest for name,digest in saved.items()
+            if name.split("/",1)[0] in keep
+        }
+        if len(kept) != len(saved):
+            self.write(kept,"w")
+
+    def write(self, checksums: dict[str,str], mode: str):
+        with open(self.path,mode,encoding="utf8") as fp:
+            for name, digest in checksums.items():
+                # the escaping sha256sum uses for awkward names
+                if "\\" in name or "\n" in name:
+                    name = name.replace("\\","\\\\").replace("\n","\\n")
+                    fp.write(f"\\{digest}  {name}\n")
+                else:
+                    fp.write(f"{digest}  {name}\n")
+
+"""
+Checks the backups in a destination against their checksums (see
+Checksums). Backups are hashed several at a time; hashlib lets other threads
+run while it hashes, so this keeps the disk busy rather than waiting on
+one file at a time.
+    @param destination: The backup destination directory.
+    @param workers: How many backups to hash at once.
+    @return: "ok", "mismatch" or "missing" for each backup with a checksum,
+        by its path relative to the destination.
+"""
+@traced
+def verify_checksums(
+        destination: str,
+        workers: int=DEFAULT_COPY_WORKERS
+) -> dict[str,str]:
+    from concurrent.futures import ThreadPoolExecutor
+    checksums: dict[str,str] = Checksums(destination).load()
+    def check(name: str) -> Tuple[str,int]:
+        path: str = os.path.join(destination,name)
+        try:
+            size: int = os.stat(path).st_size
+            matches: bool = hash_file(path) == checksums[name]
+        except FileNotFoundError:
+            return "missing", 0
+        return ("ok" if matches else "mismatch"), size
+    results: dict[str,str] = dict()
+    with ThreadPoolExecutor(max(1,workers)) as pool:
+        for name, (result,size) in zip(
+            checksums,pool.map(check,checksums)
+        ):
+            results[name] = result
+            if result != "missing":
+                TRACER.count("files_hashed")
+                TRACER.count("bytes_hashed",size)
+    return results
+
+"""
+A record, kept in MANIFEST_FILE in a backup destination, of the size & mtime
+(and optionally a hash) of the source of each backup made there. It is used
+to tell whether a version has already been backed up, without reading
+either copy.
+"""
+class BackupManifest():
+    """
+        @param destination: The backup destination directory.
+        @param backend: For a destination that is not a directory (see
+            is_remote), its backend, which the manifest is read & written
+            through instead.
+    """
+    def __init__(
+            self,
+            destination: str,
+            backend: LocalBackend | WebDAVBackend | None = None
+    ):
+        self.manifest_path: str = f"{destination}/{MANIFEST_FILE}"
+        self.backend: LocalBackend | WebDAVBackend | None = backend
+        # filename -> [size, mtime in ns, SHA-256 hash or None]
+        self.entries: dict[str,List[Any]] = dict()
+        self.changed: bool = False
+        if backend is not None:
+            try:
+                self.entries = json.loads(backend.read(MANIFEST_FILE) or b"{}")
+            except ValueError:
+                pass
+            return
+        try:
+            with open(self.manifest_path,"r",encoding="utf8") as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            # as with VersionIndex, create it before the destination is
+            # indexed, so making it does not make the index stale
+            try: open(self.manifest_path,"a").close()
+            except OSError: pass
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    """
+    Whether the backup of a file is already up to date.
+        @param file: The path to the source file.
+        @param backup: The path to its backup.
+        @param use_hash: Whether to fall back on comparing hashes if the
+            size matches but the mtime does not.
+    """
+    def is_backed_up(self, file: str, backup: str, use_hash: bool) -> bool:
+        entry: List[Any] | None = self.entries.get(os.path.basename(backup))
+        # a remote destination isn't looked at backup by backup; its
+        # manifest is pruned to what is there instead (see backup_sample)
+        if entry is None \
+                or (self.backend is None and not os.path.exists(backup)):
+            return False
+        stat: os.stat_result = os.stat(file)
+        if entry[0] != stat.st_size:
+            return False
+        if entry[1] == stat.st_mtime_ns:
+            return True
+        if use_hash and entry[2] is not None and entry[2] == hash_file(file):
+            entry[1] = stat.st_mtime_ns
+            self.changed = True
+            return True
+        return False
+
+    def record(self, file: str, backup: str, use_hash: bool):
+        stat: os.stat_result = os.stat(file)
+        self.entries[os.path.basename(backup)] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            # directory products aren't hashed
+            hash_file(file) if use_hash and os.path.isfile(file) else None,
+        ]
+        self.changed = True
+
+    """
+    Moves an entry to a new backup name, for when a backup is replaced by
+    an equivalent one, e.g. a delta by a full copy.
+    """
+    def rename(self, old_name: str, new_name: str):
+        if old_name in self.entries:
+            self.entries[new_name] = self.entries.pop(old_name)
+            self.changed = True
+
+    """
+    Drops the entries of any backups that no longer exist.
+        @param names: The backups that do exist.
+    """
+    def prune(self, names: List[str]):
+        keep: set[str] = set(names)
+        for name in list(self.entries):
+            if name not in keep:
+                del self.entries[name]
+                self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            if self.backend is not None:
+                self.backend.write(
+                    MANIFEST_FILE,json.dumps(self.entries).encode()
+                )
+            else:
+                with open(self.manifest_path,"w",encoding="utf8") as fp:
+                    json.dump(self.entries,fp)
+            self.changed = False
+        except OSError:
+            pass
+
+"""
+Copies a file's contents & metadata, the same way shutil.copy2 does, but
+using the cheapest way of copying the kernel offers. In order, it tries:
+    - a reflink clone (FICLONE), which is a metadata-only operation on
+      copy-on-write filesystems
+    - os.copy_file_range, which copies inside the kernel (and lets network
+      filesystems copy server-side)
+    - os.sendfile, which also avoids copying through userspace
+    - an ordinary buffered copy
+Each method carries on from wherever the last one got to, so a method
+failing part way through does not corrupt the copy.
+    @param src: The path to the file to copy.
+    @param dst: The path of the copy (not the directory to put it in).
+    @param hasher: See copy_fd.
+    @return: dst
+"""
+def copy_file(src: str, dst: str, hasher: Any=None) -> str:
+    import shutil
+    src_fd: int = os.open(src,os.O_RDONLY)
+    try:
+        dst_fd: int = os.open(dst,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0o666)
+        try:
+            copy_fd(src_fd,dst_fd,hasher)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src,dst)
+    return dst
+
+"""
+Copies everything from the current offset of one file descriptor to
+another; see copy_file.
+    @param src_fd: The file descriptor to copy from.
+    @param dst_fd: The file descriptor to copy to; should be empty.
+    @param hasher: If given, a hashlib object to feed everything copied.
+        The copy is then made through userspace, so that each chunk is
+        hashed as it is written rather than the file being read again.
+"""
+def copy_fd(src_fd: int, dst_fd: int, hasher: Any=None):
+    if hasher is not None:
+        while chunk := os.read(src_fd,COPY_BUFSIZE):
+            hasher.update(chunk)
+            write_all(dst_fd,chunk)
+        return
+    try:
+        fcntl.ioctl(dst_fd,FICLONE,src_fd)
+        return
+    except OSError:
+        pass
+    # these methods are not available on every platform, and fail if e.g.
+    # the files are on different filesystems or one is a pipe; either way,
+    # the next method takes over from the current offsets
+    fast_copies: List[Any] = [
+        getattr(os,"copy_file_range",None),
+        lambda src_fd,dst_fd,count: os.sendfile(dst_fd,src_fd,None,count),
+    ]
+    for fast_copy in fast_copies:
+        if fast_copy is None:
+            continue
+        try:
+            while fast_copy(src_fd,dst_fd,COPY_BUFSIZE * 8) > 0:
+                pass
+            return
+        except OSError as err:
+            if err.errno in (errno.ENOSPC, errno.EDQUOT, errno.EIO):
+                raise
+    while chunk := os.read(src_fd,COPY_BUFSIZE):
+        write_all(dst_fd,chunk)
+
+"""
+Writes all of data to a file descriptor. A write can write less than it was
+given (e.g. on network & FUSE filesystems, or when interrupted by a signal),
+so this carries on from where each one got to.
+"""
+def write_all(fd: int, data: bytes):
+    view: memoryview = memoryview(data)
+    while view:
+        view = view[os.write(fd,view):]
+
+"""
+A name, in the same directory as path, for a file or directory to be written
+before being renamed to path. Unique to the thread, so parallel copies to the
+same path cannot clash.
+"""
+def temp_path(path: str) -> str:
+    import threading
+    head, tail = os.path.split(path)
+    return os.path.join(
+        head,
+        f".{tail}.phase-tmp-{os.getpid()}-{threading.get_ident()}"
+    )
+
+"""
+Copies a file with copy_file via a temporary name, so that the copy only
+ever appears at dst once it is whole.
+    @param hasher: See copy_fd.
+    @return: The number of bytes copied.
+"""
+def atomic_copy(src: str, dst: str, hasher: Any=None) -> int:
+    tmp: str = temp_path(dst)
+    try:
+        copy_file(src,tmp,hasher)
+        os.replace(tmp,dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return os.stat(dst).st_size
+
+"""
+Hardlinks a copy of a file to a previous copy of it, if the file has not
+changed since (see CopyExecutor.copy_tree).
+    @param file: The file being copied.
+    @param previous: Where the previous copy would be.
+    @param copy: The path of the new copy.
+    @param use_hash: Whether a file whose size is the same as the previous
+        copy's but mtime is not counts as unchanged if its contents are the
+        same.
+    @return: Whether the copy was made, i.e. the file was unchanged and a
+        hardlink could be made.
+"""
+def link_copy(
         file: str,
-        format: str,
-        now: datetime=datetime.now(),
-        dst: str="?"
-) -> str:
-    if dst == "?":
-        dst = os.path.dirname(file)
-    dst = os.path.abspath(dst)  # note this removes any '/' at the end
-    basename: str = os.path.basename(file)
-    ext_index: int = basename.rfind(".")
-    format = now.strftime(format)
-    new_file: str
-    if ext_index == -1:
-        new_file = f"{dst}/{basename}{format}"
-    else:
-        new_file = f"{dst}/{basename[:ext_index]}{format}{basename[ext_index:]}"
-    if os.path.isdir(file):
-        shutil.copytree(file,new_file)
-    else:
-        shutil.copy2(file,new_file)
-    return new_file
+        previous: str,
+        copy: str,
+        use_hash: bool=False
+) -> bool:
+    try:
+        previous_stat: os.stat_result = os.stat(previous)
+    except OSError:
+        return False
+    file_stat: os.stat_result = os.stat(file)
+    if not stat.S_ISREG(previous_stat.st_mode) \
+            or previous_stat.st_size != file_stat.st_size:
+        return False
+    if previous_stat.st_mtime_ns != file_stat.st_mtime_ns and not (
+        use_hash and hash_file(file) == hash_file(previous)
+    ):
+        return False
+    try:
+        os.link(previous,copy)
+    except OSError:
+        # e.g. hardlinks aren't supported, or the file has too many
+        return False
+    return True
+
+"""
+Runs copies on a bounded pool of threads. Copying is mostly waiting on I/O,
+so this helps most with lots of small files, where the time taken is
+dominated by per-file latency rather than bandwidth.
+"""
+class CopyExecutor():
+    """
+        @param workers: The maximum number of copies to run at once.
+        @param show_progress: Whether to show the overall progress of each
+            batch of copies on stderr.
+    """
+    def __init__(
+            self,
+            workers: int=DEFAULT_COPY_WORKERS,
+            show_progress: bool=False
+    ):
+        import threading
+        self.workers: int = max(1,workers)
+        self.show_progress: bool = show_progress
+        self.lock = threading.Lock()
+
+    """
+    Runs a copying function on each of a list of (source, destination)
+    pairs. If any copy fails, copies which have not started yet are
+    cancelled, and the first error is raised once the running ones have
+    finished. It is up to copy_function not to leave partial copies behind
+    (see atomic_copy).
+        @param copy_function: Takes a source & destination path, and returns
+            the number of bytes written.
+        @param jobs: The pairs of paths.
+        @return: The number of bytes each job wrote, in the order of jobs.
+    """
+    def run(
+            self,
+            copy_function: Callable[[str,str],int],
+            jobs: List[Tuple[str,str]]
+    ) -> List[int]:
+        from concurrent.futures import ThreadPoolExecutor
+        results: List[int] = [0] * len(jobs)
+        if not jobs:
+            return results
+        done: List[int] = [0,0]  # files & bytes
+        def run_job(i: int):
+            results[i] = copy_function(*jobs[i])
+            with self.lock:
+                done[0] += 1
+                done[1] += results[i]
+                if self.show_progress:
+                    print(
+                        f"\rCopying: {done[0]}/{len(jobs)} files, "
+                        f"{format_size(done[1])}",
+                        end="",
+                        file=sys.stderr
+                    )
+        error: BaseException | None = None
+        with ThreadPoolExecutor(min(self.workers,len(jobs))) as pool:
+            futures: List[Future] = \
+                [pool.submit(run_job,i) for i in range(len(jobs))]
+            for future in futures:
+                try:
+                    future.result()
+                except BaseException as err:
+                    if error is None:
+                        error = err
+                        for other in futures:
+                            other.cancel()
+        if self.show_progress:
+            print(file=sys.stderr)
+        if error is not None:
+            raise error
+        TRACER.count("files_copied",len(jobs))
+        TRACER.count("bytes_copied",sum(results))
+        return results
+
+    """
+    Copies files to the given paths, in parallel, using atomic_copy.
+        @param checksums: If given, the checksum of each copy is worked out
+            as it is made, and added to this under the copy's filename.
+        @return: The total number of bytes copied.
+    """
+    def copy_files(
+            self,
+            jobs: List[Tuple[str,str]],
+            checksums: Checksums | None = None
+    ) -> int:
+        if checksums is None:
+            return sum(self.run(atomic_copy,jobs))
+        return sum(self.run(
+            lambda src,dst: checksums.copy(
+                atomic_copy,src,dst,os.path.basename(dst)
+            ),
+            jobs
+        ))
+
+    """
+    Copies a directory tree like shutil.copytree, copying its files in
+    parallel. The tree is built under a temporary name and renamed into
+    place at the end, so a failed copy leaves nothing behind at dst.
+
+    Given a previous copy of the tree (like rsync's --link-dest), files
+    which are unchanged since it are hardlinked to it rather than copied,
+    so that the copy only takes up the space of what has changed. Files
+    count as unchanged if they have the same path, size & mtime there. If
+    a file can't be linked (e.g. the filesystem has no hardlinks) it is
+    copied instead.
+        @param src: The directory to copy.
+        @param dst: The path of the copy, which must not already exist.
+        @param checksums: If given, the checksum of each file copied is
+            added to this, under its path relative to dst's parent.
+        @param link_dest: The previous copy, or None to copy everything.
+        @param use_hash: Whether files whose size is the same as in
+            link_dest but mtime is not count as unchanged if their contents
+            are the same.
+        @return: The total number of bytes copied.
+    """
+    def copy_tree(
+            self,
+            src: str,
+            dst: str,
+            checksums: Checksums | None = None,
+            link_dest: str | None = None,
+            use_hash: bool=False
+    ) -> int:
+        import shutil
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST,os.strerror(errno.EEXIST),dst)
+        tmp: str = temp_path(dst)
+        jobs: List[Tuple[str,str]] = []
+        rel_dirs: List[str] = []
+        # the paths of the files linked, relative to src
+        linked: List[str] = []
+        try:
+            for dirpath, _, filenames in os.walk(src,followlinks=True):
+                rel_dir: str = os.path.relpath(dirpath,src)
+                rel_dirs.append(rel_dir)
+                os.makedirs(os.path.join(tmp,rel_dir),exist_ok=True)
+                for filename in filenames:
+                    file: str = os.path.join(dirpath,filename)
+                    copy: str = os.path.join(tmp,rel_dir,filename)
+                    if link_dest is not None and link_copy(
+                        file,
+                        os.path.join(link_dest,rel_dir,filename),
+                        copy,
+                        use_hash
+                    ):
+                        linked.append(os.path.relpath(file,src))
+                    else:
+                        jobs.append((file,copy))
+            TRACER.count("files_linked",len(linked))
+            TRACER.count("bytes_linked",sum(
+                os.stat(os.path.join(tmp,rel_path)).st_size
+                for rel_path in linked
+            ))
+            if checksums is not None and linked:
+                # a linked file has the same checksum as the one it is
+                # linked to, if that was backed up to the same destination
+                previous: dict[str,str] = checksums.load()
+                for rel_path in linked:
+                    checksums.add(
+                        os.path.join(os.path.basename(dst),rel_path),
+                        previous.get(
+                            os.path.join(os.path.basename(link_dest),rel_path)
+                        ) or hash_file(os.path.join(tmp,rel_path))
+                    )
+            copy_function: Callable[[str,str],int] = \
+                lambda src,dst: os.stat(copy_file(src,dst)).st_size
+            if checksums is not None:
+                copy_function = lambda file,copy: checksums.copy(
+                    lambda file,copy,hasher:
+                        os.stat(copy_file(file,copy,hasher)).st_size,
+                    file,
+                    copy,
+                    os.path.join(
+                        os.path.basename(dst),os.path.relpath(file,src)
+                    )
+                )
+            written: int = sum(self.run(copy_function,jobs))
+            # directory mtimes are set last, since copying into a directory
+            # changes its mtime
+            for rel_dir in reversed(rel_dirs):
+                shutil.copystat(
+                    os.path.join(src,rel_dir),
+                    os.path.join(tmp,rel_dir)
+                )
+            os.rename(tmp,dst)
+        except BaseException:
+            shutil.rmtree(tmp,ignore_errors=True)
+            raise
+        return written
+
+"""
+Gets the regex which identifies releases of a product (see date): the same
+as patterns_to_regex, except that anything (the date-time stamp) can come
+before the extension.
+    @param patterns: The product's patterns, as in config["patterns"].
+"""
+def release_regex(patterns: List[str]) -> Pattern:
+    parts: List[str] = []
+    for pattern in patterns:
+        # the stamp goes where date puts it, before the last '.'; the
+        # version can't have one in it, so this is the same place
+        ext_index: int = pattern.rfind(".")
+        if ext_index == -1:
+            ext_index = len(pattern)
+        parts.append(
+            pat_to_regex(pattern[:ext_index]).pattern + ".*"
+            + pat_to_regex(pattern[ext_index:]).pattern
+        )
+    if len(parts) == 1:
+        return re.compile(parts[0])
+    return re.compile("|".join(f"(?:{part})" for part in parts))
+
+"""
+Finds the earlier backup that a new backup of a directory product should
+hardlink its unchanged files to (see CopyExecutor.copy_tree): the backup
+in the destination of the closest version before the one being backed up,
+or failing that the closest after it, or the same version (as happens with
+releases), newest first.
+    @param destination: The backup destination directory.
+    @param regex: The regex the destination's backups of the product match
+        in full, e.g. the product's own regex for sample backups, or
+        release_regex.
+    @param name: The name of the product file being backed up.
+    @return: The path of the backup, or None if there is no earlier backup
+        of the same file of the product that is a directory.
+"""
+def link_source(destination: str, regex: Pattern, name: str) -> str | None:
+    match: Match[str] | None = regex.fullmatch(name)
+    if match is None:
+        return None
+    version: Version = match_version(match)
+    best: Tuple[bool,int,int] | None = None
+    source: str | None = None
+    try:
+        with os.scandir(destination) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") \
+                        or not entry.is_dir(follow_symlinks=False):
+                    continue
+                entry_match: Match[str] | None = regex.fullmatch(entry.name)
+                # only backups of the same one of the product's files
+                if entry_match is None \
+                        or entry_match.lastindex != match.lastindex:
+                    continue
+                entry_version: Version = match_version(entry_match)
+                key: Tuple[bool,int,int] = (
+                    entry_version <= version,
+                    -abs(version - entry_version),
+                    entry.stat(follow_symlinks=False).st_mtime_ns
+                )
+                if best is None or key > best:
+                    best = key
+                    source = entry.path
+    except FileNotFoundError:
+        pass
+    return source
+
+"""
+Gets the regex which identifies backups of a product in a backup destination.
+As well as plain copies, this matches compressed backups (with an
+extension from COMPRESSIONS, and .tar before it for directory products)
+and deltas (with DELTA_EXTENSION), so backups are still recognised if the
+compression or delta options are changed.
+    @param regex: The regex used to identify product files.
+"""
+def backup_regex(regex: Pattern) -> Pattern:
+    extensions: str = "|".join(
+        re.escape(extension) for _,extension,_ in COMPRESSIONS.values()
+    )
+    return re.compile(
+        f"(?:{regex.pattern})"
+        + f"(?:(?:\\.tar)?(?:{extensions})|{re.escape(DELTA_EXTENSION)})?"
+    )
+
+"""
+Gets the extension added to the name of a compressed copy of a file.
+    @param file: The path to the file.
+    @param compression: The compression used, if any.
+"""
+def compressed_extension(file: str, compression: str | None) -> str:
+    if compression is None:
+        return ""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}'")
+    if os.path.isdir(file):
+        return ".tar" + COMPRESSIONS[compression][1]
+    return COMPRESSIONS[compression][1]
+
+"""
+Gets the name a backup of a product file gets in a backup destination.
+    @param file: The path to the product file.
+    @param compression: The compression used in the destination, if any.
+"""
+def backup_name(file: str, compression: str | None) -> str:
+    return os.path.basename(file) + compressed_extension(file,compression)
+
+"""
+Makes a compressed copy of a file, or a compressed tar archive of a
+directory, streaming it through the compressor in fixed-size chunks so
+that memory use does not depend on the size of the file. The copy is
+written under a temporary name and renamed into place once whole, and is
+given the mtime of the original.
+    @param src: The file or directory to compress.
+    @param dst: The path of the compressed copy.
+    @param compression: A key of COMPRESSIONS.
+    @param checksums: If given, the checksum of the compressed copy is
+        worked out as it is written, and added to this under its filename.
+    @return: The size of the compressed copy.
+"""
+def compress_copy(
+        src: str,
+        dst: str,
+        compression: str,
+        checksums: Checksums | None = None
+) -> int:
+    import importlib
+    import shutil
+    import tarfile
+    module, _, tar_mode = COMPRESSIONS[compression]
+    open_compressed: Callable[...,Any] = importlib.import_module(module).open
+    tmp: str = temp_path(dst)
+    try:
+        with open(tmp,"wb") as raw:
+            out: Any = raw if checksums is None else HashingWriter(raw)
+            if os.path.isdir(src):
+                with tarfile.open(
+                    fileobj=out,mode=f"w:{tar_mode}"
+                ) as archive:
+                    archive.add(src,arcname=os.path.basename(src))
+            else:
+                with open(src,"rb") as fsrc, open_compressed(out,"wb") as fdst:
+                    shutil.copyfileobj(fsrc,fdst,COPY_BUFSIZE)
+        if checksums is not None:
+            checksums.add(os.path.basename(dst),out.hasher.hexdigest())
+        shutil.copystat(src,tmp)
+        os.replace(tmp,dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    return os.stat(dst).st_size
+
+"""
+Restores a backup, decompressing it if it was compressed. The restored
+file gets the product file's original name, i.e. without any extension
+added by compression.
+    @param backup: The path to the backup.
+    @param dst: The directory to restore the backup to.
+    @param regex: The regex used to identify product files; needed to tell
+        compressed directory products from compressed product files which
+        are themselves tar archives.
+    @return: The path of the restored file.
+"""
+@traced
+def restore(backup: str, dst: str, regex: Pattern) -> str:
+    import importlib
+    import shutil
+    import tarfile
+    name: str = os.path.basename(backup)
+    for module, extension, _ in COMPRESSIONS.values():
+        if not name.endswith(extension):
+            continue
+        open_compressed: Callable[...,Any] = \
+            importlib.import_module(module).open
+        name = name[:-len(extension)]
+        if name.endswith(".tar") and regex.fullmatch(name) is None:
+            with tarfile.open(backup,"r:*") as archive:
+                top_level: str = archive.getnames()[0].split("/")[0]
+                restored: str = os.path.join(dst,top_level)
+                if os.path.lexists(restored):
+                    raise FileExistsError(
+                        errno.EEXIST,os.strerror(errno.EEXIST),restored
+                    )
+                archive.extractall(dst,filter="data")
+            return restored
+        restored = os.path.join(dst,name)
+        if os.path.lexists(restored):
+            raise FileExistsError(errno.EEXIST,os.strerror(errno.EEXIST),restored)
+        tmp: str = temp_path(restored)
+        try:
+            with open_compressed(backup,"rb") as fsrc, open(tmp,"xb") as fdst:
+                shutil.copyfileobj(fsrc,fdst,COPY_BUFSIZE)
+            shutil.copystat(backup,tmp)
+            os.rename(tmp,restored)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        return restored
+    if name.endswith(DELTA_EXTENSION):
+        name = name[:-len(DELTA_EXTENSION)]
+    restored = os.path.join(dst,name)
+    if os.path.lexists(restored):
+        raise FileExistsError(errno.EEXIST,os.strerror(errno.EEXIST),restored)
+    if os.path.isdir(backup):
+        CopyExecutor().copy_tree(backup,restored)
+    elif backup.endswith(DELTA_EXTENSION):
+        tmp = temp_path(restored)
+        try:
+            apply_delta(backup,tmp)
+            os.rename(tmp,restored)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+    else:
+        atomic_copy(backup,restored)
+    return restored
+
+"""
+Restores a backup from a destination that is not a directory, by fetching
+it next to where it is to be restored to, and restoring that.
+    @param backend: The destination's backend.
+    @param name: The backup's name in the destination.
+    @param dst: The directory to restore it to.
+    @param regex: The regex used to identify product files.
+    @return: The path to the restored file.
+"""
+def restore_remote(
+        backend: LocalBackend | WebDAVBackend,
+        name: str,
+        dst: str,
+        regex: Pattern
+) -> str:
+    import shutil
+    import tempfile
+    fetched: str = tempfile.mkdtemp(prefix=".phase-restore-",dir=dst)
+    try:
+        backend.fetch(name,os.path.join(fetched,name))
+        return restore(os.path.join(fetched,name),dst,regex)
+    finally:
+        shutil.rmtree(fetched,ignore_errors=True)
+
+"""
+Writes an rsync-style binary delta, which describes a target file as a
+sequence of blocks copied from a base file and literal data. Blocks of the
+base are found anywhere in the target by sliding a rolling (Adler-32)
+checksum over the target one byte at a time, confirmed with a strong hash.
+After a match, the search jumps a whole block ahead, so the byte-by-byte
+work is proportional to how much the target differs from the base.
+    @param base: The path to the base file.
+    @param target: The path to the file to describe.
+    @param delta: The path to write the delta to.
+    @param base_name: The name the delta records for its base, without
+        DELTA_EXTENSION. When reconstructing, the base is looked for in the
+        same directory as the delta, either as a full copy or as another
+        delta, so a base can be turned from one into the other without its
+        dependents having to change.
+    @param max_size: If given, making the delta is abandoned as soon as it
+        is certain to be bigger than this, since the search for matches is
+        slowest when there are none to find.
+    @return: The size of the delta, or -1 if it was abandoned.
+"""
+def make_delta(
+        base: str,
+        target: str,
+        delta: str,
+        base_name: str,
+        max_size: int | None = None
+) -> int:
+    import hashlib
+    import mmap
+    import struct
+    import zlib
+    block: int = DELTA_BLOCK_SIZE
+    # weak checksum -> {strong hash -> offset in base}
+    blocks: dict[int,dict[bytes,int]] = dict()
+    with open(base,"rb") as fbase:
+        offset: int = 0
+        while len(chunk := fbase.read(block)) == block:
+            strong: bytes = hashlib.blake2b(chunk,digest_size=16).digest()
+            blocks.setdefault(zlib.adler32(chunk),dict()) \
+                .setdefault(strong,offset)
+            offset += block
+    with open(target,"rb") as ftarget, open(delta,"wb") as fdelta:
+        encoded_name: bytes = base_name.encode("utf8")
+        fdelta.write(DELTA_MAGIC)
+        fdelta.write(struct.pack(">H",len(encoded_name)))
+        fdelta.write(encoded_name)
+        size: int = os.fstat(ftarget.fileno()).st_size
+        if size == 0:
+            return fdelta.tell()
+        data = mmap.mmap(ftarget.fileno(),0,access=mmap.ACCESS_READ)
+        # the copy currently being built up, as [offset, length]
+        pending: List[int] = []
+        def flush_copy():
+            if pending:
+                fdelta.write(b"C" + struct.pack(">QQ",*pending))
+                pending.clear()
+        def write_literal(start: int, end: int):
+            if start < end:
+                flush_copy()
+                fdelta.write(b"D" + struct.pack(">Q",end - start))
+                fdelta.write(data[start:end])
+        pos: int = 0
+        literal_start: int = 0
+        if max_size is None:
+            max_size = size * 2 + block
+        # how long the current run of literal data can get before the delta
+        # is too big
+        budget: int = max_size - fdelta.tell()
+        weak: int = zlib.adler32(data[0:block]) if size >= block else 0
+        while pos + block <= size:
+            if pos - literal_start > budget:
+                data.close()
+                return -1
+            candidates: dict[bytes,int] | None = blocks.get(weak)
+            if candidates is not None:
+                match: int | None = candidates.get(hashlib.blake2b(
+                    data[pos:pos+block],digest_size=16
+                ).digest())
+                if match is not None:
+                    write_literal(literal_start,pos)
+                    if pending and pending[0] + pending[1] == match:
+                        pending[1] += block
+                    else:
+                        flush_copy()
+                        pending.extend([match,block])
+                    pos += block
+                    literal_start = pos
+                    # (allowing for the pending copy's op, 17 bytes)
+                    budget = max_size - fdelta.tell() - 17
+                    if pos + block <= size:
+                        weak = zlib.adler32(data[pos:pos+block])
+                    continue
+            if pos + block < size:
+                # roll the window on by a byte
+                out_byte: int = data[pos]
+                a: int = (weak & 0xffff) - out_byte + data[pos+block]
+                a %= 65521
+                b: int = ((weak >> 16) - block * out_byte + a - 1) % 65521
+                weak = (b << 16) | a
+            pos += 1
+        write_literal(literal_start,size)
+        flush_copy()
+        data.close()
+        return fdelta.tell() if fdelta.tell() <= max_size else -1
+
+"""
+Gets the name of the base a delta file was made against, without
+DELTA_EXTENSION.
+"""
+def delta_base(delta: str) -> str:
+    import struct
+    with open(delta,"rb") as fp:
+        if fp.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError(f"{delta} is not a phase delta file")
+        (name_length,) = struct.unpack(">H",fp.read(2))
+        return fp.read(name_length).decode("utf8")
+
+"""
+Gets the path to the base a delta file was made against, which is either a
+full copy or another delta.
+"""
+def delta_base_path(delta: str) -> str:
+    base: str = os.path.join(os.path.dirname(delta),delta_base(delta))
+    if os.path.lexists(base):
+        return base
+    return base + DELTA_EXTENSION
+
+"""
+Gets the number of deltas that have to be applied to rebuild a backup,
+i.e. 0 for a full copy.
+"""
+def delta_chain_length(backup: str) -> int:
+    length: int = 0
+    while backup.endswith(DELTA_EXTENSION):
+        length += 1
+        backup = delta_base_path(backup)
+    return length
+
+"""
+Rebuilds the file a delta describes. If the delta's base is itself a delta,
+that is rebuilt first (into a temporary file).
+    @param delta: The path to the delta.
+    @param out: The path to write the rebuilt file to.
+"""
+def apply_delta(delta: str, out: str):
+    import shutil
+    import struct
+    base: str = delta_base_path(delta)
+    base_tmp: str | None = None
+    if base.endswith(DELTA_EXTENSION):
+        base_tmp = temp_path(base[:-len(DELTA_EXTENSION)])
+        apply_delta(base,base_tmp)
+    try:
+        with open(delta,"rb") as fdelta, \
+                open(base_tmp or base,"rb") as fbase, \
+                open(out,"wb") as fout:
+            fdelta.seek(len(DELTA_MAGIC))
+            (name_length,) = struct.unpack(">H",fdelta.read(2))
+            fdelta.seek(name_length,os.SEEK_CUR)
+            while op := fdelta.read(1):
+                if op == b"C":
+                    offset, remaining = struct.unpack(">QQ",fdelta.read(16))
+                    fbase.seek(offset)
+                    source = fbase
+                else:
+                    (remaining,) = struct.unpack(">Q",fdelta.read(8))
+                    source = fdelta
+                while remaining > 0:
+                    chunk: bytes = source.read(min(remaining,COPY_BUFSIZE))
+                    if not chunk:
+                        raise ValueError(f"{delta} is truncated or corrupt")
+                    fout.write(chunk)
+                    remaining -= len(chunk)
+    finally:
+        if base_tmp is not None and os.path.lexists(base_tmp):
+            os.remove(base_tmp)
+    shutil.copystat(delta,out)
+
+"""
+Makes a backup of a file as a delta against an existing backup, or as a full
+copy if that is better: when there is no earlier backup, when the chain of
+deltas back to a full copy would reach chain_limit, or when the delta would
+be more than half the size of the file anyway. Directories are always
+copied whole (see CopyExecutor.copy_tree).
+    @param file: The path to the file (or directory) to back up.
+    @param backup: The path of a full copy of the backup; the delta, if one
+        is made, gets DELTA_EXTENSION added to this.
+    @param base: The path to the backup to make the delta against, if any.
+    @param chain_limit: The maximum number of deltas between a backup and
+        a full copy; so there is a full copy every chain_limit backups.
+    @return: The path of the backup made.
+"""
+def delta_copy(
+        file: str,
+        backup: str,
+        base: str | None,
+        chain_limit: int
+) -> str:
+    import shutil
+    if os.path.isdir(file):
+        CopyExecutor().copy_tree(file,backup)
+        return backup
+    if base is None or os.path.isdir(base) \
+            or delta_chain_length(base) + 1 >= chain_limit:
+        atomic_copy(file,backup)
+        return backup
+    delta: str = backup + DELTA_EXTENSION
+    tmp: str = temp_path(delta)
+    base_tmp: str | None = None
+    base_name: str = os.path.basename(base)
+    if base_name.endswith(DELTA_EXTENSION):
+        base_name = base_name[:-len(DELTA_EXTENSION)]
+    try:
+        if base.endswith(DELTA_EXTENSION):
+            base_tmp = temp_path(base[:-len(DELTA_EXTENSION)])
+            apply_delta(base,base_tmp)
+        size: int = make_delta(
+            base_tmp or base,file,tmp,base_name,
+            max_size=os.stat(file).st_size // 2
+        )
+        if size < 0:
+            os.remove(tmp)
+            atomic_copy(file,backup)
+            return backup
+        shutil.copystat(file,tmp)
+        os.replace(tmp,delta)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        if base_tmp is not None and os.path.lexists(base_tmp):
+            os.remove(base_tmp)
+    return delta
+
+"""
+Turns every delta in a directory which is made against one of the given
+backups into a full copy, so that those backups can be deleted.
+    @param destination: The backup directory.
+    @param names: The names of the backups about to be deleted.
+    @return: (old name, new name) for each delta turned into a full copy.
+"""
+def rebase_deltas(destination: str, names: List[str]) -> List[Tuple[str,str]]:
+    doomed: set[str] = set(names)
+    doomed_bases: set[str] = {
+        name[:-len(DELTA_EXTENSION)] if name.endswith(DELTA_EXTENSION)
+            else name
+        for name in names
+    }
+    rebased: List[Tuple[str,str]] = []
+    with os.scandir(destination) as entries:
+        deltas: List[str] = [
+            entry.name for entry in entries
+            if entry.name.endswith(DELTA_EXTENSION)
+            and entry.name not in doomed
+        ]
+    for name in deltas:
+        delta: str = os.path.join(destination,name)
+        if delta_base(delta) not in doomed_bases:
+            continue
+        full: str = delta[:-len(DELTA_EXTENSION)]
+        tmp: str = temp_path(full)
+        try:
+            apply_delta(delta,tmp)
+            os.rename(tmp,full)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        os.remove(delta)
+        rebased.append((name,os.path.basename(full)))
+    return rebased
+
+"""
+Empties & deletes directory trees on a thread pool. Each task lists one
+directory with os.scandir, deletes the files in it and hands its
+subdirectories on to new tasks, so a tree with thousands of files is worked
+through many directories at a time; the emptied directories are deleted
+last, deepest first.
+    @param roots: The directories to delete.
+    @param workers: The maximum number of directories to work on at once.
+    @param dry_run: If true, nothing is deleted; the files are only counted.
+    @return: The number of files & bytes in each root, in the order of roots.
+"""
+def sweep_trees(
+        roots: List[str],
+        workers: int=DEFAULT_DELETE_WORKERS,
+        dry_run: bool=False
+) -> List[Tuple[int,int]]:
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    totals: List[List[int]] = [[0,0] for _ in roots]
+    dirs: List[str] = []
+    def sweep(path: str) -> List[str]:
+        subdirs: List[str] = []
+        files: int = 0
+        size: int = 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                files += 1
+                size += entry.stat(follow_symlinks=False).st_size
+                if not dry_run:
+                    os.unlink(entry.path)
+        return [files,size] + subdirs
+    with ThreadPoolExecutor(max_workers=max(1,workers)) as pool:
+        running: dict[Future,int] = {
+            pool.submit(sweep,root): i for i,root in enumerate(roots)
+        }
+        dirs.extend(roots)
+        try:
+            while running:
+                done, _ = wait(running,return_when=FIRST_COMPLETED)
+                for future in done:
+                    i: int = running.pop(future)
+                    files, size, *subdirs = future.result()
+                    totals[i][0] += files
+                    totals[i][1] += size
+                    dirs.extend(subdirs)
+                    for subdir in subdirs:
+                        running[pool.submit(sweep,subdir)] = i
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+    if not dry_run:
+        # every directory was found after its parent
+        for path in reversed(dirs):
+            os.rmdir(path)
+    return [(files,size) for files,size in totals]
+
+"""
+Deletes files and directories. Directories are first renamed out of the
+way, so that one which is only partly deleted (because phase was stopped,
+say) is never mistaken for a version of the product, and are then deleted
+with sweep_trees.
+    @param paths: The files and directories to delete.
+    @param workers: See sweep_trees.
+    @param dry_run: If true, nothing is deleted; only the plan is returned.
+    @return: Each path, with the number of files & bytes deleted with it.
+"""
+def remove_paths(
+        paths: List[str],
+        workers: int=DEFAULT_DELETE_WORKERS,
+        dry_run: bool=False
+) -> List[Removal]:
+    removals: List[Removal] = []
+    trees: List[str] = []
+    tree_indices: List[int] = []
+    for path in paths:
+        path_stat: os.stat_result = os.lstat(path)
+        if stat.S_ISDIR(path_stat.st_mode):
+            tree: str = path
+            if not dry_run:
+                tree = temp_path(path)
+                os.rename(path,tree)
+            trees.append(tree)
+            tree_indices.append(len(removals))
+            removals.append((path,0,0))
+            continue
+        if not dry_run:
+            os.remove(path)
+        removals.append((path,1,path_stat.st_size))
+    for i, (files,size) in zip(tree_indices,sweep_trees(trees,workers,dry_run)):
+        removals[i] = (removals[i][0],files,size)
+    if not dry_run:
+        TRACER.count("entries_deleted",sum(removal[1] for removal in removals))
+        TRACER.count("bytes_deleted",sum(removal[2] for removal in removals))
+    return removals
+
+"""
+Deletes the oldest versions of the product until only a given number are
+left. Versions can be files or directories (see remove_paths), and all the
+files of a version (see patterns_to_regex) are deleted together.
+    @param versions: The filenames of the various product versions, paired
+        with their respective versions. The output of get_versions
+    @param limit: The number of versions to leave behind
+    @param index: If given, the version index to record the deletions in
+    @param path: The directory the files are in. Defaults to the pwd.
+    @param dry_run: If true, nothing is deleted, and the plan is returned.
+    @return: What was (or would be) deleted; see remove_paths.
+"""
+@traced
+def clean(
+        versions: Product,
+        limit: int,
+        index: VersionIndex | None = None,
+        path: str=".",
+        dry_run: bool=False
+) -> List[Removal]:
+    old: Product = Product.of(versions).all_but_newest(limit)
+    removals: List[Removal] = remove_paths(
+        [os.path.join(path,name) for name in old.names],
+        dry_run=dry_run
+    )
+    if index is not None and old and not dry_run:
+        index.update(path,removed=old.names)
+    return removals
+
+"""
+Selects every nth version of the product and copies it to a given
+destination. "nth version" here means that the *version number* is divisble
+by n. Versions which have already been backed up, and not changed since,
+are skipped, as are versions too old to survive the clean below. Also
+deletes older versions in copies directory until only a given number are
+left, using the clean function.
+    @param versions: The versions of the product; the output of get_versions
+    @param regex: the regex used to identify a product file
+    @param config: the section of the configuration used for sample backups.
+        It has the following values:
+            destination: the given directory above
+            frequency: the value of n
+            limit: the maximum number of backups to leave behind
+            hash: (optional) whether to compare file contents when a
+                version's mtime has changed but its size has not
+            checksum: (optional) whether to keep checksums of the backups
+                (see Checksums)
+    @param index: If given, the version index used to list the destination
+        (and to record the changes made to it)
+    @param manifest: If given, the manifest of the destination, which is
+        used to decide what is already backed up. Otherwise, the size & mtime
+        of each existing backup is compared with the version itself
+    @param executor: The executor the copies are made with. Defaults to one
+        with the default number of workers.
+    @param path: The product directory, which the version filenames and
+        the destination are relative to. Defaults to the pwd.
+    @return: How many files/bytes were copied and skipped
+"""
+@traced
+def backup_sample(
+        versions: Product,
+        regex: Pattern,
+        config: dict[str,Any],
+        index: VersionIndex | None = None,
+        manifest: BackupManifest | None = None,
+        executor: CopyExecutor | None = None,
+        path: str="."
+) -> CopyStats:
+    if executor is None:
+        executor = CopyExecutor()
+    backend: LocalBackend | WebDAVBackend = \
+        open_backend(config["destination"],path)
+    try:
+        return backup_sample_to(
+            backend,versions,regex,config,index,manifest,executor,path
+        )
+    finally:
+        backend.close()
+
+"""
+Does the work of backup_sample, through the destination's backend. Only
+plain copies are made in a destination that is not a directory (see
+is_remote). Such a destination is listed through its backend rather than
+indexed, and always has a manifest, read & written in one go, since the
+backups there don't keep the mtimes of what they are copies of.
+"""
+def backup_sample_to(
+        backend: LocalBackend | WebDAVBackend,
+        versions: Product,
+        regex: Pattern,
+        config: dict[str,Any],
+        index: VersionIndex | None,
+        manifest: BackupManifest | None,
+        executor: CopyExecutor,
+        path: str
+) -> CopyStats:
+    remote: bool = not isinstance(backend,LocalBackend)
+    destination: str = \
+        backend.url if remote else os.path.join(path,config["destination"])
+    compression: str | None = config.get("compression")
+    delta_limit: int | None = config.get("delta")
+    if delta_limit is not None and (
+        compression is not None or config.get("store",False)
+    ):
+        raise ValueError(
+            "The delta option cannot be used with compression or store"
+        )
+    checksums: Checksums | None = \
+        Checksums(destination) if config.get("checksum",False) else None
+    existing: Product
+    if remote:
+        listing: dict[str,int | None] = backend.list()
+        existing = listed_backups(listing,regex)
+        index = None
+        manifest = BackupManifest(destination,backend)
+        manifest.prune(list(listing))
+    elif index is not None:
+        existing = index.get_versions(backup_regex(regex),path=destination)
+    else:
+        existing = get_versions(backup_regex(regex),path=destination)
+    existing_names: dict[Version,str] = \
+        {version: name for name,version in reversed(existing)}
+    sampled: Product = Product.of(versions).every(config["frequency"])
+    # versions that would only be cleaned away again straight after being
+    # copied are not worth copying
+    kept: set[Version] = set(heapq.nlargest(
+        config["limit"],set(existing_names) | set(sampled.versions)
+    ))
+    use_hash: bool = config.get("hash",False)
+    stats = CopyStats()
+    jobs: List[Tuple[str,str]] = []
+    job_versions: List[Version] = []
+    for version in sampled:
+        if version[1] not in kept:
+            continue
+        file: str = os.path.join(path,version[0])
+        backup: str = \
+            f"{destination}/{backup_name(file,compression)}"
+        if delta_limit is not None and version[1] in existing_names:
+            # it may have been backed up as a delta
+            backup = f"{destination}/{existing_names[version[1]]}"
+        if manifest is not None:
+            up_to_date: bool = \
+                manifest.is_backed_up(file,backup,use_hash)
+        else:
+            up_to_date = is_same_file_stat(
+                file,backup,compare_size=compression is None
+            )
+        if up_to_date:
+            stats.files_skipped += 1
+            stats.bytes_skipped += os.stat(file).st_size
+            TRACER.count("files_skipped")
+            continue
+        jobs.append((file,backup))
+        job_versions.append(version[1])
+    # the backups actually made, which for deltas differ from those planned
+    made: List[str] = [backup for _,backup in jobs]
+    removed: List[str] = []
+    # existing deltas made into full copies
+    rebased_in_place: List[Tuple[str,Version]] = []
+    # whether backups in the store were replaced, leaving the bodies they
+    # had possibly unused
+    replaced: bool = False
+    if config.get("store",False):
+        store: str = f"{destination}/{STORE_DIR}"
+        replaced = any(os.path.lexists(backup) for _,backup in jobs)
+        stats.bytes_copied += sum(executor.run(
+            lambda file,backup: store_copy(file,backup,store,compression),
+            jobs
+        ))
+    elif compression is not None:
+        stats.bytes_copied += sum(executor.run(
+            lambda file,backup:
+                compress_copy(file,backup,compression,checksums),
+            jobs
+        ))
+    elif delta_limit is not None:
+        # each delta is made against the backup before it, so these are
+        # made one at a time, oldest first
+        backups_by_version: dict[Version,str] = {
+            version: f"{destination}/{name}"
+            for version,name in existing_names.items()
+        }
+        for i in sorted(range(len(jobs)),key=lambda i: job_versions[i]):
+            job_file, backup = jobs[i]
+            if os.path.lexists(backup):
+                # an out of date backup; anything made against it has to
+                # be made whole before it goes
+                for old_name, new_name in rebase_deltas(
+                    destination,[os.path.basename(backup)]
+                ):
+                    removed.append(old_name)
+                    if manifest is not None:
+                        manifest.rename(old_name,new_name)
+                    for version, made_path in backups_by_version.items():
+                        if os.path.basename(made_path) == old_name:
+                            backups_by_version[version] = \
+                                f"{destination}/{new_name}"
+                            rebased_in_place.append((new_name,version))
+                remove_paths([backup])
+                removed.append(os.path.basename(backup))
+            if os.path.isdir(job_file):
+                # deltas are only made of files; a directory product is
+                # copied whole
+                made[i] = f"{destination}/{os.path.basename(job_file)}"
+                backups_by_version[job_versions[i]] = made[i]
+                stats.bytes_copied += \
+                    executor.copy_tree(job_file,made[i],checksums)
+                continue
+            older: List[Version] = [
+                version for version in backups_by_version
+                if version < job_versions[i]
+            ]
+            made[i] = delta_copy(
+                job_file,
+                f"{destination}/{os.path.basename(job_file)}",
+                backups_by_version[max(older)] if older else None,
+                delta_limit
+            )
+            backups_by_version[job_versions[i]] = made[i]
+            stats.bytes_copied += os.stat(made[i]).st_size
+            TRACER.count("files_copied")
+            TRACER.count("bytes_copied",os.stat(made[i]).st_size)
+    else:
+        files: List[Tuple[str,str]] = \
+            [job for job in jobs if not os.path.isdir(job[0])]
+        if checksums is not None:
+            stats.bytes_copied += executor.copy_files(files,checksums)
+        else:
+            stats.bytes_copied += sum(executor.run(
+                backend.put,
+                [(file,os.path.basename(backup)) for file,backup in files]
+            ))
+        # directory products are copied a tree at a time, each of which
+        # copies its files in parallel; oldest first, so that with link
+        # each can be linked to the one before
+        for i in sorted(range(len(jobs)),key=lambda i: job_versions[i]):
+            job_file, backup = jobs[i]
+            if not os.path.isdir(job_file):
+                continue
+            if remote:
+                stats.bytes_copied += backend_put(
+                    backend,job_file,os.path.basename(backup),executor
+                )
+                continue
+            if os.path.lexists(backup):
+                remove_paths([backup])
+            stats.bytes_copied += executor.copy_tree(
+                job_file,
+                backup,
+                checksums,
+                link_source(destination,regex,os.path.basename(job_file))
+                    if config.get("link",False) else None,
+                use_hash
+            )
+    stats.files_copied += len(jobs)
+    if checksums is not None:
+        checksums.save()
+    if manifest is not None:
+        for (job_file,_), backup in zip(jobs,made):
+            manifest.record(job_file,backup,use_hash)
+    copied: List[Tuple[str,Version]] = [
+        (os.path.basename(backup),version)
+        for backup,version in zip(made,job_versions)
+    ] + rebased_in_place
+    if index is not None:
+        index.update(destination,added=copied,removed=removed)
+    with TRACER.stage("clean_backups"):
+        clean_backups_in(
+            backend,regex,config,index,manifest,path,replaced=replaced
+        )
+    return stats
+
+"""
+Deletes the oldest backups in a sample backup destination until only a given
+number are left. Deltas made against the backups being deleted are made
+into full copies first, and afterwards, if any were deleted, anything in the
+destination's store that is no longer used is deleted.
+    @param regex: The regex used to identify product files.
+    @param config: The section of the configuration used for sample backups
+        (see backup_sample).
+    @param index: If given, the version index used to list the destination.
+    @param manifest: If given, the destination's manifest, which is updated
+        to match.
+    @param path: The product directory, which the destination is relative
+        to. Defaults to the pwd.
+    @param dry_run: If true, nothing is changed, and the backups that would
+        be deleted are returned.
+    @return: What was (or would be) deleted; see remove_paths.
+"""
+@traced
+def clean_backups(
+        regex: Pattern,
+        config: dict[str,Any],
+        index: VersionIndex | None = None,
+        manifest: BackupManifest | None = None,
+        path: str=".",
+        dry_run: bool=False
+) -> List[Removal]:
+    backend: LocalBackend | WebDAVBackend = \
+        open_backend(config["destination"],path)
+    try:
+        if not isinstance(backend,LocalBackend) and not dry_run:
+            # see backup_sample_to
+            manifest = BackupManifest(backend.url,backend)
+        return clean_backups_in(
+            backend,regex,config,index,manifest,path,dry_run
+        )
+    finally:
+        backend.close()
+
+"""
+Does the work of clean_backups, through the destination's backend. A
+destination that is not a directory (see is_remote) only has plain copies
+in it, and is listed through its backend; the sizes of directories there
+aren't known.
+    @param replaced: Whether backups in the destination's store have just
+        been replaced (see backup_sample_to). Its unused bodies are only
+        looked for if they have, or if backups are deleted here.
+"""
+def clean_backups_in(
+        backend: LocalBackend | WebDAVBackend,
+        regex: Pattern,
+        config: dict[str,Any],
+        index: VersionIndex | None = None,
+        manifest: BackupManifest | None = None,
+        path: str=".",
+        dry_run: bool=False,
+        replaced: bool=False
+) -> List[Removal]:
+    remote: bool = not isinstance(backend,LocalBackend)
+    destination: str = \
+        backend.url if remote else os.path.join(path,config["destination"])
+    listing: dict[str,int | None] = dict()
+    backups: Product
+    if remote:
+        listing = backend.list()
+        backups = listed_backups(listing,regex)
+    elif not os.path.isdir(destination):
+        return []
+    elif index is None:
+        backups = get_versions(backup_regex(regex),path=destination)
+    else:
+        backups = index.get_versions(backup_regex(regex),path=destination)
+    cut: int = version_cut(backups,config["limit"])
+    removals: List[Removal]
+    if remote:
+        removals = [
+            (f"{destination}/{name}",1,listing[name] or 0)
+            for name,_ in backups[cut:]
+        ]
+        if dry_run:
+            return removals
+        for name, _ in backups[cut:]:
+            backend.delete(name)
+    elif dry_run:
+        return clean(backups,config["limit"],path=destination,dry_run=True)
+    else:
+        # deltas against backups about to be cleaned away are made whole
+        # first
+        rebased: List[Tuple[str,str]] = rebase_deltas(
+            destination,[backup[0] for backup in backups[cut:]]
+        ) if len(backups) > cut else []
+        if rebased:
+            renames: dict[str,str] = dict(rebased)
+            backups = Product(
+                (
+                    (renames.get(name,name),version)
+                    for name,version in backups
+                ),
+                is_sorted=True
+            )
+            if index is not None:
+                index.update(
+                    destination,
+                    removed=list(renames),
+                    added=[
+                        (name,version) for name,version in backups
+                        if name in renames.values()
+                    ]
+                )
+            if manifest is not None:
+                for old_name, new_name in rebased:
+                    manifest.rename(old_name,new_name)
+        removals = clean(backups,config["limit"],index,destination)
+    # finding unused bodies means going through the whole store, so it is
+    # only done when there can be some
+    if config.get("store",False) and (replaced or removals):
+        gc_store(f"{destination}/{STORE_DIR}")
+    if config.get("checksum",False) and len(backups) > cut:
+        Checksums(destination).prune([backup[0] for backup in backups[:cut]])
+    if manifest is not None:
+        manifest.prune([backup[0] for backup in backups[:cut]])
+        manifest.save()
+    return removals
+
+"""
+Whether a backup has the same size & mtime as the file it is a copy of.
+copy_file (and compress_copy) keep mtimes, so this is true of an up-to-date
+backup.
+    @param compare_size: Whether to compare sizes; a compressed backup's
+        size has nothing to do with the original's.
+"""
+def is_same_file_stat(file: str, backup: str, compare_size: bool=True) -> bool:
+    try:
+        backup_stat: os.stat_result = os.stat(backup)
+    except FileNotFoundError:
+        return False
+    file_stat: os.stat_result = os.stat(file)
+    return (
+        (not compare_size or backup_stat.st_size == file_stat.st_size)
+        and backup_stat.st_mtime_ns == file_stat.st_mtime_ns
+    )
+
+"""
+Copies a file (or directory) into a content-addressed store, and makes the
+backup a hardlink to the stored copy. Each distinct file body is stored once,
+under its SHA-256 hash, however many backups have it, so backing up a file
+that is already in the store writes nothing. If hardlinks cannot be made
+in the destination, the stored copy is copied instead.
+    @param file: The path to the file (or directory) to back up.
+    @param backup: The path the backup should have.
+    @param store: The store directory, normally STORE_DIR in the destination.
+    @param compression: If given, file bodies are stored compressed (see
+        compress_copy). Directories are then stored as a single compressed
+        archive, which is not deduplicated.
+    @return: The number of bytes actually written to the store.
+"""
+def store_copy(
+        file: str,
+        backup: str,
+        store: str,
+        compression: str | None = None
+) -> int:
+    import shutil
+    if compression is not None and os.path.isdir(file):
+        return compress_copy(file,backup,compression)
+    if os.path.isdir(file):
+        # an old backup is replaced rather than added to, so that files
+        # deleted from the product don't linger in it (keeping their blobs
+        # alive); the new one is built under a temporary name, so a failed
+        # copy leaves nothing behind
+        if os.path.lexists(backup):
+            remove_paths([backup])
+        tree: str = temp_path(backup)
+        written: int = 0
+        try:
+            for dirpath, _, filenames in os.walk(file):
+                rel_dir: str = os.path.relpath(dirpath,file)
+                os.makedirs(os.path.join(tree,rel_dir),exist_ok=True)
+                for filename in filenames:
+                    written += store_copy(
+                        os.path.join(dirpath,filename),
+                        os.path.join(tree,rel_dir,filename),
+                        store
+                    )
+            shutil.copystat(file,tree)
+            os.rename(tree,backup)
+        except BaseException:
+            shutil.rmtree(tree,ignore_errors=True)
+            raise
+        return written
+    digest: str = hash_file(file)
+    blob: str = f"{store}/{digest[:2]}/{digest}"
+    if compression is not None:
+        blob += COMPRESSIONS[compression][1]
+    written = 0
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob),exist_ok=True)
+        # the blob is written under a temporary name and then linked into
+        # place, so a half-written blob is never mistaken for a whole one,
+        # and if two copies race to store the same body only one wins
+        tmp: str = temp_path(blob)
+        try:
+            if compression is not None:
+                compress_copy(file,tmp,compression)
+            else:
+                copy_file(file,tmp)
+            try:
+                os.link(tmp,blob)
+                written = os.stat(tmp).st_size
+            except FileExistsError:
+                pass
+            except OSError:
+                # no hardlinks on this filesystem
+                os.replace(tmp,blob)
+                written = os.stat(blob).st_size
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if os.path.lexists(backup):
+        if os.path.samefile(blob,backup):
+            return written
+        os.remove(backup)
+    try:
+        os.link(blob,backup)
+    except OSError:
+        copy_file(blob,backup)
+    return written
+
+"""
+Deletes every blob in a content-addressed store that no backup refers to,
+i.e. every blob whose only link is the store's own.
+    @param store: The store directory.
+    @return: The number of blobs deleted.
+"""
+@traced
+def gc_store(store: str) -> int:
+    deleted: int = 0
+    if not os.path.isdir(store):
+        return deleted
+    with os.scandir(store) as subdirs:
+        for subdir in subdirs:
+            if not subdir.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(subdir.path) as blobs:
+                for blob in blobs:
+                    if blob.stat(follow_symlinks=False).st_nlink <= 1:
+                        os.remove(blob.path)
+                        deleted += 1
+    return deleted
+
+"""
+Makes a copy of a given file with a date-time-stamp added to the file's name.
+Note that the stamp is added before the last extension, i.e. before the last
+'.' character.
+    @param file: The path to the given file.
+    @param format: The format of the date-time-stamp.
+    @param now: The datetime to be used for the stamp. Defaults to the
+        present.
+    @param dst: The directory the copy should be placed in. Defaults to the
+        pwd.
+    @param store: Whether the copy should be kept in the content-addressed
+        store in dst (see store_copy).
+    @param executor: The executor the copy is made with. Defaults to one
+        with the default number of workers.
+    @param compression: If given, the copy is compressed (see compress_copy)
+        and gets the matching extension.
+    @param checksum: Whether to add the copy's checksum to dst's checksums
+        (see Checksums).
+    @param link_regex: If given and file is a directory, the files in it
+        which are unchanged since the closest earlier copy in dst matched by
+        this regex (see link_source & release_regex) are hardlinked to that
+        copy's instead of being copied.
+    @param use_hash: See CopyExecutor.copy_tree.
+    @return: The new (absolute) file path.
+"""
+@traced
+def date(
+        file: str,
+        format: str,
+        now: datetime | None = None,
+        dst: str="?",
+        store: bool=False,
+        executor: CopyExecutor | None = None,
+        compression: str | None = None,
+        checksum: bool=False,
+        link_regex: Pattern | None = None,
+        use_hash: bool=False
+) -> str:
+    if now is None:
+        from datetime import datetime
+        now = datetime.now()
+    if dst == "?":
+        dst = os.path.dirname(file)
+    basename: str = os.path.basename(file)
+    ext_index: int = basename.rfind(".")
+    format = now.strftime(format)
+    new_name: str
+    if ext_index == -1:
+        new_name = f"{basename}{format}"
+    else:
+        new_name = f"{basename[:ext_index]}{format}{basename[ext_index:]}"
+    new_name += compressed_extension(file,compression)
+    if executor is None:
+        executor = CopyExecutor()
+    if is_remote(dst):
+        backend: LocalBackend | WebDAVBackend = open_backend(dst)
+        try:
+            backend_put(backend,file,new_name,executor)
+        finally:
+            backend.close()
+        return f"{backend.url}/{new_name}"
+    dst = os.path.abspath(dst)  # note this removes any '/' at the end
+    new_file: str = f"{dst}/{new_name}"
+    checksums: Checksums | None = Checksums(dst) if checksum else None
+    if store:
+        TRACER.count("files_copied")
+        TRACER.count(
+            "bytes_copied",
+            store_copy(file,new_file,f"{dst}/{STORE_DIR}",compression)
+        )
+    elif compression is not None:
+        TRACER.count("files_copied")
+        TRACER.count(
+            "bytes_copied",
+            compress_copy(file,new_file,compression,checksums)
+        )
+    elif os.path.isdir(file):
+        executor.copy_tree(
+            file,
+            new_file,
+            checksums,
+            None if link_regex is None
+                else link_source(dst,link_regex,os.path.basename(file)),
+            use_hash
+        )
+    else:
+        executor.copy_files([(file,new_file)],checksums)
+    if checksums is not None:
+        checksums.save()
+    return new_file
+
+"""
+Whether a backup destination is somewhere other than a directory, i.e. a
+URL with one of the schemes in BACKENDS.
+"""
+def is_remote(destination: str) -> bool:
+    scheme, separator, _ = destination.partition("://")
+    return bool(separator) and scheme in BACKENDS
+
+"""
+Gets the backend which reads & writes a backup destination (see BACKENDS).
+    @param destination: The destination, as given in the configuration.
+    @param path: The product directory, which a destination that is a
+        directory is relative to. Defaults to the pwd.
+"""
+def open_backend(
+        destination: str,
+        path: str="."
+) -> LocalBackend | WebDAVBackend:
+    if is_remote(destination):
+        return BACKENDS[destination.partition("://")[0]](destination)
+    return LocalBackend(os.path.normpath(os.path.join(path,destination)))
+
+"""
+The interface through which backups are copied to a destination, so that
+where they go can be changed without the code making them having to. Names
+are relative to the destination, with / between directories, and the
+directories a name needs are made as it is written. This one is for a
+destination that is a directory.
+"""
+class LocalBackend():
+    """
+        @param directory: The destination directory.
+    """
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.url: str = directory
+
+    """
+    Lists a directory in the destination.
+        @param name: The directory; defaults to the destination itself.
+        @return: The name of everything in it, with its size, or None for
+            directories. Empty if the directory does not exist.
+    """
+    def list(self, name: str="") -> dict[str,int | None]:
+        entries: dict[str,int | None] = dict()
+        try:
+            with os.scandir(os.path.join(self.directory,name)) as scan:
+                for entry in scan:
+                    entries[entry.name] = \
+                        None if entry.is_dir() else entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        return entries
+
+    """
+    Copies a file to the destination.
+        @param file: The path to the file.
+        @param name: Its name in the destination.
+        @return: The number of bytes copied.
+    """
+    def put(self, file: str, name: str) -> int:
+        path: str = os.path.join(self.directory,name)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        return atomic_copy(file,path)
+
+    """
+    Copies a file or directory out of the destination.
+        @param name: Its name in the destination.
+        @param dst: The path of the copy.
+    """
+    def fetch(self, name: str, dst: str):
+        path: str = os.path.join(self.directory,name)
+        if os.path.isdir(path):
+            CopyExecutor().copy_tree(path,dst)
+        else:
+            atomic_copy(path,dst)
+
+    """
+    Gets the contents of a small file, or None if it does not exist.
+    """
+    def read(self, name: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.directory,name),"rb") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    """
+    Replaces the contents of a small file.
+    """
+    def write(self, name: str, data: bytes):
+        path: str = os.path.join(self.directory,name)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmp: str = temp_path(path)
+        with open(tmp,"wb") as fp:
+            fp.write(data)
+        os.replace(tmp,path)
+
+    """
+    Deletes a file or directory, and any directories that leaves empty, up
+    to the destination itself.
+        @return: What was deleted (see remove_paths).
+    """
+    def delete(self, name: str) -> Removal:
+        path: str = os.path.join(self.directory,name)
+        if not os.path.lexists(path):
+            return (path,0,0)
+        removal: Removal = remove_paths([path])[0]
+        parent: str = os.path.dirname(path)
+        while os.path.relpath(parent,self.directory) != ".":
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+        return removal
+
+    def close(self):
+        pass
+
+"""
+A backend (see LocalBackend) for a destination on a WebDAV server, or any
+HTTP server that takes PUT, DELETE, MKCOL, MOVE & PROPFIND requests, given
+as an http:// or https:// URL, optionally with a user name & password in it.
+
+Connections are kept open & reused for as many requests as the server
+allows, from a pool holding one for each thread that has needed one at
+once, so sending many small files pays for one TCP connection (and TLS
+handshake) per thread rather than one per file. Files are streamed from
+disk; files bigger than chunk_size are sent as a series of ranged PUTs to a
+temporary name, which is moved into place once it is whole. RFC 7231 has
+servers refuse ranged PUTs, so with one that does (or that doesn't end up
+with the whole file) big files are sent in one streamed PUT instead, as
+they are from then on. Requests that fail because of the network or the
+server are retried, and if a big file's ranged upload is interrupted it
+carries on from however much the server got.
+"""
+class WebDAVBackend():
+    """
+        @param url: The destination.
+        @param chunk_size: The size of the pieces big files are sent in.
+        @param retries: How many times a failed request is retried.
+        @param retry_delay: How long to wait before the first retry; the
+            wait doubles each time.
+    """
+    def __init__(
+            self,
+            url: str,
+            chunk_size: int=REMOTE_CHUNK_SIZE,
+            retries: int=REMOTE_RETRIES,
+            retry_delay: float=REMOTE_RETRY_DELAY
+    ):
+        import threading
+        from urllib.parse import urlsplit, unquote
+        parts = urlsplit(url)
+        self.https: bool = parts.scheme == "https"
+        self.host: str = parts.hostname or ""
+        self.port: int | None = parts.port
+        # the path of the destination on the server, unquoted
+        self.root: str = unquote(parts.path).rstrip("/")
+        # the scheme, host & port, without the user name & password
+        self.origin: str = \
+            f"{parts.scheme}://{parts.netloc.rpartition('@')[2]}"
+        self.url: str = self.origin + parts.path.rstrip("/")
+        self.headers: dict[str,str] = dict()
+        if parts.username is not None:
+            import base64
+            credentials: bytes = (
+                f"{unquote(parts.username)}:{unquote(parts.password or '')}"
+            ).encode()
+            self.headers["Authorization"] = \
+                f"Basic {base64.b64encode(credentials).decode()}"
+        self.chunk_size: int = chunk_size
+        self.retries: int = retries
+        self.retry_delay: float = retry_delay
+        self.pool: List[Any] = []  # idle connections
+        self.collections: set[str] = set()  # directories known to exist
+        # whether the server takes ranged PUTs, until it turns out not to
+        self.ranged_puts: bool = True
+        self.lock = threading.Lock()
+        # how many connections have been opened, for the curious
+        self.connections: int = 0
+
+    def href(self, name: str) -> str:
+        from urllib.parse import quote
+        return quote(f"{self.root}/{name}" if name else self.root or "/")
+
+    """
+    Sends a request, on a pooled connection, and reads the response.
+    Requests which fail because the connection did, or with a 5xx status,
+    are retried a few times, backing off between tries.
+        @param method: The HTTP method.
+        @param name: What the request is for (see LocalBackend).
+        @param body: The body, as bytes or a file positioned at the start of
+            it; a file is rewound to there for each try.
+        @param headers: Any headers besides the usual ones.
+        @param ok: The statuses which count as success.
+        @param retries: How many times to retry; defaults to self.retries.
+        @param into: If given, a file to write the response body to, instead
+            of returning it.
+        @return: The status, the response headers & the body.
+        @raise ConnectionError: If the request failed every time.
+        @raise OSError: If the server answered with a status not in ok.
+    """
+    def request(
+            self,
+            method: str,
+            name: str,
+            body: Any=None,
+            headers: dict[str,str] | None = None,
+            ok: Tuple[int,...]=(200,201,204),
+            retries: int | None = None,
+            into: Any=None
+    ) -> Tuple[int,Any,bytes]:
+        import http.client
+        import shutil
+        if retries is None:
+            retries = self.retries
+        start: int = body.tell() if hasattr(body,"seek") else 0
+        attempt: int = 0
+        while True:
+            with self.lock:
+                connection: Any = self.pool.pop() if self.pool else None
+            if connection is None:
+                connection_class: type = http.client.HTTPSConnection \
+                    if self.https else http.client.HTTPConnection
+                connection = connection_class(
+                    self.host,
+                    self.port,
+                    timeout=REMOTE_TIMEOUT,
+                    blocksize=COPY_BUFSIZE
+                )
+                with self.lock:
+                    self.connections += 1
+            problem: str
+            try:
+                if hasattr(body,"seek"):
+                    body.seek(start)
+                if into is not None:
+                    into.seek(0)
+                    into.truncate()
+                connection.request(
+                    method,
+                    self.href(name),
+                    body=body,
+                    headers=self.headers | (headers or {})
+                )
+                response: Any = connection.getresponse()
+                data: bytes = b""
+                if into is not None and response.status in ok:
+                    shutil.copyfileobj(response,into,COPY_BUFSIZE)
+                else:
+                    data = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                connection.close()
+                problem = str(err) or type(err).__name__
+            else:
+                if response.will_close:
+                    connection.close()
+                else:
+                    with self.lock:
+                        self.pool.append(connection)
+                if response.status in ok:
+                    return response.status, response.headers, data
+                if response.status < 500:
+                    raise OSError(
+                        f"{method} {self.url}/{name}: "
+                        + f"{response.status} {response.reason}"
+                    )
+                problem = f"{response.status} {response.reason}"
+            if attempt >= retries:
+                raise ConnectionError(f"{method} {self.url}/{name}: {problem}")
+            time.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+
+    """
+    Lists the directory name, or gives (name, its size) if it is a file.
+    """
+    def propfind(
+            self,
+            name: str,
+            depth: int
+    ) -> dict[str,int | None] | Tuple[str,int]:
+        import xml.etree.ElementTree as ET
+        from urllib.parse import urlsplit, unquote
+        status, _, data = self.request(
+            "PROPFIND",
+            name,
+            b'<?xml version="1.0"?><propfind xmlns="DAV:"><prop>'
+            + b"<resourcetype/><getcontentlength/></prop></propfind>",
+            {"Depth": str(depth),"Content-Type": "application/xml"},
+            ok=(207,404)
+        )
+        entries: dict[str,int | None] = dict()
+        if status == 404:
+            return entries
+        base: str = f"{self.root}/{name}".rstrip("/")
+        for response in ET.fromstring(data).iter("{DAV:}response"):
+            path: str = \
+                unquote(urlsplit(response.findtext("{DAV:}href","")).path)
+            size: int | None = None
+            if response.find(".//{DAV:}collection") is None:
+                size = int(response.findtext(".//{DAV:}getcontentlength","0"))
+            if path.rstrip("/") == base:
+                if size is not None:
+                    return name, size
+                continue
+            entries[path.rstrip("/").rpartition("/")[2]] = size
+        return entries
+
+    def list(self, name: str="") -> dict[str,int | None]:
+        entries: dict[str,int | None] | Tuple[str,int] = \
+            self.propfind(name,1)
+        return entries if isinstance(entries,dict) else dict()
+
+    """
+    Makes the directories which name is in, if they haven't been already.
+    """
+    def make_collections(self, name: str):
+        parts: List[str] = name.split("/")[:-1]
+        for i in range(len(parts) + 1):
+            collection: str = "/".join(parts[:i])
+            with self.lock:
+                if collection in self.collections:
+                    continue
+            # 405 means it is already there
+            self.request("MKCOL",collection,ok=(200,201,405))
+            with self.lock:
+                self.collections.add(collection)
+
+    def put(self, file: str, name: str) -> int:
+        size: int = os.stat(file).st_size
+        self.make_collections(name)
+        with open(file,"rb") as fp:
+            if size <= self.chunk_size or not self.ranged_puts:
+                self.request("PUT",name,fp,{"Content-Length": str(size)})
+                return size
+            head, _, tail = name.rpartition("/")
+            part: str = f"{head}/.{tail}.phase-part".lstrip("/")
+            self.request("DELETE",part,ok=(200,204,404))
+            offset: int = 0
+            failures: int = 0
+            while offset < size and self.ranged_puts:
+                end: int = min(offset + self.chunk_size,size)
+                fp.seek(offset)
+                try:
+                    status, _, _ = self.request(
+                        "PUT",
+                        part,
+                        fp.read(end - offset),
+                        {"Content-Range": f"bytes {offset}-{end - 1}/{size}"},
+                        ok=(200,201,204,400,501),
+                        retries=0
+                    )
+                    offset = end
+                    # 400 is what RFC 7231 says to refuse them with
+                    self.ranged_puts = status not in (400,501)
+                except ConnectionError:
+                    if failures >= self.retries:
+                        raise
+                    time.sleep(self.retry_delay * 2 ** failures)
+                    failures += 1
+                    # carry on from whatever the server got
+                    offset = self.size(part)
+            # a server that ignores Content-Range is left with only the last
+            # piece, so check the whole file got there
+            if self.ranged_puts and self.size(part) != size:
+                self.ranged_puts = False
+            if not self.ranged_puts:
+                self.request("DELETE",part,ok=(200,204,404))
+                fp.seek(0)
+                self.request("PUT",name,fp,{"Content-Length": str(size)})
+                return size
+        self.request(
+            "MOVE",
+            part,
+            headers={
+                "Destination": self.origin + self.href(name),
+                "Overwrite": "T",
+            },
+            ok=(201,204)
+        )
+        return size
+
+    """
+    The size of a file, or 0 if it doesn't exist.
+    """
+    def size(self, name: str) -> int:
+        status, headers, _ = self.request("HEAD",name,ok=(200,404))
+        return int(headers.get("Content-Length","0")) if status == 200 else 0
+
+    def fetch(self, name: str, dst: str):
+        import shutil
+        entries: dict[str,int | None] | Tuple[str,int] = \
+            self.propfind(name,1)
+        if isinstance(entries,tuple):
+            tmp: str = temp_path(dst)
+            try:
+                with open(tmp,"wb") as fp:
+                    self.request("GET",name,into=fp)
+                os.replace(tmp,dst)
+            except BaseException:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                raise
+            return
+        os.mkdir(dst)
+        try:
+            for child in entries:
+                self.fetch(f"{name}/{child}",os.path.join(dst,child))
+        except BaseException:
+            shutil.rmtree(dst,ignore_errors=True)
+            raise
+
+    def read(self, name: str) -> bytes | None:
+        status, _, data = self.request("GET",name,ok=(200,404))
+        return data if status == 200 else None
+
+    def write(self, name: str, data: bytes):
+        self.make_collections(name)
+        self.request("PUT",name,data)
+
+    def delete(self, name: str) -> Removal:
+        self.request("DELETE",name,ok=(200,204,404))
+        TRACER.count("entries_deleted")
+        return (f"{self.url}/{name}",1,0)
+
+    def close(self):
+        with self.lock:
+            for connection in self.pool:
+                connection.close()
+            self.pool.clear()
+
+# The backend used for each kind of URL that a backup destination can be
+# given as; other destinations are directories, and use LocalBackend
+BACKENDS: dict[str,type[WebDAVBackend]] = {
+    "http": WebDAVBackend,
+    "https": WebDAVBackend,
+}
+
+"""
+Copies a file or directory to a backend, copying a directory's files in
+parallel. A directory replaces any that was there before.
+    @param backend: The backend (see LocalBackend).
+    @param file: The file or directory to copy.
+    @param name: Its name in the destination.
+    @param executor: The CopyExecutor to copy with.
+    @return: The number of bytes copied.
+"""
+def backend_put(
+        backend: LocalBackend | WebDAVBackend,
+        file: str,
+        name: str,
+        executor: CopyExecutor
+) -> int:
+    if not os.path.isdir(file):
+        return sum(executor.run(backend.put,[(file,name)]))
+    backend.delete(name)
+    jobs: List[Tuple[str,str]] = []
+    for dirpath, _, filenames in os.walk(file,followlinks=True):
+        rel_dir: str = os.path.relpath(dirpath,file)
+        for filename in filenames:
+            jobs.append((
+                os.path.join(dirpath,filename),
+                f"{name}/{filename}" if rel_dir == "."
+                    else f"{name}/{rel_dir}/{filename}",
+            ))
+    return sum(executor.run(backend.put,jobs))
+
+"""
+Picks out the backups of a product from a listing of a destination (see
+LocalBackend.list), sorted as by get_versions.
+    @param regex: The regex used to identify product files.
+"""
+def listed_backups(listing: dict[str,int | None], regex: Pattern) -> Product:
+    regex = backup_regex(regex)
+    backups = Product()
+    for name in listing:
+        match: Match[str] | None = regex.fullmatch(name)
+        if match is not None:
+            backups.append(name,match_version(match))
+    return backups
+
+"""
+Makes a destination an up to date copy of a directory, like rsync or rclone
+sync, for phase backup --all. What has been copied is recorded in a
+SYNC_MANIFEST_FILE in the destination, with the size & mtime each file had,
+so only files which are new or have changed since the last sync are copied
+(in parallel), and the destination is never listed, which is what makes
+syncing to a slow network mount or a server quick. Changes made to the
+destination by anything else are not noticed; delete the manifest to copy
+everything again.
+    @param src: The directory to copy. If dst is inside it, dst is left out.
+    @param dst: The directory to copy to, made if need be, or a URL (see
+        open_backend).
+    @param mirror: Whether to also delete files that have been synced before
+        but are no longer in src. Only files phase synced are ever deleted.
+    @param executor: The CopyExecutor to use. Defaults to a new one with the
+        default number of workers.
+    @return: What was copied & skipped, and what was deleted (see
+        remove_paths).
+"""
+@traced
+def sync_tree(
+        src: str,
+        dst: str,
+        mirror: bool=False,
+        executor: CopyExecutor | None = None
+) -> Tuple[CopyStats,List[Removal]]:
+    if executor is None:
+        executor = CopyExecutor()
+    src = os.path.abspath(src)
+    backend: LocalBackend | WebDAVBackend = open_backend(dst)
+    try:
+        return sync_to_backend(src,backend,mirror,executor)
+    finally:
+        backend.close()
+
+"""
+Does the work of sync_tree, through the destination's backend.
+"""
+def sync_to_backend(
+        src: str,
+        backend: LocalBackend | WebDAVBackend,
+        mirror: bool,
+        executor: CopyExecutor
+) -> Tuple[CopyStats,List[Removal]]:
+    # relative path -> [size, mtime in ns] of the source when it was copied
+    entries: dict[str,List[int]] = dict()
+    try:
+        entries = json.loads(backend.read(SYNC_MANIFEST_FILE) or b"{}")
+    except ValueError:
+        pass
+    stats = CopyStats()
+    # relative path -> [size, mtime in ns] of every file in src
+    found: dict[str,List[int]] = dict()
+    # a local dst is recognised by its inode, which scandir gives for free
+    excluded: Tuple[int,int] | None = None
+    if isinstance(backend,LocalBackend):
+        try:
+            dst_stat: os.stat_result = os.stat(backend.directory)
+            excluded = (dst_stat.st_ino,dst_stat.st_dev)
+        except FileNotFoundError:
+            pass
+    dirs: List[str] = [src]
+    while dirs:
+        with os.scandir(dirs.pop()) as scan:
+            for entry in scan:
+                if entry.is_dir(follow_symlinks=False):
+                    if excluded is None or entry.inode() != excluded[0] or \
+                            entry.stat(follow_symlinks=False).st_dev \
+                            != excluded[1]:
+                        dirs.append(entry.path)
+                    continue
+                # left by copies which are still running (or were stopped)
+                if ".phase-tmp-" in entry.name:
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    entry_stat: os.stat_result = entry.stat()
+                except OSError:
+                    # e.g. deleted since the directory was listed
+                    continue
+                found[os.path.relpath(entry.path,src)] = \
+                    [entry_stat.st_size,entry_stat.st_mtime_ns]
+    TRACER.count("files_scanned",len(found))
+    removals: List[Removal] = []
+    if mirror:
+        for rel in [rel for rel in entries if rel not in found]:
+            removals.append(backend.delete(rel))
+            del entries[rel]
+    jobs: List[Tuple[str,str]] = []
+    for rel, entry_stat in found.items():
+        if entries.get(rel) == entry_stat:
+            stats.files_skipped += 1
+            stats.bytes_skipped += entry_stat[0]
+            continue
+        jobs.append((os.path.join(src,rel),rel))
+    TRACER.count("files_skipped",stats.files_skipped)
+    def sync_file(file: str, rel: str) -> int:
+        written: int = backend.put(file,rel)
+        # the size & mtime from before the copy, so that a file changed
+        # while it was being copied is copied again next time
+        entries[rel] = found[rel]
+        return written
+    try:
+        stats.bytes_copied = sum(executor.run(sync_file,jobs))
+        stats.files_copied = len(jobs)
+    finally:
+        # what was copied before any failure is not copied again
+        backend.write(SYNC_MANIFEST_FILE,json.dumps(entries).encode())
+    return stats, removals
+
+"""
+Finds every product (directory with a .phase file) in a directory tree.
+Hidden directories, like backup stores, are not searched, and nor are
+backup --all destinations (see sync_tree), which hold copies of products.
+    @param root: The directory to search.
+    @return: The product directories, in sorted order.
+"""
+def find_products(root: str) -> List[str]:
+    products: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if SYNC_MANIFEST_FILE in filenames:
+            dirnames[:] = []
+            continue
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        if ".phase" in filenames:
+            products.append(dirpath)
+    products.sort()
+    return products
+
+"""
+Runs one command on one product, for a batch. Unlike main, this leaves the
+pwd alone, so that several products can be processed at once.
+    @param product_path: The product directory.
+    @param action: The command: DEFAULT (sample backups & clean), BACKUP or
+        CLEAN.
+    @param backup_action: For BACKUP, which kind of backup to make.
+    @param dry_run: For CLEAN, whether to only work out what would be deleted.
+    @param wait: Whether to wait for another phase making sample backups of,
+        or cleaning, the product (see ProductLock).
+    @return: A one line summary of what was done.
+    @raise BlockingIOError: If wait is False and another phase is.
+"""
+@traced
+def process_product(
+        product_path: str,
+        action: Action,
+        backup_action: BackupAction | None = None,
+        dry_run: bool=False,
+        wait: bool=True
+) -> str:
+    stages: List[str] = maintenance_stages(action,backup_action,dry_run)
+    if not stages:
+        return apply_action(product_path,action,backup_action,dry_run)
+    with ProductLock(product_path,stages,wait) as lock:
+        match lock.result:
+            case LockResult.BUSY:
+                raise BlockingIOError(
+                    errno.EWOULDBLOCK,
+                    "another phase is working on the product",
+                    product_path
+                )
+            case LockResult.DONE:
+                return "skipped, just done by another phase"
+        return apply_action(product_path,action,backup_action,dry_run)
+
+"""
+Does the work of process_product, with the product's lock already held if
+it is needed.
+"""
+def apply_action(
+        product_path: str,
+        action: Action,
+        backup_action: BackupAction | None = None,
+        dry_run: bool=False
+) -> str:
+    import subprocess
+    config: dict[str,Any] = load_config(product_path)
+    index = VersionIndex(os.path.join(product_path,INDEX_FILE))
+    executor = CopyExecutor(config["performance"]["copy_workers"])
+    newest: int | None = None
+    if action == Action.BACKUP and backup_action != BackupAction.SAMPLE:
+        newest = 1
+    versions: Product = \
+        index.get_versions(config["regex"],newest,path=product_path)
+    sample_config: dict[str,Any] = config["backup"]["sample"]
+    sample_destination: str = \
+        os.path.join(product_path,sample_config["destination"])
+    summary: str
+    match action, backup_action:
+        case Action.BACKUP, BackupAction.ALL \
+                if config["backup"]["all"].get("destination") is not None:
+            sync_destination: str = config["backup"]["all"]["destination"]
+            sync_stats, sync_removals = sync_tree(
+                product_path,
+                sync_destination if is_remote(sync_destination)
+                    else os.path.join(product_path,sync_destination),
+                config["backup"]["all"].get("mirror",False),
+                executor
+            )
+            summary = f"synced: {sync_stats}" + (
+                f", deleted {format_removals(sync_removals)}"
+                if sync_removals else ""
+            )
+        case Action.BACKUP, BackupAction.ALL:
+            cmd: str = config["backup"]["all"]["cmd"]
+            result = subprocess.run(
+                cmd,
+                shell=True,
+                cwd=product_path,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE
+            )
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"{cmd} exited with status {result.returncode}: "
+                    + result.stderr.decode(errors="replace").strip()
+                )
+            summary = f"ran {cmd}"
+        case Action.BACKUP, BackupAction.RELEASE:
+            if not versions:
+                return "no product files"
+            release_config: dict[str,Any] = config["backup"]["release"]
+            new_names: List[str] = [
+                date(
+                    os.path.join(product_path,version[0]),
+                    release_config["format"],
+                    dst=release_config["destination"]
+                        if is_remote(release_config["destination"])
+                        else os.path.join(
+                            product_path,release_config["destination"]
+                        ),
+                    store=release_config.get("store",False),
+                    executor=executor,
+                    compression=release_config.get("compression"),
+                    checksum=release_config.get("checksum",False),
+                    link_regex=release_regex(config["patterns"])
+                        if release_config.get("link",False) else None,
+                    use_hash=release_config.get("hash",False)
+                )
+                for version in versions.newest(1)
+            ]
+            summary = "released " + ", ".join(
+                os.path.basename(new_name) for new_name in new_names
+            )
+        case Action.CLEAN, _:
+            removals: List[Removal] = \
+                clean(versions,config["limit"],index,product_path,dry_run)
+            backup_removals: List[Removal] = clean_backups(
+                config["regex"],
+                sample_config,
+                index,
+                None if dry_run else BackupManifest(sample_destination),
+                product_path,
+                dry_run
+            )
+            summary = (
+                f"{'would delete' if dry_run else 'deleted'} "
+                + f"{len(removals)} versions & {len(backup_removals)} backups, "
+                + format_removals(removals + backup_removals)
+            )
+        case _:
+            stats: CopyStats = backup_sample(
+                versions,
+                config["regex"],
+                sample_config,
+                index,
+                BackupManifest(sample_destination),
+                executor,
+                product_path
+            )
+            registry_backed_up(product_path,versions,stats)
+            summary = f"sample backups: {stats}"
+            if action != Action.BACKUP:
+                clean(versions,config["limit"],index,product_path)
+                summary += (
+                    f", deleted {count_old_versions(versions,config['limit'])}"
+                    + " versions"
+                )
+    index.save()
+    return summary
+
+"""
+Runs process_product with tracing on, for a batch being traced. The product
+is processed in another process, so what is recorded is returned along with
+the summary, to be reported by the process running the batch.
+    @param start: The start time of the batch's tracer, which the times
+        recorded are taken relative to.
+    @return: The summary, and the records made.
+"""
+def trace_product(
+        start: float,
+        product_path: str,
+        action: Action,
+        backup_action: BackupAction | None = None,
+        dry_run: bool=False
+) -> Tuple[str,List[dict[str,Any]]]:
+    TRACER.enable(product=product_path,pid=os.getpid())
+    TRACER.start = start
+    summary: str = process_product(product_path,action,backup_action,dry_run)
+    return summary, [TRACER.context | record for record in TRACER.records]
+
+"""
+Runs one command on every product in a directory tree, several products at
+a time in separate processes, and prints a summary line for each. A product
+that fails does not stop the others.
+    @param root: The directory to search for products (see find_products).
+    @param action: The command (see process_product).
+    @param backup_action: For BACKUP, which kind of backup to make.
+    @param jobs: How many products to process at once.
+    @param dry_run: See process_product.
+    @param products: The products to process instead of those in root, e.g.
+        the registered ones. They are named by their full paths.
+    @return: The number of products that failed.
+"""
+def run_batch(
+        root: str,
+        action: Action,
+        backup_action: BackupAction | None = None,
+        jobs: int = 1,
+        dry_run: bool=False,
+        products: List[str] | None = None
+) -> int:
+    from concurrent.futures import ProcessPoolExecutor
+    named_by_path: bool = products is not None
+    if products is None:
+        products = find_products(root)
+    failures: int = 0
+    if not products:
+        print(
+            "No products registered" if named_by_path
+            else f"No products found in {root}"
+        )
+        return failures
+    start: float = time.monotonic()
+    with ProcessPoolExecutor(max_workers=min(jobs,len(products))) as pool:
+        futures: List[Future] = [
+            pool.submit(
+                trace_product,TRACER.start,product,action,backup_action,dry_run
+            ) if TRACER.enabled else
+            pool.submit(process_product,product,action,backup_action,dry_run)
+            for product in products
+        ]
+        for product, future in zip(products,futures):
+            name: str = \
+                product if named_by_path else os.path.relpath(product,root)
+            try:
+                summary: str = future.result()
+                if TRACER.enabled:
+                    summary, records = summary
+                    for record in records:
+                        if record["depth"] == 0:
+                            for count, value in record["counts"].items():
+                                TRACER.count(count,value)
+                        record["depth"] += len(TRACER.stack)
+                        TRACER.records.append(record)
+                print(f"\x1b[1m{name}\x1b[0m: {summary}")
+            except Exception as err:
+                failures += 1
+                print(
+                    f"\x1b[1m{name}\x1b[0m: \x1b[1;31mPhase Error: "
+                    + f"{type(err).__name__}: {err}\x1b[0m",
+                    file=sys.stderr
+                )
+    print(
+        f"{len(products) - failures} of {len(products)} products done in "
+        + f"{time.monotonic() - start:.1f}s"
+    )
+    return failures
+
+"""
+What came of trying to take a product's lock (see ProductLock).
+"""
+@enum.unique
+class LockResult(enum.Enum):
+    # the lock is held, and the work should be done
+    ACQUIRED = "acquired"
+    # another phase holds the lock, and this one was told not to wait
+    BUSY = "busy"
+    # the lock is held, but another phase did the same work while this one
+    # was waiting for it, and nothing has changed since
+    DONE = "done"
+
+"""
+The stages of a command that change a product's versions or sample
+backups, which only one phase at a time should run on a product.
+    @param action: The command (see process_product).
+    @param backup_action: For BACKUP, which kind of backup to make.
+    @param dry_run: For CLEAN, whether only to work out what would be
+        deleted.
+    @return: The names of the stages, or nothing if the command does not
+        need the product's lock.
+"""
+def maintenance_stages(
+        action: Action,
+        backup_action: BackupAction | None = None,
+        dry_run: bool=False
+) -> List[str]:
+    match action, backup_action:
+        case Action.DEFAULT, _:
+            return ["backup_sample","clean"]
+        case Action.BACKUP, BackupAction.SAMPLE | None:
+            return ["backup_sample"]
+        case Action.CLEAN, _ if not dry_run:
+            return ["clean","clean_backups"]
+    return []
+
+"""
+A lock on a product's MAINTENANCE_LOCK_FILE, held while its sample backups
+are made or it is cleaned, so that two phases (e.g. one opened from the
+desktop & one run by cron) don't copy the same files twice or delete each
+other's files part way through. The lock is taken with flock, so it is let
+go of when the process holding it exits, however that happens.
+
+The lock file also records the last run to finish: which stages it ran,
+and the mtimes of the product directory & its .phase file afterwards. A
+phase which had to wait for the lock skips its work if the one it waited
+for did the same stages and nothing has been saved, deleted or configured
+since.
+"""
+class ProductLock():
+    """
+        @param product_path: The product directory.
+        @param stages: What is going to be done while the lock is held (see
+            maintenance_stages).
+        @param wait: Whether to wait for another phase to let go of the
+            lock, rather than give up.
+        @param verbose: Whether to say so on stderr when having to wait.
+    """
+    def __init__(
+            self,
+            product_path: str,
+            stages: List[str],
+            wait: bool=True,
+            verbose: bool=False
+    ):
+        self.product_path: str = product_path
+        self.stages: List[str] = stages
+        self.wait: bool = wait
+        self.verbose: bool = verbose
+        self.fd: int = -1
+        self.result: LockResult = LockResult.BUSY
+
+    """
+    Takes the lock, or gives up if wait is False and another phase holds it.
+        @return: What happened, which is also kept as result. The lock file
+            stays open until release, even if the lock was not taken.
+    """
+    def acquire(self) -> LockResult:
+        self.fd = os.open(
+            os.path.join(self.product_path,MAINTENANCE_LOCK_FILE),
+            os.O_RDWR | os.O_CREAT | os.O_CLOEXEC
+        )
+        try:
+            fcntl.flock(self.fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.result = LockResult.ACQUIRED
+            return self.result
+        except BlockingIOError:
+            if not self.wait:
+                self.result = LockResult.BUSY
+                return self.result
+        before: dict[str,Any] = self.read()
+        if self.verbose:
+            print(
+                "Waiting for another phase to finish with "
+                + f"{os.path.abspath(self.product_path)}...",
+                file=sys.stderr
+            )
+        with TRACER.stage("lock wait"):
+            fcntl.flock(self.fd,fcntl.LOCK_EX)
+        last: dict[str,Any] = self.read()
+        if (
+            self.stages
+            and last.get("generation") != before.get("generation")
+            and set(self.stages) <= set(last.get("stages",[]))
+            and last.get("state") == self.state()
+        ):
+            self.result = LockResult.DONE
+        else:
+            self.result = LockResult.ACQUIRED
+        return self.result
+
+    """
+    Lets go of the lock.
+        @param completed: Whether the work was done, in which case it is
+            recorded for any phase waiting to do the same.
+    """
+    def release(self, completed: bool=False):
+        if self.fd < 0:
+            return
+        try:
+            if completed and self.result == LockResult.ACQUIRED \
+                    and self.stages:
+                record: dict[str,Any] = {
+                    "generation": self.read().get("generation",0) + 1,
+                    "stages": self.stages,
+                    "state": self.state(),
+                    "time": time.time(),
+                }
+                data: bytes = json.dumps(record).encode()
+                os.ftruncate(self.fd,len(data))
+                os.pwrite(self.fd,data,0)
+        finally:
+            os.close(self.fd)
+            self.fd = -1
+
+    """
+    Reads the record of the last run to finish, or an empty dict if there
+    isn't one (or it is being written).
+    """
+    def read(self) -> dict[str,Any]:
+        try:
+            record: Any = json.loads(os.pread(self.fd,4096,0) or b"{}")
+            return record if isinstance(record,dict) else dict()
+        except (OSError, ValueError):
+            return dict()
+
+    """
+    The mtimes which change when a product file is saved or deleted, or the
+    product is configured differently.
+    """
+    def state(self) -> List[int | None]:
+        mtimes: List[int | None] = []
+        for path in [
+            self.product_path,os.path.join(self.product_path,".phase")
+        ]:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return mtimes
+
+    def __enter__(self) -> "ProductLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type: type | None, *_: Any):
+        self.release(completed=exc_type is None)
+
+"""
+Makes sample backups of a product & cleans it in a detached process, which
+carries on after phase exits (see run_maintenance).
+    @param product_path: The (absolute) product directory.
+"""
+def maintain_in_background(product_path: str):
+    # anything buffered would otherwise be written twice
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid: int = os.fork()
+    if pid != 0:
+        os.waitpid(pid,0)
+        return
+    try:
+        # fork again so the worker is not a child of this session, and is
+        # not killed along with whatever launched phase
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        null_fd: int = os.open(os.devnull,os.O_RDWR)
+        for fd in [0,1,2]:
+            os.dup2(null_fd,fd)
+        run_maintenance(product_path)
+    finally:
+        os._exit(0)
+
+"""
+Makes sample backups of a product & cleans it, the same as phase does
+before opening it, and appends a line about what was done to the product's
+MAINTENANCE_LOG_FILE. The product's lock is held while this runs; if
+another phase already holds it, nothing is done, since that one will do
+the same work.
+    @param product_path: The product directory.
+    @return: Whether the backups & clean were run.
+"""
+def run_maintenance(product_path: str) -> bool:
+    start: float = time.monotonic()
+    message: str
+    try:
+        message = process_product(product_path,Action.DEFAULT,wait=False)
+    except BlockingIOError:
+        log_maintenance(product_path,"skipped, already running")
+        return False
+    except Exception as err:
+        message = f"Phase Error: {type(err).__name__}: {err}"
+    log_maintenance(
+        product_path,f"{message} ({time.monotonic() - start:.1f}s)"
+    )
+    return True
+
+"""
+Appends a time-stamped line to a product's MAINTENANCE_LOG_FILE, starting
+the log again once it gets too big.
+"""
+def log_maintenance(product_path: str, message: str):
+    from datetime import datetime
+    log_path: str = os.path.join(product_path,MAINTENANCE_LOG_FILE)
+    mode: str = "a"
+    try:
+        if os.stat(log_path).st_size > MAINTENANCE_LOG_MAX_SIZE:
+            mode = "w"
+    except FileNotFoundError:
+        pass
+    with open(log_path,mode,encoding="utf8") as fp:
+        fp.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} {message}\n")
+
+"""
+A minimal binding of Linux's inotify API, through ctypes.
+"""
+class Inotify():
+    """
+    Raises OSError if inotify is not available.
+    """
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc_name: str | None = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS,"libc not found")
+        libc = ctypes.CDLL(libc_name,use_errno=True)
+        try:
+            self.add_watch_func = libc.inotify_add_watch
+            init1 = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS,"inotify not supported")
+        self.add_watch_func.argtypes = \
+            [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+        self.fd: int = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+
+    """
+    Starts watching a directory.
+        @param mask: The events to watch for, a combination of IN_* values.
+        @return: The watch descriptor events on this directory will have.
+    """
+    def add_watch(self, path: str, mask: int) -> int:
+        import ctypes
+        wd: int = self.add_watch_func(self.fd,os.fsencode(path),mask)
+        if wd < 0:
+            err: int = ctypes.get_errno()
+            raise OSError(err,os.strerror(err),path)
+        return wd
+
+    """
+    Reads all the events that have happened, without waiting for more.
+        @return: (watch descriptor, mask, filename) for each event.
+    """
+    def read_events(self) -> List[Tuple[int,int,str]]:
+        import struct
+        events: List[Tuple[int,int,str]] = []
+        while True:
+            try:
+                buffer: bytes = os.read(self.fd,64 * 1024)
+            except BlockingIOError:
+                return events
+            offset: int = 0
+            while offset < len(buffer):
+                wd, mask, _, name_len = \
+                    struct.unpack_from("iIII",buffer,offset)
+                offset += 16
+                name: bytes = buffer[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                events.append((wd,mask,os.fsdecode(name)))
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+"""
+Whether a phase watch is running for a product.
+    @param product_path: The product directory.
+"""
+def is_watched(product_path: str) -> bool:
+    try:
+        fd: int = os.open(
+            os.path.join(product_path,WATCH_LOCK_FILE),os.O_RDONLY
+        )
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd,fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+"""
+Watches a set of products, and makes sample backups & cleans each one
+shortly after new versions of it are saved. Changes are noticed with
+inotify where possible, or else by rescanning each product now and then.
+Changes to a product are debounced: nothing is done until WATCH_DEBOUNCE
+seconds pass without another, and then only the versions that changed are
+backed up, all at once.
+"""
+class ProductWatcher():
+    """
+        @param debounce: How long to wait for changes to a product to stop.
+        @param use_inotify: Whether to use inotify, if it is available.
+        @param poll_interval: How often products are rescanned, if not.
+        @param log: Where to write a line about each product maintained.
+    """
+    def __init__(
+            self,
+            debounce: float=WATCH_DEBOUNCE,
+            use_inotify: bool=True,
+            poll_interval: float=WATCH_POLL_INTERVAL,
+            log: TextIO | None = None
+    ):
+        self.debounce: float = debounce
+        self.poll_interval: float = poll_interval
+        self.log: TextIO = log if log is not None else sys.stdout
+        self.configs: dict[str,dict[str,Any]] = dict()
+        self.locks: dict[str,int] = dict()
+        # product -> the versions changed since it was last maintained, or
+        # None if every version needs checking
+        self.pending: dict[str,set[Version] | None] = dict()
+        self.deadlines: dict[str,float] = dict()
+        self.inotify: Inotify | None = None
+        self.watches: dict[int,str] = dict()
+        # product -> {filename: (mtime, size)} as of the last poll
+        self.snapshots: dict[str,dict[str,Tuple[int,int]]] = dict()
+        self.next_poll: float = 0
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError:
+                self.inotify = None
+
+    """
+    Starts watching a product, and takes the lock that tells phase it is
+    being watched. Everything about the product is checked straight away,
+    to catch anything saved while it was not being watched.
+        @param product_path: The (absolute) product directory.
+        @raise FileNotFoundError: If it has no .phase file.
+        @raise BlockingIOError: If it is already being watched.
+    """
+    def add_product(self, product_path: str):
+        self.configs[product_path] = load_config(product_path)
+        lock_fd: int = os.open(
+            os.path.join(product_path,WATCH_LOCK_FILE),
+            os.O_RDWR | os.O_CREAT | os.O_CLOEXEC
+        )
+        try:
+            fcntl.flock(lock_fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            raise
+        self.locks[product_path] = lock_fd
+        if self.inotify is not None:
+            wd: int = self.inotify.add_watch(
+                product_path,IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            )
+            self.watches[wd] = product_path
+        else:
+            self.snapshots[product_path] = self.snapshot(product_path)
+        # nothing is being saved that has not been already, so there is no
+        # need to wait
+        self.mark(product_path,None,time.monotonic())
+        self.deadlines[product_path] = time.monotonic()
+
+    """
+    Records that a product has changed, and (re)starts its debounce timer.
+        @param version: The version that changed, or None if every version
+            should be checked.
+    """
+    def mark(self, product_path: str, version: Version | None, now: float):
+        if product_path in self.pending:
+            versions: set[Version] | None = self.pending[product_path]
+            if versions is not None and version is not None:
+                versions.add(version)
+            elif version is None:
+                self.pending[product_path] = None
+        else:
+            self.pending[product_path] = \
+                None if version is None else {version}
+        self.deadlines[product_path] = now + self.debounce
+
+    """
+    Handles a file in a product being written, created or moved in.
+    """
+    def notice(self, product_path: str, name: str, now: float):
+        if name == ".phase":
+            try:
+                self.configs[product_path] = load_config(product_path)
+            except (OSError, ValueError):
+                return
+            self.mark(product_path,None,now)
+            return
+        version: Version | None = \
+            VersionMatcher(self.configs[product_path]["regex"]).version(name)
+        if version is not None:
+            self.mark(product_path,version,now)
+
+    """
+    Lists the product files in a product, with their mtimes & sizes, for
+    polling.
+    """
+    def snapshot(self, product_path: str) -> dict[str,Tuple[int,int]]:
+        matcher = VersionMatcher(self.configs[product_path]["regex"])
+        files: dict[str,Tuple[int,int]] = dict()
+        with os.scandir(product_path) as entries:
+            for entry in entries:
+                if matcher.version(entry.name) is None:
+                    continue
+                try:
+                    stat: os.stat_result = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files[entry.name] = (stat.st_mtime_ns,stat.st_size)
+        return files
+
+    """
+    Waits up to timeout seconds for products to change, and records any
+    changes.
+    """
+    def wait(self, timeout: float):
+        import select
+        if self.inotify is None:
+            time.sleep(max(0,min(timeout,self.next_poll - time.monotonic())))
+            now: float = time.monotonic()
+            if now < self.next_poll:
+                return
+            self.next_poll = now + self.poll_interval
+            for product_path in self.snapshots:
+                old: dict[str,Tuple[int,int]] = self.snapshots[product_path]
+                new: dict[str,Tuple[int,int]] = self.snapshot(product_path)
+                self.snapshots[product_path] = new
+                for name, stat in new.items():
+                    if old.get(name) != stat:
+                        self.notice(product_path,name,now)
+            return
+        ready, _, _ = select.select([self.inotify],[],[],max(0,timeout))
+        if not ready:
+            return
+        now = time.monotonic()
+        for wd, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so anything could have changed
+                for product_path in self.configs:
+                    self.mark(product_path,None,now)
+            elif wd in self.watches:
+                if mask & IN_CREATE and not mask & IN_ISDIR:
+                    # a new file; wait for it to be closed
+                    continue
+                self.notice(self.watches[wd],name,now)
+
+    """
+    Makes sample backups of the changed versions of a product, then cleans
+    it.
+        @param versions: The versions that changed, or None for all of them.
+        @return: A summary of what was done.
+    """
+    def maintain(self, product_path: str, versions: set[Version] | None) -> str:
+        with ProductLock(product_path,["backup_sample","clean"]) as lock:
+            if lock.result == LockResult.DONE:
+                return "skipped, just done by another phase"
+            return self.maintain_locked(product_path,versions)
+
+    """
+    Does the work of maintain, with the product's lock held.
+    """
+    def maintain_locked(
+            self,
+            product_path: str,
+            versions: set[Version] | None
+    ) -> str:
+        config: dict[str,Any] = self.configs[product_path]
+        sample_config: dict[str,Any] = config["backup"]["sample"]
+        index = VersionIndex(os.path.join(product_path,INDEX_FILE))
+        all_versions: Product = \
+            index.get_versions(config["regex"],path=product_path)
+        stats: CopyStats = backup_sample(
+            Product(
+                (
+                    version for version in all_versions
+                    if versions is None or version[1] in versions
+                ),
+                is_sorted=True
+            ),
+            config["regex"],
+            sample_config,
+            index,
+            BackupManifest(
+                os.path.join(product_path,sample_config["destination"])
+            ),
+            CopyExecutor(config["performance"]["copy_workers"]),
+            product_path
+        )
+        registry_backed_up(product_path,all_versions,stats)
+        clean(all_versions,config["limit"],index,product_path)
+        index.save()
+        return (
+            f"sample backups: {stats}, deleted "
+            + f"{count_old_versions(all_versions,config['limit'])} versions"
+        )
+
+    """
+    Maintains every product whose debounce timer has run out.
+        @param now: The time to compare the timers with.
+    """
+    def flush(self, now: float):
+        for product_path, deadline in list(self.deadlines.items()):
+            if deadline > now:
+                continue
+            del self.deadlines[product_path]
+            versions: set[Version] | None = self.pending.pop(product_path)
+            try:
+                summary: str = self.maintain(product_path,versions)
+                print(f"\x1b[1m{product_path}\x1b[0m: {summary}",file=self.log)
+            except Exception as err:
+                print(
+                    f"\x1b[1m{product_path}\x1b[0m: \x1b[1;31mPhase Error: "
+                    + f"{type(err).__name__}: {err}\x1b[0m",
+                    file=sys.stderr
+                )
+            self.log.flush()
+
+    """
+    Watches until stop is set, or forever.
+    """
+    def run(self, stop: threading.Event | None = None):
+        while stop is None or not stop.is_set():
+            timeout: float = 1.0 if stop is not None else 60.0
+            if self.deadlines:
+                timeout = min(
+                    timeout,min(self.deadlines.values()) - time.monotonic()
+                )
+            self.wait(timeout)
+            self.flush(time.monotonic())
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+        for lock_fd in self.locks.values():
+            os.close(lock_fd)
+        self.locks.clear()
+
+"""
+The registry of products phase knows about, an SQLite database in the
+user's state directory (see registry_path), which phase init & phase
+desktop add products to. It holds each product's pattern, latest version
+and when its sample backups were last made, so that phase list and phase
+batch --registered don't have to search for products.
+"""
+class Registry():
+    """
+        @param path: The database file, which is created (along with its
+            directory) if need be. Defaults to registry_path().
+    """
+    def __init__(self, path: str | None = None):
+        import sqlite3
+        self.path: str = path or registry_path()
+        os.makedirs(os.path.dirname(self.path),exist_ok=True)
+        # several phases (e.g. a batch's workers) can update it at once
+        self.db = sqlite3.connect(self.path,timeout=30)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS products ("
+                + "path TEXT PRIMARY KEY, "
+                + "pattern TEXT NOT NULL, "
+                + "latest_version INTEGER, "
+                + "last_backup REAL, "
+                + "updated REAL NOT NULL)"
+            )
+
+    """
+    Adds a product, or updates everything about it if it is already there.
+    The latest version is found by listing the product, and the time of the
+    last sample backups from the manifest kept with them.
+        @param product_path: The product directory.
+        @param config: The product's configuration (see load_config).
+    """
+    def register(self, product_path: str, config: dict[str,Any]):
+        product_path = os.path.abspath(product_path)
+        latest: Product = \
+            get_versions(config["regex"],path=product_path).newest(1)
+        last_backup: float | None = None
+        destination: str = config["backup"]["sample"]["destination"]
+        if not is_remote(destination):
+            try:
+                last_backup = os.stat(os.path.join(
+                    product_path,destination,MANIFEST_FILE
+                )).st_mtime
+            except OSError:
+                pass
+        with self.db:
+            self.db.execute(
+                "INSERT INTO products VALUES (?,?,?,?,?) "
+                + "ON CONFLICT(path) DO UPDATE SET pattern = excluded.pattern, "
+                + "latest_version = excluded.latest_version, "
+                + "last_backup = excluded.last_backup, "
+                + "updated = excluded.updated",
+                (
+                    product_path,
+                    ", ".join(config["patterns"]),
+                    latest[0][1] if latest else None,
+                    last_backup,
+                    time.time()
+                )
+            )
+
+    """
+    Records that sample backups of a product have just been made, if it is
+    registered.
+        @param versions: The product's versions, newest first.
+    """
+    def backed_up(self, product_path: str, versions: Product):
+        now: float = time.time()
+        with self.db:
+            self.db.execute(
+                "UPDATE products SET latest_version = ?, last_backup = ?, "
+                + "updated = ? WHERE path = ?",
+                (
+                    versions[0][1] if versions else None,
+                    now,
+                    now,
+                    os.path.abspath(product_path)
+                )
+            )
+
+    """
+    Forgets about a product.
+    """
+    def remove(self, product_path: str):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM products WHERE path = ?",
+                (os.path.abspath(product_path),)
+            )
+
+    """
+    Every registered product, ordered by path.
+        @return: A dict for each, with the columns of the products table as
+            keys.
+    """
+    def products(self) -> List[dict[str,Any]]:
+        cursor = self.db.execute(
+            "SELECT path, pattern, latest_version, last_backup, updated "
+            + "FROM products ORDER BY path"
+        )
+        columns: List[str] = [column[0] for column in cursor.description]
+        return [dict(zip(columns,row)) for row in cursor]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "Registry":
+        return self
+
+    def __exit__(self, *_: Any):
+        self.close()
+
+"""
+Where the registry is kept: $XDG_STATE_HOME/phase, or ~/.local/state/phase
+if that isn't set.
+"""
+def registry_path() -> str:
+    state_home: str = os.getenv("XDG_STATE_HOME") or \
+        os.path.join(os.path.expanduser("~"),".local","state")
+    return os.path.join(state_home,"phase",REGISTRY_FILE)
+
+"""
+Records that sample backups of a product have just been made, if there is
+a registry at all; phase doesn't create one just for this.
+    @param stats: What the backups did; nothing is recorded if nothing was
+        copied.
+"""
+def registry_backed_up(product_path: str, versions: Product, stats: CopyStats):
+    if stats.files_copied == 0 or not os.path.exists(registry_path()):
+        return
+    import sqlite3
+    try:
+        with Registry() as registry:
+            registry.backed_up(product_path,versions)
+    except sqlite3.Error:
+        # the registry is only a cache; it is rebuilt by phase init/desktop
+        pass
+
+"""
+Adds a product to the registry (or updates it there), or forgets about it,
+for phase init & desktop. The registry is only a convenience, so if it
+can't be written to, a warning is printed rather than the command failing.
+    @param config: The product's configuration (see load_config), or None
+        to forget about it.
+"""
+def update_registry(product_path: str, config: dict[str,Any] | None):
+    import sqlite3
+    try:
+        with Registry() as registry:
+            if config is None:
+                registry.remove(product_path)
+            else:
+                registry.register(product_path,config)
+    except (OSError, sqlite3.Error) as err:
+        print(
+            "\x1b[1;33mWarning:\x1b[0m the product registry "
+            + f"({registry_path()}) couldn't be updated: {err}",
+            file=sys.stderr
+        )
+
+"""
+Prints every registered product: its latest version, when its sample
+backups were last made and its pattern. Products whose .phase file has gone
+are marked as missing.
+"""
+def list_products():
+    from datetime import datetime
+    with Registry() as registry:
+        products: List[dict[str,Any]] = registry.products()
+    if not products:
+        print(
+            "No products registered. Products are registered by phase init "
+            + "and phase desktop."
+        )
+        return
+    for product in products:
+        latest: str = "-" if product["latest_version"] is None \
+            else f"v{product['latest_version']}"
+        last_backup: str = "never backed up" \
+            if product["last_backup"] is None \
+            else "backed up " + datetime.fromtimestamp(
+                product["last_backup"]
+            ).strftime("%Y-%m-%d %H:%M")
+        missing: str = "" \
+            if os.path.exists(os.path.join(product["path"],".phase")) \
+            else " \x1b[1;31m(missing)\x1b[0m"
+        print(
+            f"\x1b[1m{product['path']}\x1b[0m{missing}: {latest}, "
+            + f"{last_backup} ({product['pattern']})"
+        )
 
 def prompt(question: str, default: str="") -> str:
     print(f"\x1b[1m{question}\x1b[0m")
@@ -379,6 +5324,8 @@ with a given configuration.
         the relevant settings to the config file.
 """
 def add_desktop_file(product_path: str, config: dict[str,Any]):
+    import textwrap
+    from datetime import datetime
     if not os.path.exists(DESKTOP_FILES_LOC):
         os.mkdir(DESKTOP_FILES_LOC)
     if "desktop" in config:
@@ -452,6 +5399,7 @@ def add_desktop_file(product_path: str, config: dict[str,Any]):
     desktop_file.close()
 
 def remove_desktop_file(product_path,config: dict[str,Any]):
+    import textwrap
     if "desktop" not in config:
         print(textwrap.dedent("""
             This product has no desktop entry file.
@@ -489,6 +5437,7 @@ def remove_desktop_file(product_path,config: dict[str,Any]):
             config_file.write(new_config[i])
 
 def initialise(product_path: str):
+    import textwrap
     if os.path.exists(product_path + "/.phase"):
         print("This directory already contains a .phase file!")
         print("Delete it if you wish to continue")